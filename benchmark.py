@@ -0,0 +1,327 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from betfair import BetfairSettings
+from betmapping import BetMapping
+from codec import decodeResult, decodeMarketCatalogues, decodeCurrentOrders
+from codec import iterResultItems, MarketCatalogue
+from daemon import OverUnderStrategy
+from eventlog import log
+from eventlog import WARNING
+from exclusions import ExclusionRules
+from fakebetfair import FakeExchange
+from fakebetfair import FakeBetfair
+from fakebetfair import UNDER_SELECTION_ID
+from fakebetfair import createOfflineStrategy
+
+# ----------------------------------
+# HARNESS
+# ----------------------------------
+
+
+def measure(name, fn, repeat=5):
+    # autorange so each repeat runs for at least 0.2s, report per call timings
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(number, int(number * 0.2 / elapsed)) if elapsed > 0 else number
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+
+    result = {'name': name, 'number': number, 'repeat': repeat, 'best_us': round(min(timings) * 1e6, 3),
+              'median_us': round(statistics.median(timings) * 1e6, 3), 'mean_us': round(statistics.mean(timings) * 1e6, 3)}
+    print('%-40s %12.3f us  (median of %d x %d)' %
+          (name, result['median_us'], repeat, number))
+    return result
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# ----------------------------------
+# MICRO BENCHMARKS
+# ----------------------------------
+
+
+def microBenchmarks(selected):
+    results = []
+    settings = BetfairSettings('bench', 'bench', 'https://betting.invalid/',
+                               'https://accounts.invalid/')
+
+    exchange = FakeExchange(events=34, marketsPerEvent=30)
+    betfair = FakeBetfair(settings, exchange)
+    marketId = exchange.catalogues[exchange.events[0]['event']['id']][0]['marketId']
+    marketBook = betfair.getMarketBookBestOffers(marketId)
+
+    prices = [1.01 + i * 0.37 for i in range(100)]
+    applyOddsLadder = OverUnderStrategy.applyOddsLadder
+
+    def oddsLadder():
+        for price in prices:
+            applyOddsLadder(None, price)
+
+    catalogueResponse = exchange.handle('', json.dumps({'method': 'SportsAPING/v1.0/listMarketCatalogue', 'params': {
+                                        'filter': {}, 'maxResults': '1000'}}))
+    exchange.addOpenPositions(500)
+    ordersResponse = exchange.handle('', json.dumps(
+        {'method': 'SportsAPING/v1.0/listCurrentOrders', 'params': {}}))
+
+    def streamCatalogue():
+        chunks = [catalogueResponse[i:i + 65536]
+                  for i in range(0, len(catalogueResponse), 65536)]
+        fromResult = MarketCatalogue.fromResult
+        return [fromResult(market) for market in iterResultItems('listMarketCatalogue', chunks)]
+
+    exclusionRules = ExclusionRules(['Excluded Team %d' % i for i in range(150)])
+    eventNames = ['Home %d v Away %d' % (i, i) for i in range(99)] + ['Excluded Team 7 v Home 1']
+
+    def exclusionFilter():
+        for eventName in eventNames:
+            exclusionRules.match(eventName)
+
+    infogolBet = {'HomeTeam': 'Manchester United', 'AwayTeam': 'Leicester City', 'HomeTeamDisplay': 'Man Utd',
+                  'AwayTeamDisplay': 'Leicester', 'MatchDateTime': '2019-03-16T15:00:00', 'VerdictText': 'Man Utd To Win',
+                  'VerdictConfidence': 3}
+
+    benchmarks = [
+        ('applyOddsLadder x100', oddsLadder),
+        ('getCurrentBestPrices', lambda: betfair.getCurrentBestPrices(
+            marketBook, UNDER_SELECTION_ID)),
+        ('getCurrentLayPrice', lambda: betfair.getCurrentLayPrice(
+            marketBook, UNDER_SELECTION_ID)),
+        ('decode listMarketCatalogue 1000', lambda: json.loads(catalogueResponse)),
+        ('decode listCurrentOrders 1000', lambda: json.loads(ordersResponse)),
+        ('codec listMarketCatalogue 1000', lambda: decodeMarketCatalogues(
+            decodeResult('listMarketCatalogue', catalogueResponse))),
+        ('stream listMarketCatalogue 1000', streamCatalogue),
+        ('codec listCurrentOrders 1000', lambda: decodeCurrentOrders(
+            decodeResult('listCurrentOrders', ordersResponse))),
+        ('exclusion filter x100 events', exclusionFilter),
+        ('BetMapping construction', lambda: BetMapping(dict(infogolBet))),
+    ]
+
+    for name, fn in benchmarks:
+        if selected is None or selected in name:
+            results.append(measure(name, fn))
+
+    return results
+
+# ----------------------------------
+# MACRO BENCHMARK
+# ----------------------------------
+
+ITERATION_NAME = 'iteration events=%d markets=%d positions=%d'
+POSITION_PASS_NAME = 'position pass positions=%d active=%d changes=%s'
+STOP_LOSS_NAME = 'stop loss step positions=%d workers=%d'
+
+
+def iterationBenchmark(events, marketsPerEvent, positions, ticks):
+    exchange = FakeExchange(
+        events=events, marketsPerEvent=marketsPerEvent, kickOffSpreadMinutes=2)
+    exchange.addOpenPositions(positions)
+
+    with tempfile.TemporaryDirectory() as directory:
+        strategy = createOfflineStrategy(
+            exchange, os.path.join(directory, 'bench.journal'))
+
+        durations = []
+        callsPerTick = []
+        for tick in range(ticks):
+            exchange.resetCalls()
+            startedAt = time.perf_counter()
+            strategy.iteration()
+            durations.append(time.perf_counter() - startedAt)
+            callsPerTick.append(sum(exchange.calls.values()))
+
+        strategy.ledger.stop()
+        strategy.journal.close()
+        strategy.memory.close()
+        strategy.exitPool.shutdown()
+
+    # the first tick bootstraps discovery so it is reported separately
+    firstTick = durations[0]
+    durations.sort()
+    result = {'name': ITERATION_NAME % (events, marketsPerEvent, positions),
+              'ticks': ticks, 'first_tick_ms': round(firstTick * 1e3, 3),
+              'median_ms': round(statistics.median(durations) * 1e3, 3),
+              'p95_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1e3, 3),
+              'max_ms': round(durations[-1] * 1e3, 3), 'api_calls_per_tick': round(statistics.mean(callsPerTick), 2)}
+    print('%-40s %12.3f ms  (p95 %.3f ms, %.1f api calls/tick)' %
+          (result['name'], result['median_ms'], result['p95_ms'], result['api_calls_per_tick']))
+    return result
+
+
+def changeDetectionBenchmark(positions, active, ticks, enabled):
+    '''
+    CPU of the position pass per tick with positions hedged and waiting, of which
+    only `active` see an order change (a partial fill on the hedge) each tick.
+    With change detection the cost follows `active`, without it `positions`.
+    The fake exchange's own CPU is taken out of the timings.
+    '''
+    exchange = FakeExchange(events=positions, marketsPerEvent=1)
+    marketIds = exchange.addOpenPositions(positions)
+
+    exchangeSeconds = [0.0]
+    handle = exchange.handle
+
+    def timedHandle(url, body, timeout=None):
+        startedAt = time.process_time()
+        try:
+            return handle(url, body, timeout)
+        finally:
+            exchangeSeconds[0] += time.process_time() - startedAt
+    exchange.handle = timedHandle
+
+    with tempfile.TemporaryDirectory() as directory:
+        strategy = createOfflineStrategy(
+            exchange, os.path.join(directory, 'bench.journal'))
+        strategy.changes.enabled = enabled
+        strategy.betfair = FakeBetfair(strategy.betfairSettings, exchange)
+        strategy.tradeExistingMarketPositions()
+
+        durations = []
+        for tick in range(ticks):
+            for marketId in marketIds[tick * active % positions:][:active]:
+                hedge = exchange.orders[marketId][1]
+                hedge['sizeMatched'] = round(hedge['sizeMatched'] + 0.01, 2)
+                hedge['sizeRemaining'] = round(hedge['sizeRemaining'] - 0.01, 2)
+            exchangeSeconds[0] = 0.0
+            startedAt = time.process_time()
+            strategy.tradeExistingMarketPositions()
+            durations.append(time.process_time() -
+                             startedAt - exchangeSeconds[0])
+            strategy.changes.flush()
+
+        strategy.ledger.stop()
+        strategy.journal.close()
+        strategy.memory.close()
+        strategy.exitPool.shutdown()
+
+    result = {'name': POSITION_PASS_NAME % (positions, active, 'on' if enabled else 'off'),
+              'ticks': ticks, 'median_ms': round(statistics.median(durations) * 1e3, 3),
+              'open_positions': len(strategy.positions)}
+    print('%-40s %12.3f ms' % (result['name'], result['median_ms']))
+    return result
+
+
+def exitBenchmark(positions, ticks, latencySeconds, workers):
+    '''
+    Stop loss stepping with every position past its deadline: the exit engine's
+    decision pass (CPU) and the whole step including submission (wall clock)
+    against a fake exchange answering each call after latencySeconds, with
+    actions submitted from `workers` threads.
+    '''
+    exchange = FakeExchange(events=positions, marketsPerEvent=1,
+                            latency=lambda operation: latencySeconds)
+    exchange.pricePath = lambda market, elapsed: market['basePrice']
+    exchange.addOpenPositions(positions, placedMinutesAgo=16.5, backStake=10.0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        strategy = createOfflineStrategy(
+            exchange, os.path.join(directory, 'bench.journal'))
+        strategy.exitPool.shutdown()
+        strategy.exitPool = concurrent.futures.ThreadPoolExecutor(workers)
+        strategy.betfair = FakeBetfair(strategy.betfairSettings, exchange)
+
+        decideSeconds = []
+        stepSeconds = []
+        decide = strategy.exitEngine.decide
+        stepStopLosses = strategy.stepStopLosses
+
+        def timedDecide(*args):
+            startedAt = time.process_time()
+            try:
+                return decide(*args)
+            finally:
+                decideSeconds.append(time.process_time() - startedAt)
+
+        def timedStep(*args):
+            startedAt = time.perf_counter()
+            stepStopLosses(*args)
+            stepSeconds.append(time.perf_counter() - startedAt)
+
+        strategy.exitEngine.decide = timedDecide
+        strategy.stepStopLosses = timedStep
+        for tick in range(ticks):
+            strategy.tradeExistingMarketPositions()
+
+        strategy.ledger.stop()
+        strategy.journal.close()
+        strategy.memory.close()
+        strategy.exitPool.shutdown()
+
+    result = {'name': STOP_LOSS_NAME % (positions, workers), 'ticks': len(stepSeconds),
+              'decide_ms': round(statistics.median(decideSeconds) * 1e3, 3),
+              'median_ms': round(statistics.median(stepSeconds) * 1e3, 3), 'latency_ms': latencySeconds * 1e3}
+    print('%-40s %12.3f ms  (decide %.3f ms)' %
+          (result['name'], result['median_ms'], result['decide_ms']))
+    return result
+
+# ----------------------------------
+# MAIN
+# ----------------------------------
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Micro and macro benchmarks for the strategy and Betfair client hot paths.')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--markets', type=int, default=30, help='markets per event')
+    parser.add_argument('--positions', type=int, default=20)
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--output-dir', default='benchmark-results')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+
+    # keep the background log writer quiet while measuring
+    log.level = WARNING
+
+    def selected(name):
+        return args.filter is None or args.filter in name
+
+    results = microBenchmarks(args.filter)
+    if selected(ITERATION_NAME % (args.events, args.markets, args.positions)):
+        results.append(iterationBenchmark(
+            args.events, args.markets, args.positions, args.ticks))
+    for positions in (100, 500, 2000):
+        for enabled in (False, True):
+            if selected(POSITION_PASS_NAME % (positions, 10, 'on' if enabled else 'off')):
+                results.append(changeDetectionBenchmark(
+                    positions, 10, args.ticks, enabled))
+    for positions in (5, 50, 500):
+        for workers in (1, 16):
+            if selected(STOP_LOSS_NAME % (positions, workers)):
+                results.append(exitBenchmark(positions, 5, 0.02, workers))
+
+    revision = gitRevision()
+    report = {'revision': revision, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': sys.version.split()[0], 'platform': platform.platform(), 'args': vars(args), 'results': results}
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    outputPath = os.path.join(args.output_dir, 'bench-%s-%s.json' %
+                              (revision, time.strftime('%Y%m%d-%H%M%S')))
+    with open(outputPath, 'w') as outputFile:
+        json.dump(report, outputFile, indent=2)
+    print('written: %s' % outputPath)
+
+    if args.compare:
+        with open(args.compare) as compareFile:
+            previous = {result['name']: result for result in json.load(compareFile)['results']}
+        print('\ncompared with %s' % args.compare)
+        for result in results:
+            before = previous.get(result['name'])
+            key = 'median_us' if 'median_us' in result else 'median_ms'
+            if before is not None and before.get(key):
+                print('%-40s %8.2fx' % (result['name'], result[key] / before[key]))
@@ -1,23 +1,34 @@
 import urllib
 import urllib.request
 import urllib.error
-import json
 import datetime
 import sys
 import uuid
 import datetime
-import fuzzywuzzy
+import time
 
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
+from eventlog import log
+from metrics import metrics
+from tracing import tracer
+from resilience import CircuitOpenError
+
+from codec import APINGError
+from codec import encodeRequest, decodeResult, loads, iterResultItems
+from codec import decodeMarketBooks, decodeCurrentOrders, decodeClearedOrders, decodeAccountFunds
+from codec import MarketCatalogue, CurrentOrder
 
 
 class BetfairSettings:
-    def __init__(self, appKey, sessionToken, bettingURL, accountsURL):
+    def __init__(self, appKey, sessionToken, bettingURL, accountsURL, timeoutSeconds=30.0, hedging=None, resilience=None):
         self.appKey = appKey
         self.sessionToken = sessionToken
         self.bettingURL = bettingURL
         self.accountsURL = accountsURL
+        # socket timeout per request (the ceiling when resilience derives it from the tick budget), and
+        # optional HedgedReads and Resilience shared by every client built from these settings
+        self.timeoutSeconds = timeoutSeconds
+        self.hedging = hedging
+        self.resilience = resilience
         self.headers = {'X-Application': appKey, 'X-Authentication': sessionToken,
                         'content-type': 'application/json'}
 
@@ -83,10 +94,10 @@ class Betfair:
                             matchMarketCatalogue, betMapping.marketName)
 
             if market is not None:
-                betMapping.marketId = market['marketId']
+                betMapping.marketId = market.marketId
                 selection = self.getSelection(market, betMapping.selectionName)
                 if selection is not None:
-                    betMapping.selectionId = selection['selectionId']
+                    betMapping.selectionId = selection.selectionId
 
             if betMapping.selectionId is not None:
                 market_book_result = self.getMarketBookBestOffers(
@@ -100,57 +111,201 @@ class Betfair:
 
         return betMappings
 
-    def callBettingAping(self, jsonrpc_req):
+    def callBetting(self, operation, params, decoder=None):
+        return self.callOperation(self.settings.bettingURL, 'SportsAPING/v1.0/' + operation, params, decoder, 'betting')
+
+    def callAccount(self, operation, params, decoder=None):
+        return self.callOperation(self.settings.accountsURL, 'AccountAPING/v1.0/' + operation, params, decoder, 'accounts')
+
+    def callOperation(self, url, method, params, decoder=None, endpoint='betting'):
+        # raises APINGError when no result is available
+        operation = method.rsplit('/', 1)[-1]
+        body = encodeRequest(method, params)
+
+        with tracer.span('betfair.' + operation, operation=operation):
+            jsonResponse = self.sendAping(url, body, operation, endpoint)
+
+            if jsonResponse is None:
+                raise APINGError(operation, 'UNAVAILABLE')
+
+            result = decodeResult(operation, jsonResponse)
+            return decoder(result) if decoder is not None else result
+
+    def streamBetting(self, operation, params, fromResult, arrayKey=None, predicate=None):
+        '''
+        Yields result records as the response streams in, dropping those the
+        predicate rejects before the next one is parsed. Raises APINGError, possibly
+        after some records have been yielded.
+        '''
+        url = self.settings.bettingURL
+        body = encodeRequest('SportsAPING/v1.0/' + operation, params)
+        labels = (('operation', operation),)
+
+        with tracer.span('betfair.' + operation, operation=operation, streamed=True):
+            metrics.add('betfair_requests_in_flight', 1, labels)
+            metrics.inc('betfair_request_bytes_total', labels, len(body))
+            startedAt = time.perf_counter()
+            try:
+                if self.settings.resilience is not None:
+                    chunks = self.settings.resilience.stream(
+                        'betting', operation, lambda timeout: self.openChunks(url, body, operation, timeout), self.settings.timeoutSeconds)
+                else:
+                    chunks = self.openChunks(url, body, operation)
+                for item in iterResultItems(operation, self.countChunks(chunks, labels), arrayKey):
+                    record = fromResult(item)
+                    if predicate is None or predicate(record):
+                        yield record
+            except urllib.error.HTTPError as e:
+                metrics.inc('betfair_errors_total', labels +
+                            (('errorCode', 'HTTP_%d' % e.code),))
+                log.error('APING_HTTP_ERROR', operation=operation,
+                          url=url, statusCode=e.code)
+                raise APINGError(operation, 'UNAVAILABLE',
+                                 errorDetails='HTTP %d' % e.code)
+            except CircuitOpenError as e:
+                metrics.inc('betfair_errors_total', labels +
+                            (('errorCode', 'CIRCUIT_OPEN'),))
+                raise APINGError(operation, 'UNAVAILABLE', errorDetails=str(e))
+            except OSError as e:
+                metrics.inc('betfair_errors_total', labels +
+                            (('errorCode', 'URL_ERROR'),))
+                log.error('APING_UNAVAILABLE', operation=operation,
+                          url=url, reason=str(getattr(e, 'reason', e)))
+                raise APINGError(operation, 'UNAVAILABLE', errorDetails=str(e))
+            except APINGError as e:
+                metrics.inc('betfair_errors_total',
+                            labels + (('errorCode', e.errorCode),))
+                raise
+            finally:
+                metrics.observe('betfair_request_seconds',
+                                time.perf_counter() - startedAt, labels)
+                metrics.add('betfair_requests_in_flight', -1, labels)
+
+    def openChunks(self, url, body, operation, timeout=None):
+        if self.settings.hedging is not None:
+            return self.settings.hedging.stream(operation, lambda: self.postChunks(url, body, timeout=timeout))
+        return self.postChunks(url, body, timeout=timeout)
+
+    def countChunks(self, chunks, labels):
+        for chunk in chunks:
+            metrics.inc('betfair_response_bytes_total', labels, len(chunk))
+            yield chunk
+
+    def collect(self, records):
         try:
-            req = urllib.request.Request(
-                self.settings.bettingURL, jsonrpc_req.encode('utf-8'), self.settings.headers)
-            response = urllib.request.urlopen(req)
-            jsonResponse = response.read()
-            return jsonResponse.decode('utf-8')
-        except urllib.error.HTTPError:
-            print('Not a valid operation from the service ' +
-                  str(self.settings.bettingURL))
-            # exit()
-            return None
-        except urllib.error.URLError as e:
-            print(e.reason)
-            print('No service available at ' + str(self.settings.bettingURL))
-            # exit()
+            return list(records)
+        except APINGError as e:
+            self.logApingError(e)
             return None
 
-    def callAccountAping(self, jsonrpc_req):
+    def sendAping(self, url, body, operation, endpoint='betting'):
+        labels = (('operation', operation),)
+
+        metrics.add('betfair_requests_in_flight', 1, labels)
+        metrics.inc('betfair_request_bytes_total', labels, len(body))
+        startedAt = time.perf_counter()
         try:
-            req = urllib.request.Request(
-                self.settings.accountsURL, jsonrpc_req.encode('utf-8'), self.settings.headers)
-            response = urllib.request.urlopen(req)
-            jsonResponse = response.read()
-            return jsonResponse.decode('utf-8')
-        except urllib.error.HTTPError:
-            print('Not a valid operation from the service ' +
-                  str(self.settings.accountsURL))
+            if self.settings.resilience is not None:
+                jsonResponse = self.settings.resilience.call(
+                    endpoint, operation, lambda timeout: self.postOnce(url, body, operation, timeout), self.settings.timeoutSeconds)
+            else:
+                jsonResponse = self.postOnce(url, body, operation)
+            metrics.inc('betfair_response_bytes_total',
+                        labels, len(jsonResponse))
+            self.recordApiErrors(operation, jsonResponse)
+            return jsonResponse
+        except urllib.error.HTTPError as e:
+            metrics.inc('betfair_errors_total', labels +
+                        (('errorCode', 'HTTP_%d' % e.code),))
+            log.error('APING_HTTP_ERROR', operation=operation,
+                      url=url, statusCode=e.code)
             # exit()
             return None
         except urllib.error.URLError as e:
-            print(e.reason)
-            print('No service available at ' + str(self.settings.accountsURL))
+            metrics.inc('betfair_errors_total', labels +
+                        (('errorCode', 'URL_ERROR'),))
+            log.error('APING_UNAVAILABLE', operation=operation,
+                      url=url, reason=str(e.reason))
             # exit()
             return None
+        except CircuitOpenError:
+            # the endpoint is down: fail at once, the breaker logged the outage
+            metrics.inc('betfair_errors_total', labels +
+                        (('errorCode', 'CIRCUIT_OPEN'),))
+            log.debug('APING_CIRCUIT_OPEN', operation=operation, endpoint=endpoint)
+            return None
+        except OSError as e:
+            # read timeouts surface as TimeoutError rather than URLError
+            errorCode = 'TIMEOUT' if isinstance(e, TimeoutError) else 'SOCKET_ERROR'
+            metrics.inc('betfair_errors_total', labels +
+                        (('errorCode', errorCode),))
+            log.error('APING_UNAVAILABLE', operation=operation,
+                      url=url, reason=str(e))
+            return None
+        finally:
+            metrics.observe('betfair_request_seconds',
+                            time.perf_counter() - startedAt, labels)
+            metrics.add('betfair_requests_in_flight', -1, labels)
+
+    def postOnce(self, url, body, operation, timeout=None):
+        # one attempt, hedged when the settings say so
+        if self.settings.hedging is not None:
+            return self.settings.hedging.call(operation, lambda: self.post(url, body, timeout))
+        return self.post(url, body, timeout)
+
+    def post(self, url, body, timeout=None):
+        req = urllib.request.Request(url, body, self.settings.headers)
+        with urllib.request.urlopen(req, timeout=self.settings.timeoutSeconds if timeout is None else timeout) as response:
+            return response.read()
+
+    def postChunks(self, url, body, chunkSize=65536, timeout=None):
+        req = urllib.request.Request(url, body, self.settings.headers)
+        with urllib.request.urlopen(req, timeout=self.settings.timeoutSeconds if timeout is None else timeout) as response:
+            while True:
+                chunk = response.read(chunkSize)
+                if not chunk:
+                    return
+                yield chunk
+
+    def recordApiErrors(self, operation, jsonResponse):
+        # only parse the body again on the (rare) error path
+        if b'"error"' not in jsonResponse and b'"errorCode"' not in jsonResponse:
+            return
+
+        try:
+            response = loads(jsonResponse)
+        except ValueError:
+            return
+
+        errorCodes = []
+        if 'error' in response:
+            errorCodes.append(APINGError.fromError(
+                operation, response['error']).errorCode)
+        elif isinstance(response.get('result'), dict):
+            result = response['result']
+            if 'errorCode' in result:
+                errorCodes.append(result['errorCode'])
+            for report in result.get('instructionReports', []):
+                if 'errorCode' in report:
+                    errorCodes.append(report['errorCode'])
+
+        for errorCode in errorCodes:
+            metrics.inc('betfair_errors_total', (('operation',
+                        operation), ('errorCode', errorCode)))
+
+    def logApingError(self, error, event='APING_EXCEPTION'):
+        log.error(event, **error.fields())
 
     """
     calling getEventTypes operation
     """
 
     def getEventTypes(self):
-        event_type_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listEventTypes", "params": {"filter":{ }}, "id": 1}'
         #print('Calling listEventTypes to get event Type ID')
-        eventTypesResponse = self.callBettingAping(event_type_req)
-        eventTypeLoads = json.loads(eventTypesResponse)
-
         try:
-            eventTypeResults = eventTypeLoads['result']
-            return eventTypeResults
-        except:
-            print('Exception from API-NG' + str(eventTypeLoads['error']))
+            return self.callBetting('listEventTypes', {'filter': {}})
+        except APINGError as e:
+            self.logApingError(e)
             # exit()
             return None
 
@@ -165,558 +320,305 @@ class Betfair:
                 if(eventTypeName == requestedEventTypeName):
                     return event['eventType']['id']
         else:
-            print('There is an issue with the input')
+            log.warning('NO_EVENT_TYPES')
             # exit()
             return None
 
     def getMarketId(self, marketCatalogueResult):
         if(marketCatalogueResult is not None):
             for market in marketCatalogueResult:
-                return market['marketId']
+                return market.marketId
 
     def getMarket(self, marketCatalogueResult, marketName):
         if(marketCatalogueResult is not None):
             for market in marketCatalogueResult:
-                if market['marketName'] == marketName:
+                if market.marketName == marketName:
                     return market
 
     def getSelectionId(self, marketCatalogueResult):
         if(marketCatalogueResult is not None):
             for market in marketCatalogueResult:
-                return market['runners'][0]['selectionId']
+                return market.runners[0].selectionId
 
     def getSelection(self, market, selectionName, confidenceThreshold=100):
+        # only the infogol mapping fuzzy matches - imported here to keep it off the daemon's startup
+        from fuzzywuzzy import fuzz
+
         if(market is not None):
-            for selection in market['runners']:
-                confidence = fuzz.ratio(selectionName, selection['runnerName'])
+            for selection in market.runners:
+                confidence = fuzz.ratio(selectionName, selection.runnerName)
                 if confidence >= confidenceThreshold:
                     return selection
 
     def getMarketBookBestOffers(self, marketId):
         #print('Calling listMarketBook to read prices for the Market with ID :' + marketId)
-        market_book_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listMarketBook", "params": {"marketIds":["' + \
-            marketId + \
-            '"],"priceProjection":{"priceData":["EX_BEST_OFFERS"]}}, "id": 1}'
         try:
-            """
-            print(market_book_req)
-            """
-            market_book_response = self.callBettingAping(market_book_req)
-            """
-            print(market_book_response)
-            """
-            market_book_loads = json.loads(market_book_response)
-
-            market_book_result = market_book_loads['result']
-            return market_book_result
-        except:
-            print('Exception from API-NG' + str(market_book_result['error']))
+            return self.callBetting('listMarketBook', {'marketIds': [marketId], 'priceProjection': {'priceData': ['EX_BEST_OFFERS']}},
+                                    decodeMarketBooks)
+        except APINGError as e:
+            self.logApingError(e)
             # exit()
             return None
 
+    def listMarketBooks(self, marketIds):
+        # EX_BEST_OFFERS costs weight 5 per market, so at most 40 marketIds per call
+        try:
+            return self.callBetting('listMarketBook', {'marketIds': marketIds, 'priceProjection': {'priceData': ['EX_BEST_OFFERS']}},
+                                    decodeMarketBooks)
+        except APINGError as e:
+            self.logApingError(e)
+            return None
+
     def getCurrentBestPrices(self, market_book_result, selectionId):
         if(market_book_result is not None):
             for marketBook in market_book_result:
-                runners = marketBook['runners']
-                for runner in runners:
-                    if (runner['selectionId'] == selectionId):
-                        if (runner['status'] == 'ACTIVE'):
-                            try:
-                                return runner['ex']['availableToBack'][0]['price'], runner['ex']['availableToLay'][0]['price']
-                            except:
-                                return None, None
+                for runner in marketBook.runners:
+                    if (runner.selectionId == selectionId):
+                        if (runner.status == 'ACTIVE'):
+                            if runner.availableToBack and runner.availableToLay:
+                                return runner.availableToBack[0][0], runner.availableToLay[0][0]
+                            return None, None
         return None, None
 
     def getCurrentLayPrice(self, market_book_result, selectionId):
         if(market_book_result is not None):
             for marketBook in market_book_result:
-                runners = marketBook['runners']
-                for runner in runners:
-                    if (runner['selectionId'] == selectionId):
-                        if (runner['status'] == 'ACTIVE'):
-                            try:
-                                return runner['ex']['availableToLay'][0]['price']
-                            except:
-                                return None
+                for runner in marketBook.runners:
+                    if (runner.selectionId == selectionId):
+                        if (runner.status == 'ACTIVE'):
+                            if runner.availableToLay:
+                                return runner.availableToLay[0][0]
+                            return None
 
     def printPriceInfo(self, market_book_result):
         if(market_book_result is not None):
             print('Please find Best three available prices for the runners')
             for marketBook in market_book_result:
-                runners = marketBook['runners']
-                for runner in runners:
-                    print('Selection id is ' + str(runner['selectionId']))
-                    if (runner['status'] == 'ACTIVE'):
+                for runner in marketBook.runners:
+                    print('Selection id is ' + str(runner.selectionId))
+                    if (runner.status == 'ACTIVE'):
                         print('Available to back price :' +
-                              str(runner['ex']['availableToBack'][0]))
+                              str(runner.availableToBack[0]))
                         print('Available to lay price :' +
-                              str(runner['ex']['availableToLay']))
+                              str(runner.availableToLay))
                     else:
                         print('This runner is not active')
 
     def placeBet(self, marketId, selectionId, stake, price):
         if(marketId is not None and selectionId is not None and price is not None):
             customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrder for marketId :' + marketId +
-                  ' with selection id :' + str(selectionId) +
-                  ' with customerRef :' + customerRef)
-            place_order_Req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/placeOrders", "params": {"marketId":"' + str(marketId) + '","instructions":'\
-                '[{"selectionId":"' + str(selectionId) + '","handicap":"0","side":"BACK","orderType":"LIMIT","limitOrder":{"size":"' + str(
-                    stake) + '","price":"' + str(price) + '","persistenceType":"LAPSE"}}],"customerRef":"' + customerRef + '"}, "id": 1}'
-            """
-            print(place_order_Req)
-            """
-            place_order_Response = self.callBettingAping(place_order_Req)
-            place_order_load = json.loads(place_order_Response)
-            try:
-                # uncomment
-                place_order_result = place_order_load['result']
-                print('Place order status is ' + place_order_result['status'])
-
-                if place_order_result['status'] != 'SUCCESS':
-                    print(place_order_result, end='\n\n')
-
-                """
-                print('Place order error status is ' + place_order_result['errorCode'])
-                print('Reason for Place order failure is ' +
-                    place_order_result['instructionReports'][0]['errorCode'])
-                """
-            except:
-                print('Exception from API-NG' +
-                      str(place_order_result['error']))
-                """
-                print(place_order_Response)
-                """
+            log.info('PLACE_ORDER', marketId=marketId, selectionId=selectionId,
+                     customerRef=customerRef)
+            return self.submitOrders(marketId, [self.limitInstruction(selectionId, 'BACK', stake, price, 'LAPSE')], customerRef)
 
     def placeOrderPair(self, marketId, backSelectionId, backStake, backPrice, laySelectionId, layStake, layPrice):
+        customerRef = str(uuid.uuid4().hex)
+        log.info('PLACE_ORDER', marketId=marketId, selectionId=backSelectionId,
+                 customerRef=customerRef)
 
-        try:
-            customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrder for marketId :' + marketId +
-                  ' with back selection id :' + str(backSelectionId) +
-                  ' with customerRef :' + customerRef)
-
-            place_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/placeOrders","params":{"marketId":"%s","instructions":[{"selectionId":"%s","handicap":"0","side":"BACK","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"LAPSE"}},{"selectionId":"%s","handicap":"0","side":"LAY","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"PERSIST"}}], "customerRef":"%s"},"id":1}' % (
-                str(marketId), str(backSelectionId), str(backStake), str(backPrice), str(laySelectionId), str(layStake), str(layPrice), customerRef)
-
-            print(place_order_Req)
-
-            place_order_Response = self.callBettingAping(place_order_Req)
-            #place_order_Response = None
-
-            place_order_load = json.loads(place_order_Response)
-
-            # uncomment
-            place_order_result = place_order_load['result']
-            print('Place order status is ' + place_order_result['status'])
-
-            if place_order_result['status'] != 'SUCCESS':
-                print(place_order_result, end='\n\n')
-                return False
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(place_order_result['error']))
-            """
-            print(place_order_Response)
-            """
-            return False
+        return self.submitOrders(marketId, [self.limitInstruction(backSelectionId, 'BACK', backStake, backPrice, 'LAPSE'),
+                                            self.limitInstruction(laySelectionId, 'LAY', layStake, layPrice, 'PERSIST')], customerRef)
 
-        return True
+    def placeBackTheUnderPair(self, marketId, backSelectionId, backStake, backPrice, laySelectionId, layStake, layPrice, customerRef=None):
+        # the caller passes customerRef when it keeps it (the daemon journals it)
+        customerRef = customerRef or str(uuid.uuid4().hex)
+        log.info('PLACE_ORDER', marketId=marketId, selectionId=backSelectionId,
+                 customerRef=customerRef)
 
-    def placeBackTheUnderPair(self, marketId, backSelectionId, backStake, backPrice, laySelectionId, layStake, layPrice):
+        return self.submitOrders(marketId, [self.limitInstruction(backSelectionId, 'BACK', backStake, backPrice, 'LAPSE', 'FILL_OR_KILL'),
+                                            self.limitInstruction(laySelectionId, 'LAY', layStake, layPrice, 'PERSIST')], customerRef)
 
-        try:
-            customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrder for marketId :' + marketId +
-                  ' with back selection id :' + str(backSelectionId) +
-                  ' with customerRef :' + customerRef)
-
-            place_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/placeOrders","params":{"marketId":"%s","instructions":[{"selectionId":"%s","handicap":"0","side":"BACK","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"LAPSE","timeInForce":"FILL_OR_KILL"}},{"selectionId":"%s","handicap":"0","side":"LAY","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"PERSIST"}}], "customerRef":"%s"},"id":1}' % (
-                str(marketId), str(backSelectionId), str(backStake), str(backPrice), str(laySelectionId), str(layStake), str(layPrice), customerRef)
-
-            print(place_order_Req)
-
-            place_order_Response = self.callBettingAping(place_order_Req)
-            #place_order_Response = None
-
-            place_order_load = json.loads(place_order_Response)
-
-            # uncomment
-            place_order_result = place_order_load['result']
-            print('Place order status is ' + place_order_result['status'])
-
-            if place_order_result['status'] != 'SUCCESS':
-                print(place_order_result, end='\n\n')
-                return False
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(place_order_result['error']))
-            """
-            print(place_order_Response)
-            """
-            return False
+    def placeLayTheOverPair(self, marketId, laySelectionId, layStake, layPrice, backSelectionId, backStake, backPrice):
+        customerRef = str(uuid.uuid4().hex)
+        log.info('PLACE_ORDER', marketId=marketId, selectionId=backSelectionId,
+                 customerRef=customerRef)
 
-        return True
+        return self.submitOrders(marketId, [self.limitInstruction(laySelectionId, 'LAY', layStake, layPrice, 'LAPSE', 'FILL_OR_KILL'),
+                                            self.limitInstruction(backSelectionId, 'BACK', backStake, backPrice, 'PERSIST')], customerRef)
 
-    def placeLayTheOverPair(self, marketId, laySelectionId, layStake, layPrice, backSelectionId, backStake, backPrice):
+    def placeOrder(self, marketId, selectionId, side, stake, price, customerRef=None):
+        customerRef = customerRef or str(uuid.uuid4().hex)
+        log.info('PLACE_ORDER', marketId=marketId, selectionId=selectionId, side=side,
+                 customerRef=customerRef)
 
-        try:
-            customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrder for marketId :' + marketId +
-                  ' with lay selection id :' + str(backSelectionId) +
-                  ' with customerRef :' + customerRef)
-
-            place_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/placeOrders","params":{"marketId":"%s","instructions":[{"selectionId":"%s","handicap":"0","side":"LAY","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"LAPSE","timeInForce":"FILL_OR_KILL"}},{"selectionId":"%s","handicap":"0","side":"BACK","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"PERSIST"}}], "customerRef":"%s"},"id":1}' % (
-                str(marketId), str(laySelectionId), str(layStake), str(layPrice), str(backSelectionId), str(backStake), str(backPrice), customerRef)
-
-            print(place_order_Req)
-
-            place_order_Response = self.callBettingAping(place_order_Req)
-            #place_order_Response = None
-
-            place_order_load = json.loads(place_order_Response)
-
-            # uncomment
-            place_order_result = place_order_load['result']
-            print('Place order status is ' + place_order_result['status'])
-
-            if place_order_result['status'] != 'SUCCESS':
-                print(place_order_result, end='\n\n')
-                return False
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(place_order_result['error']))
-            """
-            print(place_order_Response)
-            """
-            return False
+        return self.submitOrders(marketId, [self.limitInstruction(selectionId, side, stake, price, 'PERSIST')], customerRef)
 
-        return True
+    def placeFOKOrder(self, marketId, selectionId, side, stake, price, customerRef=None):
+        customerRef = customerRef or str(uuid.uuid4().hex)
+        log.info('PLACE_ORDER', marketId=marketId, selectionId=selectionId, side=side,
+                 customerRef=customerRef)
 
-    def placeOrder(self, marketId, selectionId, side, stake, price):
+        return self.submitOrders(marketId, [self.limitInstruction(selectionId, side, stake, price, 'LAPSE', 'FILL_OR_KILL')], customerRef)
 
-        try:
-            customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrder for marketId :' + marketId +
-                  ' with selection id :' + str(selectionId) +
-                  ' side :' + str(side) +
-                  ' with customerRef :' + customerRef)
-
-            place_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/placeOrders","params":{"marketId":"%s","instructions":[{"selectionId":"%s","handicap":"0","side":"%s","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"PERSIST"}}], "customerRef":"%s"},"id":1}' % (
-                str(marketId), str(selectionId), side, str(stake), str(price), customerRef)
-
-            print(place_order_Req)
-
-            place_order_Response = self.callBettingAping(place_order_Req)
-            #place_order_Response = None
-
-            place_order_load = json.loads(place_order_Response)
-
-            # uncomment
-            place_order_result = place_order_load['result']
-            print('Place order status is ' + place_order_result['status'])
-
-            if place_order_result['status'] != 'SUCCESS':
-                print(place_order_result, end='\n\n')
-                return False
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(place_order_result['error']))
-            """
-            print(place_order_Response)
-            """
-            return False
+    # self.betfair.placeOrderByPayout(marketId, selectionId, side, targetPayout)
+    def placeOrderByPayout(self, marketId, selectionId, side, price, targetPayout):
+        customerRef = str(uuid.uuid4().hex)
+        log.info('PLACE_ORDER_BY_PAYOUT', marketId=marketId, selectionId=selectionId, side=side,
+                 customerRef=customerRef)
 
-        return True
+        instruction = {'selectionId': selectionId, 'handicap': 0, 'side': side, 'orderType': 'LIMIT',
+                       'limitOrder': {'price': price, 'betTargetType': 'PAYOUT', 'betTargetSize': targetPayout}}
+        return self.submitOrders(marketId, [instruction], customerRef)
 
-    def placeFOKOrder(self, marketId, selectionId, side, stake, price):
+    def limitInstruction(self, selectionId, side, size, price, persistenceType, timeInForce=None):
+        limitOrder = {'size': size, 'price': price,
+                      'persistenceType': persistenceType}
+        if timeInForce is not None:
+            limitOrder['timeInForce'] = timeInForce
+        return {'selectionId': selectionId, 'handicap': 0, 'side': side, 'orderType': 'LIMIT', 'limitOrder': limitOrder}
+
+    def submitOrders(self, marketId, instructions, customerRef):
+        # customerRef (32 hex chars) rides on each order so cleared orders can be joined back to it
+        for instruction in instructions:
+            instruction.setdefault('customerOrderRef', customerRef)
 
         try:
-            customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrder for marketId :' + marketId +
-                  ' with selection id :' + str(selectionId) +
-                  ' side :' + str(side) +
-                  ' with customerRef :' + customerRef)
-
-            place_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/placeOrders","params":{"marketId":"%s","instructions":[{"selectionId":"%s","handicap":"0","side":"%s","orderType":"LIMIT","limitOrder":{"size":"%s","price":"%s","persistenceType":"LAPSE","timeInForce":"FILL_OR_KILL"}}], "customerRef":"%s"},"id":1}' % (
-                str(marketId), str(selectionId), side, str(stake), str(price), customerRef)
-
-            print(place_order_Req)
-
-            place_order_Response = self.callBettingAping(place_order_Req)
-            #place_order_Response = None
-
-            place_order_load = json.loads(place_order_Response)
-
-            # uncomment
-            place_order_result = place_order_load['result']
-            print('Place order status is ' + place_order_result['status'])
-
-            if place_order_result['status'] != 'SUCCESS':
-                print(place_order_result, end='\n\n')
-                return False
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(place_order_result['error']))
-            """
-            print(place_order_Response)
-            """
+            place_order_result = self.callBetting(
+                'placeOrders', {'marketId': marketId, 'instructions': instructions, 'customerRef': customerRef})
+        except APINGError as e:
+            self.logApingError(e)
             return False
 
-        return True
+        log.info('PLACE_ORDER_STATUS', marketId=marketId,
+                 status=place_order_result['status'], customerRef=customerRef)
 
-    # self.betfair.placeOrderByPayout(marketId, selectionId, side, targetPayout)
-    def placeOrderByPayout(self, marketId, selectionId, side, price, targetPayout):
-
-        try:
-            customerRef = str(uuid.uuid4().hex)
-            print('Calling placeOrderByPayout for marketId :' + marketId +
-                  ' with selection id :' + str(selectionId) +
-                  ' side :' + str(side) +
-                  ' with customerRef :' + customerRef)
-
-            place_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/placeOrders","params":{"marketId":"%s","instructions":[{"selectionId":"%s","handicap":"0","side":"%s","orderType":"LIMIT","limitOrder":{"price":"%s","betTargetType":"PAYOUT","betTargetSize":"%s"}}], "customerRef":"%s"},"id":1}' % (
-                str(marketId), str(selectionId), side, str(price), str(targetPayout), customerRef)
-
-            print(place_order_Req)
-
-            place_order_Response = self.callBettingAping(place_order_Req)
-            #place_order_Response = None
-
-            place_order_load = json.loads(place_order_Response)
-
-            # uncomment
-            place_order_result = place_order_load['result']
-            print('Place order status is ' + place_order_result['status'])
-
-            if place_order_result['status'] != 'SUCCESS':
-                print(place_order_result, end='\n\n')
-                return False
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(place_order_result['error']))
-            """
-            print(place_order_Response)
-            """
+        if place_order_result['status'] != 'SUCCESS':
+            log.warning('PLACE_ORDER_FAILED', marketId=marketId,
+                        result=place_order_result)
             return False
 
         return True
 
     def cancelOrders(self, marketId):
+        customerRef = str(uuid.uuid4().hex)
+        log.info('CANCEL_ORDERS', marketId=marketId,
+                 customerRef=customerRef)
 
         try:
-            customerRef = str(uuid.uuid4().hex)
-            print('cancelaceOrders for marketId :' + marketId +
-                  ' with customerRef :' + customerRef)
-
-            cancel_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/cancelOrders","params":{"marketId":"%s", "customerRef":"%s"},"id":1}' % (
-                str(marketId), customerRef)
-
-            print(cancel_order_Req)
-
-            cancel_order_Response = self.callBettingAping(cancel_order_Req)
-            #place_order_Response = None
-
-            cancel_order_load = json.loads(cancel_order_Response)
-
-            # uncomment
-            cancel_order_result = cancel_order_load['result']
-            print('Cancel order status is ' + cancel_order_result['status'])
+            cancel_order_result = self.callBetting(
+                'cancelOrders', {'marketId': marketId, 'customerRef': customerRef})
+        except APINGError as e:
+            self.logApingError(e)
+            return False
 
-            if cancel_order_result['status'] != 'SUCCESS':
-                print(cancel_order_result, end='\n\n')
-                return False
+        log.info('CANCEL_ORDERS_STATUS', marketId=marketId,
+                 status=cancel_order_result['status'], customerRef=customerRef)
 
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(cancel_order_result['error']))
-            """
-            print(place_order_Response)
-            """
+        if cancel_order_result['status'] != 'SUCCESS':
+            log.warning('CANCEL_ORDERS_FAILED', marketId=marketId,
+                        result=cancel_order_result)
             return False
 
         return True
 
     def replaceOrder(self, marketId, betId, newPrice):
         customerRef = str(uuid.uuid4().hex)
-        print('Calling replaceOrder for betId :' + betId +
-              ' on marketId : ' + marketId +
-              ' with newPrice :' + str(newPrice) +
-              ' customerRef : ' + customerRef)
+        log.info('REPLACE_ORDER', marketId=marketId, betId=betId,
+                 newPrice=newPrice, customerRef=customerRef)
 
-        replace_order_Req = '{"jsonrpc":"2.0","method":"SportsAPING/v1.0/replaceOrders","params":{"marketId":"%s","instructions":[{"betId":"%s","newPrice":"%s"}], "customerRef":"%s"},"id":1}' % (
-            str(marketId), str(betId), str(newPrice), customerRef)
+        try:
+            replace_order_result = self.callBetting('replaceOrders', {'marketId': marketId, 'instructions': [{'betId': betId, 'newPrice': newPrice}],
+                                                                      'customerRef': customerRef})
+        except APINGError as e:
+            self.logApingError(e)
+            return False
 
-        print(replace_order_Req)
+        log.info('REPLACE_ORDER_STATUS', marketId=marketId,
+                 status=replace_order_result['status'], customerRef=customerRef)
 
-        replace_order_Response = self.callBettingAping(replace_order_Req)
-        #place_order_Response = None
+        if replace_order_result['status'] != 'SUCCESS':
+            log.warning('REPLACE_ORDER_FAILED', marketId=marketId,
+                        result=replace_order_result)
+            return False
 
-        replace_order_load = json.loads(replace_order_Response)
-        try:
-            # uncomment
-            replace_order_result = replace_order_load['result']
-            print('RePlace order status is ' + replace_order_result['status'])
-
-            if replace_order_result['status'] != 'SUCCESS':
-                print(replace_order_result, end='\n\n')
-
-            """
-            print('Place order error status is ' + place_order_result['errorCode'])
-            print('Reason for Place order failure is ' +
-                place_order_result['instructionReports'][0]['errorCode'])
-            """
-        except:
-            print('Exception from API-NG' + str(replace_order_result['error']))
-            """
-            print(place_order_Response)
-            """
+        return True
 
     def getAccountFunds(self):
-        #[{"jsonrpc": "2.0", "method": "AccountAPING/v1.0/getAccountFunds", "params": {"wallet":"UK"}, "id": 1}]
         try:
-            account_funds_req = '{"jsonrpc": "2.0", "method": "AccountAPING/v1.0/getAccountFunds", "params": {"wallet":"UK"}, "id": 1}'
-            """
-            print(account_funds_req)
-            """
-            account_funds_response = self.callAccountAping(account_funds_req)
-            """
-            print(account_funds_response)
-            """
-            account_funds_loads = json.loads(account_funds_response)
-
-            account_funds_result = account_funds_loads['result']
-
-            return account_funds_result
-        except:
-            print('Exception from Account API-NG' +
-                  str(account_funds_result['error']))
+            return self.callAccount('getAccountFunds', {'wallet': 'UK'}, decodeAccountFunds)
+        except APINGError as e:
+            self.logApingError(e, 'ACCOUNT_APING_EXCEPTION')
             # exit()
             return None
 
     def getMarketCatalogueForMatch(self, eventTypeID, eventDateTime, filter):
         if (eventTypeID is not None):
-            #print('Calling listMarketCatalouge Operation to get MarketID and selectionId')
-            now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-
-            market_catalogue_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listMarketCatalogue", "params": {"filter":{"eventTypeIds":["' + eventTypeID + '"],"textQuery":"' + filter + '",'\
-                '"marketStartTime":{"from":"' + now + '","to":"' + eventDateTime + \
-                '"}},"sort":"FIRST_TO_START","maxResults":"1000", "marketProjection":["RUNNER_METADATA"]}, "id": 1}'
-            """
-            print(market_catalogue_req)
-            """
-            market_catalogue_response = self.callBettingAping(
-                market_catalogue_req)
-            """
-            print(market_catalogue_response)
-            """
-            market_catalouge_loads = json.loads(market_catalogue_response)
-            try:
-                market_catalouge_results = market_catalouge_loads['result']
-                return market_catalouge_results
-            except:
-                print('Exception from API-NG' +
-                      str(market_catalouge_results['error']))
-                # exit()
-                return None
-
-    def getMarketCatalogueForEvent(self, eventTypeID, eventId, turnInPlayEnabled):
+            return self.collect(self.streamMarketCatalogueForMatch(eventTypeID, eventDateTime, filter))
+
+    def streamMarketCatalogueForMatch(self, eventTypeID, eventDateTime, filter, predicate=None):
+        #print('Calling listMarketCatalouge Operation to get MarketID and selectionId')
+        now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        return self.streamBetting('listMarketCatalogue', {'filter': {'eventTypeIds': [eventTypeID], 'textQuery': filter,
+                                                                     'marketStartTime': {'from': now, 'to': eventDateTime}},
+                                                          'sort': 'FIRST_TO_START', 'maxResults': 1000, 'marketProjection': ['RUNNER_METADATA']},
+                                  MarketCatalogue.fromResult, predicate=predicate)
+
+    def getMarketCatalogueForEvent(self, eventTypeID, eventId, turnInPlayEnabled, predicate=None):
         if (eventTypeID is not None):
-            #print('Calling listMarketCatalouge Operation to get MarketID and selectionId')
-
-            market_catalogue_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listMarketCatalogue", "params": {"filter":{"eventTypeIds":["' + eventTypeID + \
-                '"],"eventIds":["' + eventId + \
-                '"], "turnInPlayEnabled":"true"},"sort":"FIRST_TO_START","maxResults":"1000", "marketProjection":["RUNNER_METADATA"]}, "id": 1}'
-            """
-            print(market_catalogue_req)
-            """
-            market_catalogue_response = self.callBettingAping(
-                market_catalogue_req)
-            """
-            print(market_catalogue_response)
-            """
-            market_catalouge_loads = json.loads(market_catalogue_response)
-            try:
-                market_catalouge_results = market_catalouge_loads['result']
-                return market_catalouge_results
-            except:
-                print('Exception from API-NG' +
-                      str(market_catalouge_results['error']))
-                # exit()
-                return None
-
-    def listCurrentOrders(self, marketId=None):
+            return self.collect(self.streamMarketCatalogueForEvent(eventTypeID, eventId, turnInPlayEnabled, predicate))
+
+    def streamMarketCatalogueForEvent(self, eventTypeID, eventId, turnInPlayEnabled, predicate=None):
+        #print('Calling listMarketCatalouge Operation to get MarketID and selectionId')
+        return self.streamBetting('listMarketCatalogue', {'filter': {'eventTypeIds': [eventTypeID], 'eventIds': [eventId], 'turnInPlayEnabled': True},
+                                                          'sort': 'FIRST_TO_START', 'maxResults': 1000, 'marketProjection': ['RUNNER_METADATA', 'COMPETITION']},
+                                  MarketCatalogue.fromResult, predicate=predicate)
+
+    def streamMarketCatalogueInWindow(self, eventTypeID, fromDateTime, toDateTime, predicate=None):
+        return self.streamBetting('listMarketCatalogue', {'filter': {'eventTypeIds': [eventTypeID], 'marketStartTime': {'from': fromDateTime, 'to': toDateTime}},
+                                                          'sort': 'FIRST_TO_START', 'maxResults': 1000},
+                                  MarketCatalogue.fromResult, predicate=predicate)
+
+    def listCurrentOrders(self, marketId=None, marketIds=None):
         #print('Calling listCurrentOrders')
+        if marketId is not None:
+            marketIds = [marketId]
+
+        params = {'orderProjection': 'ALL', 'dateRange': {}}
+        if marketIds is not None:
+            params['marketIds'] = marketIds
 
+        # per tick queries are small - one whole body decode beats streaming them
         try:
-            if marketId is None:
-                current_orders_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listCurrentOrders", "params": {"orderProjection":"ALL","dateRange":{}}, "id": 1}'
-            else:
-                current_orders_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listCurrentOrders", "params": {"marketIds":["' + \
-                    marketId + '"],"orderProjection":"ALL","dateRange":{}}, "id": 1}'
-
-            current_orders_response = self.callBettingAping(current_orders_req)
-            """
-            print(current_orders_response)
-            """
-            current_orders_loads = json.loads(current_orders_response)
-
-            current_orders_results = current_orders_loads['result']
-            return current_orders_results
-        except:
-            print('Exception from API-NG' +
-                  str(current_orders_results['error']))
+            return self.callBetting('listCurrentOrders', params, decodeCurrentOrders)
+        except APINGError as e:
+            self.logApingError(e)
             # exit()
             return None
 
-    def listEvents(self, eventTypeID, eventDateTime):
-        #event_type_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listEvents", "params": {"filter":{ }}, "id": 1}'
+    def streamCurrentOrders(self, marketIds=None, predicate=None):
+        # account wide queries can return thousands of orders
+        params = {'orderProjection': 'ALL', 'dateRange': {}}
+        if marketIds is not None:
+            params['marketIds'] = marketIds
+
+        return self.streamBetting('listCurrentOrders', params, CurrentOrder.fromResult, 'currentOrders', predicate)
+
+    def listClearedOrders(self, fromDateTime, toDateTime, fromRecord=0, recordCount=1000, betStatus='SETTLED'):
+        # one page of settled orders: (orders, moreAvailable), raises APINGError
+        return self.callBetting('listClearedOrders', {'betStatus': betStatus, 'settledDateRange': {'from': fromDateTime, 'to': toDateTime},
+                                                      'includeItemDescription': True, 'fromRecord': fromRecord, 'recordCount': recordCount},
+                                decodeClearedOrders)
+
+    def iterClearedOrders(self, fromDateTime, toDateTime, recordCount=1000, betStatus='SETTLED'):
+        # pages through the whole range, recordCount orders per call
+        fromRecord = 0
+        while True:
+            orders, moreAvailable = self.listClearedOrders(
+                fromDateTime, toDateTime, fromRecord, recordCount, betStatus)
+            yield from orders
+            if not moreAvailable or not orders:
+                return
+            fromRecord = fromRecord + len(orders)
+
+    def listEvents(self, eventTypeID, eventDateTime, fromDateTime=None):
+        if fromDateTime is None:
+            fromDateTime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+
         try:
-            now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-            listEvents_req = '{"jsonrpc": "2.0", "method": "SportsAPING/v1.0/listEvents", "params": {"filter":{"eventTypeIds":["' + \
-                eventTypeID + '"],''"marketStartTime":{"from":"' + now + \
-                '","to":"' + eventDateTime + '"}},"maxResults":"1000"}, "id": 1}'
-
-            listEventsResponse = self.callBettingAping(listEvents_req)
-            eventLoads = json.loads(listEventsResponse)
-
-            eventResults = eventLoads['result']
-            return eventResults
-        except:
-            print('Exception from API-NG' + str(eventLoads['error']))
+            return self.callBetting('listEvents', {'filter': {'eventTypeIds': [eventTypeID], 'marketStartTime': {'from': fromDateTime, 'to': eventDateTime}},
+                                                   'maxResults': 1000})
+        except APINGError as e:
+            self.logApingError(e)
             # exit()
             return None
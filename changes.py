@@ -0,0 +1,101 @@
+import time
+
+from metrics import metrics
+
+KINDS = ('book', 'orders')
+
+# ----------------------------------
+# FINGERPRINTS
+# ----------------------------------
+
+
+def bookFingerprint(marketBook, selectionId):
+    # what an entry decision reads from a book: market state and the selection's best prices
+    if marketBook is None:
+        return None
+    fingerprint = []
+    for book in marketBook:
+        fingerprint.append((book.status, book.inplay, book.version))
+        for runner in book.runners:
+            if runner.selectionId == selectionId:
+                fingerprint.append((runner.status, runner.availableToBack[0] if runner.availableToBack else None,
+                                    runner.availableToLay[0] if runner.availableToLay else None))
+    return tuple(fingerprint)
+
+
+def ordersFingerprint(orders):
+    # what a trading decision reads from a market's orders: their sides, prices and fills
+    # (in the order listed - a reordering only costs one extra evaluation)
+    return tuple([(order.betId, order.side, order.price, order.sizeMatched, order.sizeRemaining)
+                  for order in orders])
+
+# ----------------------------------
+# CHANGE DETECTOR
+# ----------------------------------
+
+
+class ChangeDetector:
+    '''
+    Remembers the fingerprint each market was last evaluated on, per kind of
+    input ('book', 'orders'), so the strategy only re-runs a decision when its
+    input changed materially. changed() is True, and records the fingerprint,
+    for a new market or a different fingerprint; a decision that failed part way
+    (an API error) calls invalidate() so the next tick evaluates again. Timers
+    are the caller's: due=True (a stop loss being stepped) always evaluates.
+
+    flush() exports the fraction of evaluations skipped since the previous
+    flush, once per tick. With enabled False every evaluation runs.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.fingerprints = {}
+        self.seenAt = {}
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def changed(self, marketId, kind, fingerprint, due=False, now=None):
+        key = (marketId, kind)
+        # re-inserted so seenAt stays least recently seen first
+        self.seenAt.pop(key, None)
+        self.seenAt[key] = time.time() if now is None else now
+        if self.enabled and not due and key in self.fingerprints and self.fingerprints[key] == fingerprint:
+            self.count(kind, 'skipped')
+            return False
+
+        self.fingerprints[key] = fingerprint
+        self.count(kind, 'evaluated')
+        return True
+
+    def count(self, kind, result):
+        # exported by flush() so the per market path stays off the metrics lock
+        self.counts[(kind, result)] = self.counts.get((kind, result), 0) + 1
+
+    def invalidate(self, marketId, kinds=KINDS):
+        for kind in kinds:
+            self.fingerprints.pop((marketId, kind), None)
+            self.seenAt.pop((marketId, kind), None)
+
+    def expire(self, before):
+        # markets not seen since before (kicked off without entry), oldest first
+        while self.seenAt:
+            key, seenAt = next(iter(self.seenAt.items()))
+            if seenAt >= before:
+                return
+            del self.seenAt[key]
+            self.fingerprints.pop(key, None)
+
+    def flush(self):
+        skipped = 0
+        total = 0
+        for (kind, result), count in self.counts.items():
+            metrics.inc('change_evaluations_total',
+                        (('kind', kind), ('result', result)), count)
+            total = total + count
+            if result == 'skipped':
+                skipped = skipped + count
+        if total:
+            metrics.set('change_skip_fraction', round(skipped / total, 4))
+        self.counts = {}
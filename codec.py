@@ -0,0 +1,335 @@
+import codecs
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ----------------------------------
+# BACKEND
+# ----------------------------------
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    BACKEND = 'json'
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+# ----------------------------------
+# ERRORS
+# ----------------------------------
+
+
+class APINGError(Exception):
+    '''
+    An API-NG call that did not produce a result: a JSON-RPC error (for example
+    APINGException INVALID_SESSION_INFORMATION), an undecodable body or a transport
+    failure (errorCode UNAVAILABLE).
+    '''
+
+    def __init__(self, operation, errorCode, exceptionName=None, errorDetails=None, requestUUID=None):
+        Exception.__init__(self, '%s: %s' % (operation, errorCode))
+        self.operation = operation
+        self.errorCode = errorCode
+        self.exceptionName = exceptionName
+        self.errorDetails = errorDetails
+        self.requestUUID = requestUUID
+
+    @classmethod
+    def fromError(cls, operation, error):
+        data = error.get('data') or {}
+        exceptionName = data.get('exceptionname')
+        exception = data.get(exceptionName) or {}
+        return cls(operation, exception.get('errorCode', str(error.get('code'))), exceptionName,
+                   exception.get('errorDetails', error.get('message')), exception.get('requestUUID'))
+
+    def fields(self):
+        return {'operation': self.operation, 'errorCode': self.errorCode, 'exceptionName': self.exceptionName,
+                'errorDetails': self.errorDetails, 'requestUUID': self.requestUUID}
+
+# ----------------------------------
+# RECORDS
+# ----------------------------------
+
+
+class Runner:
+    __slots__ = ('selectionId', 'runnerName', 'sortPriority')
+
+    def __init__(self, selectionId, runnerName, sortPriority=None):
+        self.selectionId = selectionId
+        self.runnerName = runnerName
+        self.sortPriority = sortPriority
+
+
+class MarketCatalogue:
+    __slots__ = ('marketId', 'marketName', 'marketStartTime', 'totalMatched',
+                 'competitionId', 'competitionName', 'runners')
+
+    def __init__(self, marketId, marketName, marketStartTime=None, totalMatched=0.0, competitionId=None, competitionName=None, runners=()):
+        self.marketId = marketId
+        self.marketName = marketName
+        self.marketStartTime = marketStartTime
+        self.totalMatched = totalMatched
+        self.competitionId = competitionId
+        self.competitionName = competitionName
+        self.runners = list(runners)
+
+    @classmethod
+    def fromResult(cls, market):
+        competition = market.get('competition') or {}
+        return cls(market['marketId'], market['marketName'], market.get('marketStartTime'), market.get('totalMatched', 0.0),
+                   competition.get('id'), competition.get('name'),
+                   [Runner(runner['selectionId'], runner.get('runnerName'), runner.get('sortPriority')) for runner in market.get('runners', ())])
+
+    def toResult(self):
+        # the inverse of fromResult, for the warm start snapshot
+        return {'marketId': self.marketId, 'marketName': self.marketName, 'marketStartTime': self.marketStartTime,
+                'totalMatched': self.totalMatched, 'competition': {'id': self.competitionId, 'name': self.competitionName},
+                'runners': [{'selectionId': runner.selectionId, 'runnerName': runner.runnerName, 'sortPriority': runner.sortPriority}
+                            for runner in self.runners]}
+
+    def __repr__(self):
+        return 'MarketCatalogue(%s, %s)' % (self.marketId, self.marketName)
+
+
+class RunnerBook:
+    # availableToBack / availableToLay are best first lists of (price, size)
+    __slots__ = ('selectionId', 'status', 'lastPriceTraded',
+                 'availableToBack', 'availableToLay', 'totalMatched')
+
+    def __init__(self, selectionId, status, lastPriceTraded=None, availableToBack=(), availableToLay=(), totalMatched=0.0):
+        self.selectionId = selectionId
+        self.status = status
+        self.lastPriceTraded = lastPriceTraded
+        self.availableToBack = list(availableToBack)
+        self.availableToLay = list(availableToLay)
+        self.totalMatched = totalMatched
+
+
+class MarketBook:
+    __slots__ = ('marketId', 'status', 'inplay',
+                 'version', 'totalMatched', 'runners')
+
+    def __init__(self, marketId, status, inplay=False, version=None, totalMatched=0.0, runners=()):
+        self.marketId = marketId
+        self.status = status
+        self.inplay = inplay
+        self.version = version
+        self.totalMatched = totalMatched
+        self.runners = list(runners)
+
+    @classmethod
+    def fromResult(cls, book):
+        runners = []
+        for runner in book.get('runners', ()):
+            ex = runner.get('ex') or {}
+            runners.append(RunnerBook(runner['selectionId'], runner.get('status'), runner.get('lastPriceTraded'),
+                                      [(offer['price'], offer['size']) for offer in ex.get('availableToBack', ())],
+                                      [(offer['price'], offer['size']) for offer in ex.get('availableToLay', ())],
+                                      runner.get('totalMatched', 0.0)))
+        return cls(book['marketId'], book.get('status'), book.get('inplay', False), book.get('version'),
+                   book.get('totalMatched', 0.0), runners)
+
+    def __repr__(self):
+        return 'MarketBook(%s, %s)' % (self.marketId, self.status)
+
+
+class CurrentOrder:
+    __slots__ = ('betId', 'marketId', 'selectionId', 'side', 'status', 'price', 'size',
+                 'sizeMatched', 'sizeRemaining', 'averagePriceMatched', 'placedDate', 'customerOrderRef')
+
+    def __init__(self, betId, marketId, selectionId, side, status, price, size, sizeMatched=0.0, sizeRemaining=0.0, averagePriceMatched=0.0, placedDate=None,
+                 customerOrderRef=None):
+        self.betId = betId
+        self.marketId = marketId
+        self.selectionId = selectionId
+        self.side = side
+        self.status = status
+        self.price = price
+        self.size = size
+        self.sizeMatched = sizeMatched
+        self.sizeRemaining = sizeRemaining
+        self.averagePriceMatched = averagePriceMatched
+        self.placedDate = placedDate
+        self.customerOrderRef = customerOrderRef
+
+    @classmethod
+    def fromResult(cls, order):
+        priceSize = order['priceSize']
+        return cls(order['betId'], order['marketId'], order['selectionId'], order['side'], order['status'],
+                   priceSize['price'], priceSize['size'], order.get('sizeMatched', 0.0), order.get('sizeRemaining', 0.0),
+                   order.get('averagePriceMatched', 0.0), order.get('placedDate'), order.get('customerOrderRef'))
+
+    def __repr__(self):
+        return 'CurrentOrder(%s, %s %s@%s)' % (self.betId, self.side, self.size, self.price)
+
+
+class ClearedOrder:
+    # itemDescription fields are flattened (requested with includeItemDescription)
+    __slots__ = ('betId', 'marketId', 'selectionId', 'eventId', 'eventTypeId', 'side', 'orderType', 'persistenceType',
+                 'betOutcome', 'priceRequested', 'priceMatched', 'sizeSettled', 'sizeCancelled', 'profit', 'commission',
+                 'placedDate', 'lastMatchedDate', 'settledDate', 'customerOrderRef', 'customerStrategyRef',
+                 'eventDesc', 'marketDesc', 'marketType', 'marketStartTime', 'runnerDesc')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def fromResult(cls, order):
+        fields = dict(order)
+        fields.update(order.get('itemDescription') or {})
+        return cls(**fields)
+
+    def __repr__(self):
+        return 'ClearedOrder(%s, %s %s %s)' % (self.betId, self.side, self.betOutcome, self.profit)
+
+
+class AccountFunds:
+    __slots__ = ('availableToBetBalance', 'exposure',
+                 'retainedCommission', 'exposureLimit', 'wallet')
+
+    def __init__(self, availableToBetBalance, exposure, retainedCommission=0.0, exposureLimit=None, wallet=None):
+        self.availableToBetBalance = availableToBetBalance
+        self.exposure = exposure
+        self.retainedCommission = retainedCommission
+        self.exposureLimit = exposureLimit
+        self.wallet = wallet
+
+    @classmethod
+    def fromResult(cls, funds):
+        return cls(funds['availableToBetBalance'], funds['exposure'], funds.get('retainedCommission', 0.0),
+                   funds.get('exposureLimit'), funds.get('wallet'))
+
+# ----------------------------------
+# CODEC
+# ----------------------------------
+
+
+def encodeRequest(method, params, requestId=1):
+    # parameters are serialised, never concatenated, so quotes in textQuery etc. are escaped
+    return dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': requestId})
+
+
+def decodeResult(operation, body):
+    try:
+        response = loads(body)
+    except ValueError as e:
+        raise APINGError(operation, 'INVALID_RESPONSE', errorDetails=str(e))
+
+    if 'error' in response:
+        raise APINGError.fromError(operation, response['error'])
+    if 'result' not in response:
+        raise APINGError(operation, 'NO_RESULT')
+    return response['result']
+
+
+ARRAY_SEPARATORS = re.compile(r'[\s,]*')
+ITEM_DECODER = json.JSONDecoder()
+
+
+def iterResultItems(operation, chunks, arrayKey=None):
+    '''
+    Yields the items of the result array (or of result[arrayKey]) one at a time
+    while the body is still arriving as byte chunks, so only the current chunk and
+    the item being parsed are held in memory. An item split across chunks fails
+    raw_decode and is retried once the text buffered for it has doubled, so an
+    item spanning k chunks is parsed O(log k) times rather than k. A body without
+    the array (e.g. a JSON-RPC error) is decoded in full so APINGError is raised.
+    '''
+    arrayStart = re.compile(r'"%s"\s*:\s*\[' % (arrayKey or 'result'))
+    textDecoder = codecs.getincrementaldecoder('utf-8')()
+    parts = []
+    buffered = 0
+    retryAt = 0
+    index = None
+
+    for chunk in chunks:
+        text = textDecoder.decode(chunk)
+        parts.append(text)
+        buffered = buffered + len(text)
+        if buffered < retryAt:
+            continue
+        buffer = ''.join(parts)
+
+        if index is None:
+            match = arrayStart.search(buffer)
+            if match is None:
+                parts = [buffer]
+                continue
+            index = match.end()
+
+        index, closed = yield from decodeItems(buffer, index)
+        if closed:
+            return
+        parts = [buffer[index:]]
+        buffered = len(parts[0])
+        retryAt = 2 * buffered
+        index = 0
+
+    buffer = ''.join(parts) + textDecoder.decode(b'', True)
+    if index is None:
+        decodeResult(operation, buffer)
+        raise APINGError(operation, 'NO_RESULT')
+
+    index, closed = yield from decodeItems(buffer, index)
+    if closed:
+        return
+    raise APINGError(operation, 'INVALID_RESPONSE',
+                     errorDetails='truncated result array')
+
+
+def decodeItems(buffer, index):
+    # yields the complete items from index on, returns (where the rest starts, whether the array closed)
+    rawDecode = ITEM_DECODER.raw_decode
+    skipSeparators = ARRAY_SEPARATORS.match
+    while True:
+        index = skipSeparators(buffer, index).end()
+        if index >= len(buffer):
+            return index, False
+        if buffer[index] == ']':
+            return index, True
+        try:
+            item, index = rawDecode(buffer, index)
+        except ValueError:
+            # item continues in the next chunk
+            return index, False
+        yield item
+
+
+def decodeMarketCatalogues(result):
+    fromResult = MarketCatalogue.fromResult
+    return [fromResult(market) for market in result]
+
+
+def decodeMarketBooks(result):
+    fromResult = MarketBook.fromResult
+    return [fromResult(book) for book in result]
+
+
+def decodeCurrentOrders(result):
+    fromResult = CurrentOrder.fromResult
+    return [fromResult(order) for order in result['currentOrders']]
+
+
+def decodeClearedOrders(result):
+    # one page: (orders, moreAvailable)
+    fromResult = ClearedOrder.fromResult
+    return [fromResult(order) for order in result.get('clearedOrders', ())], result.get('moreAvailable', False)
+
+
+def decodeAccountFunds(result):
+    return AccountFunds.fromResult(result)
@@ -1,12 +1,48 @@
+import concurrent.futures
 import datetime
-import requests
+import functools
 import os
+import threading
+import time
+import uuid
 
-from apscheduler.schedulers.blocking import BlockingScheduler
+# process start, before the module imports, for the time to first hedge check
+STARTED_AT = time.monotonic()
 
 from betfair import BetfairSettings
 from betfair import Betfair
 
+from eventlog import log
+from metrics import metrics
+from tracing import tracer
+from tracing import ProfilerSwitch
+
+from journal import PositionJournal
+from journal import OPENED, BACK_MATCHED, HEDGE_PLACED, REPRICED, CLOSED
+
+from position import Position
+from position import PositionRegistry
+from position import PENDING_BACK, BACKED, HEDGE_WORKING, STOP_LOSS_STEPPING
+
+from codec import APINGError
+from codec import MarketCatalogue
+
+from eventcalendar import EventCalendar
+from exclusions import ExclusionRules
+from ledger import FundsLedger
+from pricehistory import PriceHistory
+from executor import TickExecutor
+from hedging import HedgedReads
+from resilience import Resilience
+from resilience import CircuitOpenError
+from snapshot import StateSnapshot
+from memdiag import MemoryDiagnostics
+from changes import ChangeDetector
+from changes import bookFingerprint
+from changes import ordersFingerprint
+from exitengine import ExitEngine
+from exitengine import CANCEL, REPRICE, HEDGE, CLOSE
+
 # ----------------------------------
 # HELPER CLASSES
 # ----------------------------------
@@ -29,249 +65,767 @@ class StrategySettings:
         self.marketsToTrade = marketsToTrade
         self.excludedTeams = excludedTeams
 
+
+class StagedMarket:
+    # a market validated ahead of the placement window: only the price is left to fetch
+    __slots__ = ('eventDetails', 'market', 'selectionId',
+                 'stake', 'hedgeStake', 'stagedAt')
+
+    def __init__(self, eventDetails, market, selectionId, stake, hedgeStake, stagedAt):
+        self.eventDetails = eventDetails
+        self.market = market
+        self.selectionId = selectionId
+        self.stake = stake
+        self.hedgeStake = hedgeStake
+        self.stagedAt = stagedAt
+
+    def toState(self):
+        # plain JSON / pickle friendly form, for the snapshot and the shard coordinator
+        return {'eventDetails': self.eventDetails, 'market': self.market.toResult(), 'selectionId': self.selectionId,
+                'stake': self.stake, 'hedgeStake': self.hedgeStake, 'stagedAt': self.stagedAt}
+
+    @classmethod
+    def fromState(cls, state):
+        return cls(state['eventDetails'], MarketCatalogue.fromResult(state['market']), state['selectionId'],
+                   state['stake'], state['hedgeStake'], state['stagedAt'])
+
 # ----------------------------------
 # STRATEGY
 # ----------------------------------
 
 
 class OverUnderStrategy:
-    def __init__(self, strategySettings, betfairSettings):
+    def __init__(self, strategySettings, betfairSettings, journalPath='positions.journal', exclusionRulesPath='exclusions.json', betfairFactory=Betfair, fundsReconcileSeconds=60, tickBudgetSeconds=8.0, snapshotPath=None, startedAt=None, memoryTraceFrames=0):
         self.strategySettings = strategySettings
         self.betfairSettings = betfairSettings
 
         self.sessionTokenExpiresAt = datetime.datetime.now()
         self.sessionTokenValidForMinutes = 10
         self.backStake = 2.0
+        self.availableToBetBalance = None
+        self.exposure = None
         self.betfair = None
-        self.tradedMarketIds = []
+        self.betfairFactory = betfairFactory
+        self.positions = PositionRegistry()
+        self.maxMarketIdsPerOrderQuery = 250
+        # EX_BEST_OFFERS weighs 5 per market, 200 per request
+        self.maxMarketIdsPerBookQuery = 40
+        self.journal = PositionJournal(journalPath)
+        self.profilerSwitch = ProfilerSwitch()
+        self.eventCalendar = EventCalendar(
+            '1', self.strategySettings.eventLookAheadMinutes, self.strategySettings.placementThresholdMinutes)
+        self.exclusionRules = ExclusionRules(
+            self.strategySettings.excludedTeams, path=exclusionRulesPath)
+        self.ledger = FundsLedger(
+            self.fetchAccountFunds, reconcileIntervalSeconds=fundsReconcileSeconds)
+        self.priceHistory = PriceHistory()
+        self.priceWindowSeconds = 60
+        self.priceHistoryIdleSeconds = 600
+        self.changes = ChangeDetector()
+        self.exitEngine = ExitEngine(
+            self.strategySettings.targetProfitPercent, self.applyOddsLadder)
+        self.exitPool = concurrent.futures.ThreadPoolExecutor(
+            16, thread_name_prefix='exit')
+        self.stagedEvents = {}
+        self.stagingLeadMinutes = 3
+        self.maxStagedEventsPerTick = 10
+        self.maxStagedEvents = 200
+        self.executor = TickExecutor(tickBudgetSeconds)
+        self.canEnter = False
+        self.snapshot = StateSnapshot(
+            snapshotPath) if snapshotPath is not None else None
+        self.startedAt = STARTED_AT if startedAt is None else startedAt
+        self.firstHedgeCheckSeconds = None
+        self.validationPending = False
+        self.validatedOrders = None
+        self.validationRetrySeconds = 5.0
+
+        # every long lived container, with its bound where it has a fixed one
+        self.memory = MemoryDiagnostics(traceFrames=memoryTraceFrames)
+        self.memory.track('positions', lambda: len(self.positions))
+        self.memory.track('stopLossDeadlines',
+                          lambda: len(self.positions.deadlines))
+        self.memory.track('eventCalendar', lambda: len(
+            self.eventCalendar.events), self.eventCalendar.maxEvents)
+        self.memory.track('stagedEvents', lambda: len(
+            self.stagedEvents), self.maxStagedEvents)
+        self.memory.track('priceHistory', lambda: len(
+            self.priceHistory.selections), self.priceHistory.maxSelections)
+        self.memory.track('ledgerMarkets', lambda: len(
+            self.ledger.marketOrders))
+        self.memory.track('changeFingerprints', lambda: len(self.changes))
+        self.memory.track('exitRows', lambda: len(self.exitEngine))
+
+        # warm start: trade from the snapshot and the journal, check them against the account in the background
+        state = self.snapshot.read() if self.snapshot is not None else None
+        self.warmStart = state is not None
+        if self.warmStart:
+            self.restoreSnapshot(state)
+            if self.sessionTokenExpiresAt < datetime.datetime.now():
+                self.refreshSessionToken()
+            self.betfair = self.betfairFactory(self.betfairSettings)
+            self.replayJournal()
+            self.startValidation()
+        else:
+            # init betfair
+            self.refreshSessionToken()
+            self.betfair = self.betfairFactory(self.betfairSettings)
 
-        # init betfair
-        self.refreshSessionToken()
-        self.betfair = Betfair(self.betfairSettings)
+            # bootstrap positions, then baseline the ledger against the account
+            self.bootstrapPositions()
+            self.ledger.reconcile()
 
-        # bootstrap tradedMarketIds
-        self.bootstrapTradedMarketIds()
+        # a warm start's first reconcile runs in the first tick, after positions seeded the ledger
+        self.ledger.start()
 
 # ----------------------------------
 # METHODS
 # ----------------------------------
-    def bootstrapTradedMarketIds(self):
+    def bootstrapPositions(self):
+        self.replayJournal()
+
+        # reconcile with a single account wide order query
+        ordersByMarketId = self.fetchAccountOrders(self.betfair)
+        if ordersByMarketId is not None:
+            self.applyAccountOrders(ordersByMarketId)
+
+    def replayJournal(self):
+        # replay journalled positions (incl. fully backed ones awaiting stop loss)
+        for record in self.journal.replay().values():
+            position = Position.fromRecord(record)
+            if position.placedAt is not None:
+                position.stopLossAt = self.stopLossDeadline(position.placedAt)
+            self.positions.add(position)
+
+    def fetchAccountOrders(self, betfair):
+        # every current order on the account, streamed order by order, None if the query failed
+        ordersByMarketId = {}
+        try:
+            for order in betfair.streamCurrentOrders():
+                ordersByMarketId.setdefault(order.marketId, []).append(order)
+        except APINGError as e:
+            betfair.logApingError(e)
+            return None
+        return ordersByMarketId
+
+    def applyAccountOrders(self, ordersByMarketId, marketIds=None):
+        '''
+        Reconciles positions with the account's orders. Only positions in marketIds
+        (all when None) may be closed for having no orders - a warm start checks
+        the positions known when its background query started, not those opened
+        since.
+        '''
+        for marketId, orders in ordersByMarketId.items():
+            # marketIds with unmatched bets placed outside of the journal
+            unmatched = [order for order in orders if order.sizeMatched == 0.0]
+            if unmatched and marketId not in self.positions:
+                self.positions.add(Position(marketId, unmatched[0].selectionId))
+                self.journalPosition(
+                    OPENED, marketId, selectionId=unmatched[0].selectionId, reconciled=True)
+
+        # journalled positions with no orders left have been settled or cancelled
+        for position in list(self.positions):
+            if position.marketId not in ordersByMarketId:
+                if marketIds is None or position.marketId in marketIds:
+                    self.closePosition(position.marketId, 'RECONCILED')
+            else:
+                self.ledger.updateMarket(
+                    position.marketId, ordersByMarketId[position.marketId])
+
+        # staged markets traded elsewhere are not entered
+        for eventId, stagedMarkets in self.stagedEvents.items():
+            self.stagedEvents[eventId] = [staged for staged in stagedMarkets
+                                          if staged.market.marketId not in ordersByMarketId]
+
+        self.journal.compact(
+            {position.marketId: position.toRecord() for position in self.positions})
+
+# ----------------------------------
+# WARM START
+# ----------------------------------
+    def startValidation(self):
+        self.validationPending = True
+        marketIds = set(self.positions.marketIds())
+        thread = threading.Thread(
+            target=self.validate, args=(marketIds,), name='validation', daemon=True)
+        thread.start()
+
+    def validate(self, marketIds):
+        # background thread with its own client; the result is applied on the next tick
+        betfair = self.betfairFactory(self.betfairSettings)
+        while True:
+            with metrics.time('startup_validation_seconds'):
+                ordersByMarketId = self.fetchAccountOrders(betfair)
+            if ordersByMarketId is not None:
+                self.validatedOrders = (ordersByMarketId, marketIds)
+                return
+            log.warning('VALIDATION_RETRY',
+                        retrySeconds=self.validationRetrySeconds)
+            time.sleep(self.validationRetrySeconds)
+
+    def applyValidation(self):
+        validatedOrders, self.validatedOrders = self.validatedOrders, None
+        ordersByMarketId, marketIds = validatedOrders
+        self.applyAccountOrders(ordersByMarketId, marketIds)
+        self.validationPending = False
+        log.info('VALIDATED', positions=len(self.positions),
+                 accountMarkets=len(ordersByMarketId))
+
+    def snapshotState(self):
+        stagedEvents = dict((eventId, [staged.toState() for staged in stagedMarkets])
+                            for eventId, stagedMarkets in self.stagedEvents.items())
+
+        return {'sessionToken': self.betfairSettings.sessionToken,
+                'sessionTokenExpiresAt': self.sessionTokenExpiresAt.isoformat(),
+                'eventCalendar': self.eventCalendar.toState(),
+                'stagedEvents': stagedEvents}
+
+    def restoreSnapshot(self, state):
+        '''
+        Session, fixtures and staged catalogue from the snapshot. Positions are
+        replayed from the journal instead, which is written on every lifecycle
+        event and so is never behind the snapshot's copy.
+        '''
+        if state['sessionToken'] is not None:
+            self.sessionToken = state['sessionToken']
+            self.sessionTokenExpiresAt = datetime.datetime.fromisoformat(
+                state['sessionTokenExpiresAt'])
+            self.betfairSettings.sessionToken = self.sessionToken
+            self.betfairSettings.updateHeaders()
 
-        currentOrders = self.betfair.listCurrentOrders()
+        self.eventCalendar.restore(state['eventCalendar'])
 
-        if currentOrders is None:
-            return
+        for eventId, stagedMarkets in state['stagedEvents'].items():
+            if self.eventCalendar.kickOff(eventId) is None:
+                continue
+            self.stagedEvents[eventId] = [StagedMarket.fromState(
+                staged) for staged in stagedMarkets]
+
+        log.info('WARM_START', events=len(self.eventCalendar),
+                 stagedEvents=len(self.stagedEvents), ageSeconds=round(time.time() - state['savedAt'], 1))
 
-        # marketIds with unmatched bets
-        for order in currentOrders['currentOrders']:
-            if order['sizeMatched'] == 0.0:
-                if order['marketId'] not in self.tradedMarketIds:
-                    self.tradedMarketIds.append(order['marketId'])
+    def writeSnapshot(self):
+        if self.snapshot is None:
+            return
+        with metrics.time('snapshot_write_seconds'):
+            self.snapshot.write(self.snapshotState())
 
     def iteration(self):
         startDate = datetime.datetime.now()
-        print('START: %s' % startDate)
+        log.debug('START')
 
-        # sessionToken expired?
-        if self.sessionTokenExpiresAt < datetime.datetime.now():
-            self.refreshSessionToken()
+        self.profilerSwitch.beforeTick()
 
-        # init betfair - handles initialiation of headers
-        self.betfair = Betfair(self.betfairSettings)
+        # disabled on this thread even when the tick raises
+        try:
+            with metrics.time('iteration_seconds'), tracer.span('iteration'):
+                self.iterationStages()
+        finally:
+            self.profilerSwitch.afterTick()
+        self.memory.afterTick()
+        self.changes.flush()
 
-        # account funds, back stake
-        accountFunds = self.betfair.getAccountFunds()
+        endDate = datetime.datetime.now()
+        delta = endDate - startDate
+        log.info('END', duration=round(delta.total_seconds(), 3),
+                 availableToBetBalance=self.availableToBetBalance, exposure=self.exposure)
+
+    def iterationStages(self):
 
-        if accountFunds is None:
+        # sessionToken expired?
+        with metrics.time('iteration_stage_seconds', (('stage', 'session'),)):
+            if self.sessionTokenExpiresAt < datetime.datetime.now():
+                self.refreshSessionToken()
+
+            # init betfair - handles initialiation of headers
+            self.betfair = self.betfairFactory(self.betfairSettings)
+
+        # open positions first, optional work is shed when the tick runs out of time
+        self.runTasks([('positions', self.managePositions), ('reconcile', self.reconcileFunds),
+                       ('entry', self.enterPositions), ('discovery', self.discoverEvents)])
+
+        with metrics.time('iteration_stage_seconds', (('stage', 'journal'),)):
+            self.journal.sync()
+
+        # price history and fingerprints of markets no longer polled (kicked off, not entered)
+        self.priceHistory.expire(time.time() - self.priceHistoryIdleSeconds)
+        self.changes.expire(time.time() - self.priceHistoryIdleSeconds)
+
+        if self.snapshot is not None and self.snapshot.due():
+            self.writeSnapshot()
+
+    def runTasks(self, tasks):
+        # requests made during the tick time out within what is left of its budget
+        resilience = self.betfairSettings.resilience
+        startedAt = self.executor.clock()
+        if resilience is not None:
+            resilience.startTick(startedAt + self.executor.budgetSeconds)
+        try:
+            return self.executor.run(tasks, startedAt)
+        finally:
+            if resilience is not None:
+                resilience.endTick()
+
+    def bettingAvailable(self):
+        # False while the betting endpoint's circuit is open - optional work waits rather than failing call by call
+        resilience = self.betfairSettings.resilience
+        return resilience is None or resilience.available('betting')
+
+    def managePositions(self, budget):
+        # a warm start's background account check, once it is in
+        if self.validatedOrders is not None:
+            self.applyValidation()
+
+        # trade existing positions - never shed
+        with metrics.time('iteration_stage_seconds', (('stage', 'positions'),)), tracer.span('tradeExistingMarketPositions', positions=len(self.positions)):
+            self.tradeExistingMarketPositions()
+
+        if self.firstHedgeCheckSeconds is None:
+            self.firstHedgeCheckSeconds = time.monotonic() - self.startedAt
+            metrics.set('startup_first_hedge_check_seconds',
+                        self.firstHedgeCheckSeconds)
+            log.info('FIRST_HEDGE_CHECK', seconds=round(self.firstHedgeCheckSeconds, 3),
+                     warmStart=self.warmStart, positions=len(self.positions))
+
+        for state, count in self.positions.counts().items():
+            metrics.set('positions_open', count, (('state', state),))
+
+    def reconcileFunds(self, budget):
+        # account funds from the ledger, reconciled in the background
+        self.canEnter = False
+        with metrics.time('iteration_stage_seconds', (('stage', 'funds'),)):
+            if self.ledger.availableToBetBalance is None:
+                self.ledger.reconcile()
+
+        if self.ledger.availableToBetBalance is None:
+            metrics.inc('iteration_aborted_total', (('reason', 'funds'),))
             return
 
-        availableToBetBalance = accountFunds['availableToBetBalance']
-        exposure = accountFunds['exposure']
+        self.availableToBetBalance = self.ledger.availableToBetBalance
+        self.exposure = self.ledger.exposure
 
         # determine backStake
-        self.backStake = round(float(availableToBetBalance) * 0.04, 2)
+        self.backStake = round(float(self.availableToBetBalance) * 0.04, 2)
 
         if self.backStake < self.strategySettings.minBackStake:
             self.backStake = self.strategySettings.minBackStake
 
-        # trade existing positions
-        self.tradeExistingMarketPositions()
-
         # TODO: Insufficient Funds
-        if availableToBetBalance < self.backStake:
-            print('INSUFFICIENT FUNDS: {}'.format(availableToBetBalance))
+        if self.availableToBetBalance < self.backStake:
+            log.warning('INSUFFICIENT_FUNDS',
+                        availableToBetBalance=self.availableToBetBalance)
             return
 
-        # harvest and process new events
-        eventLookAhead = datetime.datetime.now(
-        ) + datetime.timedelta(minutes=self.strategySettings.eventLookAheadMinutes)
-        eventLookAheadDateTime = eventLookAhead.strftime('%Y-%m-%dT%H:%M:%SZ')
-        events = self.betfair.listEvents('1', eventLookAheadDateTime)
+        self.canEnter = True
 
-        if events is not None:
-            self.processEvents(events)
+    def enterPositions(self, budget):
+        # process events entering the placement window
+        if not self.canEnter:
+            return
 
-        endDate = datetime.datetime.now()
-        delta = endDate - startDate
-        print('END:   %s duration: %d secs availableToBetBalance: %s exposure: %s' % (
-            endDate, delta.seconds, availableToBetBalance, exposure))
+        # left on the calendar for the next tick
+        if not self.bettingAvailable():
+            budget.defer('entry')
+            return
 
-    def processEvents(self, events):
+        with metrics.time('iteration_stage_seconds', (('stage', 'events'),)):
+            events = self.eventCalendar.eligibleEvents()
+            if events != []:
+                with tracer.span('processEvents', events=len(events)):
+                    self.processEvents(events, budget)
 
-        for event in events:
-            eventDetails = event['event']
+    def discoverEvents(self, budget):
+        # harvest upcoming events, then resolve markets about to enter the window
+        if not self.canEnter:
+            return
 
-            # black listed teams
-            if any(team in eventDetails['name'] for team in self.strategySettings.excludedTeams):
+        if not self.bettingAvailable():
+            budget.defer('discovery')
+            return
+
+        with metrics.time('iteration_stage_seconds', (('stage', 'discovery'),)):
+            if not budget.allows('discovery'):
+                budget.defer('discovery')
                 return
+            with budget.unit('discovery'):
+                self.exclusionRules.reloadIfChanged()
+                self.eventCalendar.refresh(self.betfair)
+
+        with metrics.time('iteration_stage_seconds', (('stage', 'staging'),)):
+            self.stageEvents(budget)
 
-            # ignore if too far in future
-            placementDateTimeThreshold = datetime.datetime.now(
-            ) + datetime.timedelta(minutes=self.strategySettings.placementThresholdMinutes)
-            eventDateTime = datetime.datetime.strptime(
-                eventDetails['openDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
+    def processEvents(self, events, budget):
+
+        for index, event in enumerate(events):
+            # out of time - offered again next tick while before kick off
+            if not budget.allows('entry'):
+                for deferredEvent in events[index:]:
+                    self.eventCalendar.defer(deferredEvent)
+                budget.defer('entry', len(events) - index)
+                return
 
-            if eventDateTime > placementDateTimeThreshold:
+            with budget.unit('entry'):
+                self.processEvent(event)
+
+    def processEvent(self, event):
+        eventDetails = event['event']
+
+        # staged events skip the catalogue and order checks, unstaged ones do them now
+        stagedMarkets = self.stagedEvents.pop(eventDetails['id'], None)
+        if stagedMarkets is None:
+            markets = self.resolveEventMarkets(event)
+            if markets is None:
+                self.eventCalendar.defer(event)
+                return
+            stagedMarkets = [self.stageMarket(eventDetails, market, time.time())
+                             for market in markets]
+            ordersChecked = False
+        else:
+            metrics.inc('staged_entries_total', value=len(stagedMarkets))
+            # markets restored from a snapshot are checked again until the account is validated
+            ordersChecked = not self.validationPending
+
+        # check and establish position
+        for staged in stagedMarkets:
+            market = staged.market
+
+            # skip if market is already being traded
+            if market.marketId in self.positions:
                 continue
 
-            # get market details
-            markets = self.betfair.getMarketCatalogueForEvent(
-                '1', eventDetails['id'], True)
-
-            # check and establish position
-            for market in markets:
-                # skip if market is already being traded
-                if market['marketId'] in self.tradedMarketIds:
-                    continue
-
-                # liquidity check
-                if(market['totalMatched'] < matchedAmountThreshold):
-                    continue
-
-                # establish new market position if market is eligible for trading
-                if str(market['marketName']) in self.strategySettings.marketsToTrade:
-                    marketBook = self.betfair.getMarketBookBestOffers(
-                        market['marketId'])
-                    if marketBook is not None:
+            # liquidity check - try again next tick until kick off
+            if(market.totalMatched < self.strategySettings.matchedAmountThreshold):
+                self.eventCalendar.defer(event)
+                continue
+
+            marketBook = self.betfair.getMarketBookBestOffers(
+                market.marketId)
+            if marketBook is not None:
+                for book in marketBook:
+                    self.priceHistory.record(
+                        book, time.time(), (staged.selectionId,))
+                # the same prices as last time give the same decision
+                if self.changes.changed(market.marketId, 'book', bookFingerprint(marketBook, staged.selectionId)):
+                    with tracer.span('establishMarketPosition', marketId=market.marketId, eventId=eventDetails['id']):
                         self.establishMarketPosition(
-                            eventDetails, market, marketBook)
+                            staged, marketBook, ordersChecked)
+
+            if market.marketId not in self.positions:
+                self.eventCalendar.defer(event)
+
+    def resolveEventMarkets(self, event):
+        # the event's tradeable markets, [] when excluded, None if the catalogue call failed
+        eventDetails = event['event']
+
+        # black listed teams, competitions and event name patterns
+        rule = self.exclusionRules.match(
+            eventDetails['name'], eventId=eventDetails['id'])
+        if rule is not None:
+            log.info('EXCLUDED', eventId=eventDetails['id'],
+                     eventName=eventDetails['name'], rule=rule)
+            return []
+
+        # get market details - only tradeable markets and Match Odds (teams) are kept
+        markets = self.betfair.getMarketCatalogueForEvent(
+            '1', eventDetails['id'], True, self.isCatalogueMarketOfInterest)
+
+        if markets is None:
+            return None
+
+        # competition and team ids are only known from the catalogue
+        competitionId, competitionName = self.getCompetition(markets)
+        rule = self.exclusionRules.match(
+            competitionId=competitionId, competitionName=competitionName, teamIds=self.getTeamIds(markets))
+        if rule is not None:
+            log.info('EXCLUDED', eventId=eventDetails['id'],
+                     eventName=eventDetails['name'], rule=rule)
+            return []
+
+        # establish new market position only if market is eligible for trading
+        return [market for market in markets if market.marketName in self.strategySettings.marketsToTrade]
+
+    def stageEvents(self, budget):
+        '''
+        Resolves events that will enter the placement window within
+        stagingLeadMinutes: exclusions, catalogue, the Unders selection and stakes,
+        plus one order query across all their markets for positions established
+        elsewhere. When the event becomes eligible, entering costs one book read and
+        one placeOrders call.
+        '''
+        now = time.time()
+
+        # forget staged events that kicked off without being entered
+        for eventId in list(self.stagedEvents):
+            kickOff = self.eventCalendar.kickOff(eventId)
+            if kickOff is None or kickOff < now:
+                del self.stagedEvents[eventId]
+
+        room = min(self.maxStagedEventsPerTick,
+                   self.maxStagedEvents - len(self.stagedEvents))
+        events = [event for event in self.eventCalendar.upcomingEvents(self.stagingLeadMinutes * 60, now)
+                  if event['event']['id'] not in self.stagedEvents][:max(room, 0)]
+        if events == []:
+            return
 
-    def tradeExistingMarketPositions(self):
+        self.stageEventList(events, budget, now)
+        metrics.set('staged_events', len(self.stagedEvents))
+
+    def stageEventList(self, events, budget, now):
+        # resolves and stages the given events, skipping markets that already have orders
+        resolved = {}
+        for index, event in enumerate(events):
+            # unstaged events are picked up next tick or take the full path
+            if not budget.allows('staging'):
+                budget.defer('staging', len(events) - index)
+                break
+            with budget.unit('staging'):
+                markets = self.resolveEventMarkets(event)
+            if markets is not None:
+                resolved[event['event']['id']] = (event['event'], markets)
+
+        marketIds = [market.marketId for eventDetails,
+                     markets in resolved.values() for market in markets]
+        takenMarketIds = set()
+        for i in range(0, len(marketIds), self.maxMarketIdsPerOrderQuery):
+            currentOrders = self.betfair.listCurrentOrders(
+                marketIds=marketIds[i:i + self.maxMarketIdsPerOrderQuery])
+
+            # unstaged events take the full path when they become eligible
+            if currentOrders is None:
+                return
+
+            takenMarketIds.update(order.marketId for order in currentOrders)
 
-        for marketId in self.tradedMarketIds:
-            self.tradeMarketPosition(marketId)
+        for eventId, (eventDetails, markets) in resolved.items():
+            self.stagedEvents[eventId] = [self.stageMarket(eventDetails, market, now)
+                                          for market in markets if market.marketId not in takenMarketIds]
+            log.debug('STAGED', eventId=eventId, eventName=eventDetails['name'],
+                      markets=len(self.stagedEvents[eventId]))
 
-    def tradeMarketPosition(self, marketId):
-        print('TRADING: %s' % marketId)
+    def stageMarket(self, eventDetails, market, now):
+        '''
+        Back the Under
 
-        # get current position
-        currentOrders = self.betfair.listCurrentOrders(marketId)
+        Target Profit (e.g 0.25)
+        Total = Stake * Odds (e.g. 2.0 * 2.6 = 5.2)
+        Hedge Stake = Stake + Target Profit (e.g. 2.0 + 0.25 = 2.25)
+        Hedge Odds = Total / HedgeStake
+        '''
+        stake = self.backStake
+        targetProfit = stake * self.strategySettings.targetProfitPercent
+        hedgeStake = round(stake + targetProfit, 2)
+        return StagedMarket(eventDetails, market, market.runners[0].selectionId, stake, hedgeStake, now)
+
+    def tradeExistingMarketPositions(self):
 
-        # shortcircuit if API exception
-        if currentOrders == None:
+        if len(self.positions) == 0:
             return
 
-        if currentOrders['currentOrders'] == []:
+        # promote positions whose stop loss deadline has passed
+        for position in self.positions.popDue(datetime.datetime.now()):
+            self.positions.transition(position, STOP_LOSS_STEPPING)
+
+        # one order query for all open markets rather than one per market
+        ordersByMarketId = {}
+        marketIds = self.positions.marketIds()
+
+        for i in range(0, len(marketIds), self.maxMarketIdsPerOrderQuery):
+            currentOrders = self.betfair.listCurrentOrders(
+                marketIds=marketIds[i:i + self.maxMarketIdsPerOrderQuery])
+
+            # shortcircuit if API exception
+            if currentOrders is None:
+                return
+
+            for order in currentOrders:
+                ordersByMarketId.setdefault(order.marketId, []).append(order)
+
+        # the hedge selections' prices, for the stop loss to see where they are heading
+        self.recordPositionBooks(
+            self.positions.inState(BACKED, HEDGE_WORKING, STOP_LOSS_STEPPING))
+
+        # iterate a snapshot so closing positions cannot skip markets; stop losses are stepped together after
+        stepping = []
+        for position in self.positions.inState(PENDING_BACK, BACKED, HEDGE_WORKING, STOP_LOSS_STEPPING):
+            orders = ordersByMarketId.get(position.marketId, [])
+
+            # a backed or hedged position with unchanged orders stays as it is; a due stop loss was promoted above
+            due = position.state not in (BACKED, HEDGE_WORKING)
+            if not self.changes.changed(position.marketId, 'orders', ordersFingerprint(orders), due):
+                continue
+
+            self.ledger.updateMarket(position.marketId, orders)
+            with tracer.span('tradeMarketPosition', marketId=position.marketId, state=position.state):
+                if self.tradeMarketPosition(position, orders):
+                    stepping.append(position)
+
+        if stepping != []:
+            resting = set(marketId for marketId, orders in ordersByMarketId.items()
+                          if any(order.sizeRemaining > 0.0 for order in orders))
+            with tracer.span('stepStopLosses', positions=len(stepping)):
+                self.stepStopLosses(stepping, resting)
+
+    def recordPositionBooks(self, positions):
+        marketIds = [position.marketId for position in positions]
+        now = time.time()
+        for i in range(0, len(marketIds), self.maxMarketIdsPerBookQuery):
+            marketBooks = self.betfair.listMarketBooks(
+                marketIds[i:i + self.maxMarketIdsPerBookQuery])
+            for marketBook in marketBooks or ():
+                position = self.positions.get(marketBook.marketId)
+                if position is not None:
+                    self.priceHistory.record(
+                        marketBook, now, (position.selectionId,))
+
+    def tradeMarketPosition(self, position, orders):
+        # True when the position's stop loss is to be stepped this tick
+        marketId = position.marketId
+        log.info('TRADING', marketId=marketId, state=position.state)
+
+        if orders == []:
             # print ('currentOrders == Empty')
-            self.tradedMarketIds.remove(marketId)
+            self.closePosition(marketId, 'NO_ORDERS')
             return
 
         # if FOK did not match then cancel all orders in the Market
         # attempt will be made to place bet again on next ieration pass
-        if len(currentOrders['currentOrders']) == 1 and currentOrders['currentOrders'][0]['side'] == 'LAY':
-            print(
-                "FOK BACK ORDER DIDNOTMATCH: Canceling and placing again on next iteration.")
+        if len(orders) == 1 and orders[0].side == 'LAY':
+            log.info('FOK_BACK_ORDER_DIDNOTMATCH', marketId=marketId)
             if self.betfair.cancelOrders(marketId):
-                print('CEASETRADING: marketId {}'.format(marketId))
-                self.tradedMarketIds.remove(marketId)
+                self.ledger.cancelled(marketId)
+                log.info('CEASETRADING', marketId=marketId)
+                self.closePosition(marketId, 'FOK_DIDNOTMATCH')
 
             return
 
         filledOrderCount = 0
-        # default required so that placedDatetime is not undefined
-        placedDatetime = datetime.datetime.now()
 
-        for order in currentOrders['currentOrders']:
+        for order in orders:
 
-            if order['sizeRemaining'] == 0.0:  # original FOK order is fully matched
-                placedDatetime = datetime.datetime.strptime(
-                    order['placedDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
+            if order.sizeRemaining == 0.0:  # original FOK order is fully matched
                 filledOrderCount = filledOrderCount + 1
-                selectionId = order['selectionId']
-                price = order['priceSize']['price']
-                size = order['priceSize']['size']
-                side = 'BACK' if order['side'] == 'LAY' else 'LAY'
-
-        # execute stop loss if triggered by stopLossThresholdMinutes
-        stopLossDatetimeThreshold = placedDatetime + \
-            datetime.timedelta(
-                minutes=self.strategySettings.stopLossThresholdMinutes)
-
-        # TODO: uncomment if unsure
-        # print ("filledOrderCount = {}, {} > {}" .format(filledOrderCount, datetime.datetime.now(), stopLossDatetimeThreshold))
-
-        if filledOrderCount == 1 and datetime.datetime.now() > stopLossDatetimeThreshold:
-            # calculate stop loss percent based on time and stepping back 1% with each 10 second iteration
-            timedelta = datetime.datetime.now() - stopLossDatetimeThreshold
-            # print ("timedelta {}".format(timedelta))
-
-            stepBackProfitPercentModifier = round(
-                timedelta.seconds / 10, 0) / 100
-            #print ("stepBackProfitPercentModifier {}".format(stepBackProfitPercentModifier))
-
-            revisedProfitPercent = round(
-                (1 + self.strategySettings.targetProfitPercent) - stepBackProfitPercentModifier, 2)
-            # print ("revisedProfitPercent {}".format(revisedProfitPercent))
-
-            if revisedProfitPercent < 1.0:
-                revisedProfitPercent = 0.50
-
-            # hedge order is a lay
-            if side == 'LAY':
-                total = round(size * price, 2)
-
-                revisedStake = round(size * revisedProfitPercent, 2)
-
-                # revisedStake must obey min stake
-                if revisedStake < 2.0:
-                    revisedStake = 2.0
-                    #print ('MarketId: {} trading has hit min revised Stake and is no longer tradable.'.format(marketId))
-
-                newPrice = self.applyOddsLadder(total / revisedStake)
-
-                print("STOPLOSS: timedelta: {} stepBack: {} revisedProfit: {} newPrice: {} revisedStake: {}".format(
-                    timedelta, stepBackProfitPercentModifier, revisedProfitPercent, newPrice, revisedStake))
-                # cancel & place new hedge order as per stop loss settings
-                if self.betfair.cancelOrders(marketId):
-                    if revisedStake == 2.0:
-                        self.betfair.placeOrder(
-                            marketId, selectionId, side, revisedStake, newPrice)
-                        print('MINSTAKE CEASETRADING: marketId {}'.format(marketId))
-                        self.tradedMarketIds.remove(marketId)
-                    else:
-                        #self.betfair.placeOrderByPayout(marketId, selectionId, side, 10.0, total)
-                        self.betfair.placeFOKOrder(
-                            marketId, selectionId, side, revisedStake, newPrice)
+                filledOrder = order
 
         # remove from traded markets if both orders filled
         if filledOrderCount == 2:
-            print('POSITIONCLOSED: marketId: {}'.format(marketId))
-            self.tradedMarketIds.remove(marketId)
-
-    def establishMarketPosition(self, eventDetails, market, marketBook):
-
-        marketId = market['marketId']
-        currentOrders = self.betfair.listCurrentOrders(marketId)
-
-        if currentOrders is None:
+            log.info('POSITIONCLOSED', marketId=marketId)
+            self.closePosition(marketId, 'HEDGED')
             return
 
-        # shortcircuit if position established elsewhere (e.g. directly on website)
-        if currentOrders['currentOrders'] != []:
+        if filledOrderCount != 1:
             return
 
+        # back matched - journal it once so the stop loss clock survives a restart
+        if position.placedAt is None:
+            self.journalPosition(BACK_MATCHED, marketId, selectionId=filledOrder.selectionId, placedDate=filledOrder.placedDate,
+                                 matchedPrice=filledOrder.price, matchedSize=filledOrder.size,
+                                 hedgeSide='BACK' if filledOrder.side == 'LAY' else 'LAY')
+            self.positions.scheduleStopLoss(
+                position, self.stopLossDeadline(position.placedAt))
+
+        if position.state != STOP_LOSS_STEPPING:
+            # stop loss not yet due; track whether the hedge is still working
+            self.positions.transition(
+                position, HEDGE_WORKING if len(orders) > 1 else BACKED)
+            if position.stopLossAt > datetime.datetime.now():
+                return
+            self.positions.transition(position, STOP_LOSS_STEPPING)
+
+        return True
+
+    def stepStopLosses(self, positions, resting):
+        '''
+        Stop loss step for every position due one this tick: the exit engine
+        decides all of them in one pass, from their matched bets and how their
+        hedge prices have moved (recordPositionBooks), each market's actions (cancel, then
+        reprice or final hedge and close) are submitted concurrently, and the
+        results are journalled here on the tick's thread.
+        '''
+        actions = self.exitEngine.decide(
+            positions, time.time(), resting, self.priceHistory)
+        for action in actions:
+            if action.kind in (REPRICE, HEDGE):
+                action.customerRef = uuid.uuid4().hex
+                log.info('STOPLOSS', marketId=action.marketId, timedelta=action.elapsed, revisedProfit=action.profitPercent,
+                         newPrice=action.price, revisedStake=action.stake, laySlopePerMinute=action.laySlope)
+
+        for results in self.submitExitActions(actions):
+            for action, ok in results:
+                marketId = action.marketId
+                if action.kind == CANCEL and ok:
+                    self.ledger.cancelled(marketId)
+                elif action.kind == REPRICE and ok:
+                    self.ledger.placed(
+                        marketId, action.selectionId, action.side, action.stake, action.price)
+                    self.journalPosition(REPRICED, marketId, hedgeSide=action.side, hedgeStake=action.stake,
+                                         hedgePrice=action.price, profitPercent=action.profitPercent, customerRef=action.customerRef)
+                elif action.kind == HEDGE and ok:
+                    self.ledger.placed(
+                        marketId, action.selectionId, action.side, action.stake, action.price)
+                    self.journalPosition(HEDGE_PLACED, marketId, hedgeSide=action.side, hedgeStake=action.stake,
+                                         hedgePrice=action.price, customerRef=action.customerRef)
+                elif action.kind == CLOSE:
+                    log.info('MINSTAKE_CEASETRADING', marketId=marketId)
+                    self.closePosition(marketId, 'MINSTAKE')
+
+    def submitExitActions(self, actions):
+        # [(action, ok), ...] per market; a market stops at a failed cancel, its orders may still be working
+        byMarketId = {}
+        for action in actions:
+            byMarketId.setdefault(action.marketId, []).append(action)
+
+        betfair = self.betfair
+        resilience = self.betfairSettings.resilience
+        deadline = None if resilience is None else resilience.tickDeadline()
+
+        def submit(marketActions):
+            results = []
+            for action in marketActions:
+                if action.kind == CANCEL:
+                    ok = betfair.cancelOrders(action.marketId)
+                elif action.kind == REPRICE:
+                    ok = betfair.placeFOKOrder(
+                        action.marketId, action.selectionId, action.side, action.stake, action.price, action.customerRef)
+                elif action.kind == HEDGE:
+                    ok = betfair.placeOrder(
+                        action.marketId, action.selectionId, action.side, action.stake, action.price, action.customerRef)
+                else:
+                    ok = True
+                results.append((action, ok))
+                if action.kind == CANCEL and not ok:
+                    break
+            return results
+
+        def submitInTick(marketActions):
+            # the tick's deadline is kept per thread, the pool's threads send within it too
+            resilience.startTick(deadline)
+            try:
+                return submit(marketActions)
+            finally:
+                resilience.endTick()
+
+        if len(byMarketId) == 1:
+            return [submit(marketActions) for marketActions in byMarketId.values()]
+        return list(self.exitPool.map(submit if resilience is None else submitInTick, byMarketId.values()))
+
+    def establishMarketPosition(self, staged, marketBook, ordersChecked=False):
+        eventDetails = staged.eventDetails
+        market = staged.market
+        marketId = market.marketId
+
+        if not ordersChecked:
+            currentOrders = self.betfair.listCurrentOrders(marketId)
+
+            if currentOrders is None:
+                self.changes.invalidate(marketId)
+                return
+
+            # shortcircuit if position established elsewhere (e.g. directly on website)
+            if currentOrders != []:
+                return
+
         # Unders
-        undersSelectionId = market['runners'][0]['selectionId']
+        undersSelectionId = staged.selectionId
         underCurrentBackPrice, underCurrentLayPrice = self.betfair.getCurrentBestPrices(
             marketBook, undersSelectionId)
 
@@ -279,28 +833,57 @@ class OverUnderStrategy:
             if underCurrentBackPrice > self.strategySettings.minBackPrice and underCurrentBackPrice < self.strategySettings.maxBackPrice:
                 overround = (underCurrentLayPrice /
                              underCurrentBackPrice) * 100
-                if overround < overroundThreshold:
-                    print('OPENING POSITION: {} - {} backing selection: {}'.format(
-                        eventDetails['name'], market['marketName'], market['runners'][0]['runnerName']))
+                if overround < self.strategySettings.overroundThreshold:
+                    # how the Unders price has been moving while we watched it
+                    history = self.priceHistory.get(marketId, undersSelectionId)
+                    since = time.time() - self.priceWindowSeconds
+                    backSlope = history.slope(since) if history is not None else None
+                    log.info('OPENING_POSITION', marketId=marketId, eventName=eventDetails['name'],
+                             marketName=market.marketName, selection=market.runners[0].runnerName, staged=ordersChecked,
+                             backSlopePerMinute=round(backSlope * 60, 4) if backSlope is not None else None,
+                             backTicks=history.tickCount(since) if history is not None else None)
+
+                    # determine and place order pair (keep in running) - stakes come staged
+                    stake = staged.stake
+                    hedgeStake = staged.hedgeStake
+                    hedgeOdds = self.applyOddsLadder(
+                        stake * underCurrentBackPrice / hedgeStake)
+
+                    # journalled so the exporter can join the cleared orders back to this entry
+                    customerRef = uuid.uuid4().hex
+                    if self.betfair.placeBackTheUnderPair(marketId, undersSelectionId, stake, underCurrentBackPrice, undersSelectionId, hedgeStake, hedgeOdds, customerRef) == True:
+                        self.ledger.placed(
+                            marketId, undersSelectionId, 'BACK', stake, underCurrentBackPrice)
+                        self.ledger.placed(
+                            marketId, undersSelectionId, 'LAY', hedgeStake, hedgeOdds)
+                        self.positions.add(
+                            Position(marketId, undersSelectionId))
+                        self.journalPosition(
+                            OPENED, marketId, eventId=eventDetails['id'], eventName=eventDetails['name'], marketName=market.marketName,
+                            competitionName=market.competitionName, selectionId=undersSelectionId, backStake=stake, backPrice=underCurrentBackPrice, hedgeStake=hedgeStake, hedgePrice=hedgeOdds,
+                            customerRef=customerRef)
+                    else:
+                        # placement failed: try again next tick even if the prices hold
+                        self.changes.invalidate(marketId)
 
-                    # determine and place order pair (keep in running)
-                    '''
-                    Back the Under
+    def journalPosition(self, event, marketId, **fields):
+        self.journal.record(event, marketId, **fields)
+        self.positions.get(marketId).update(fields)
 
-                    Target Profit (e.g 0.25)
-                    Total = Stake * Odds (e.g. 2.0 * 2.6 = 5.2)
-                    Hedge Stake = Stake + Target Profit (e.g. 2.0 + 0.25 = 2.25)
-                    Hedge Odds = Total / HedgeStake
-                    '''
-                    stake = self.backStake
+    def closePosition(self, marketId, reason):
+        self.journal.record(CLOSED, marketId, reason=reason)
+        self.positions.remove(marketId)
+        self.ledger.closed(marketId)
+        self.priceHistory.discard(marketId)
+        self.changes.invalidate(marketId)
+        self.exitEngine.remove(marketId)
 
-                    targetProfit = stake * self.strategySettings.targetProfitPercent
-                    total = stake * underCurrentBackPrice
-                    hedgeStake = round(self.backStake + targetProfit, 2)
-                    hedgeOdds = self.applyOddsLadder(total / hedgeStake)
+    def fetchAccountFunds(self):
+        # called from the ledger thread; the client is replaced each tick
+        return self.betfair.getAccountFunds()
 
-                    if self.betfair.placeBackTheUnderPair(marketId, undersSelectionId, stake, underCurrentBackPrice, undersSelectionId, hedgeStake, hedgeOdds) == True:
-                        self.tradedMarketIds.append(marketId)
+    def stopLossDeadline(self, placedAt):
+        return placedAt + datetime.timedelta(minutes=self.strategySettings.stopLossThresholdMinutes)
 
 # ----------------------------------
 # HELPERS
@@ -351,8 +934,24 @@ class OverUnderStrategy:
             temp = round(odds / 10.0, 0)
             return round(temp * 10.0, 2)
 
+    def isCatalogueMarketOfInterest(self, market):
+        return market.marketName in self.strategySettings.marketsToTrade or market.marketName == 'Match Odds'
+
+    def getCompetition(self, markets):
+        for market in markets:
+            if market.competitionId is not None:
+                return market.competitionId, market.competitionName
+        return None, None
+
+    def getTeamIds(self, markets):
+        # Match Odds runners are the teams (plus The Draw)
+        for market in markets:
+            if market.marketName == 'Match Odds':
+                return [runner.selectionId for runner in market.runners if runner.runnerName != 'The Draw']
+        return []
+
     def refreshSessionToken(self):
-        print('SESSION TOKEN REFRESH...')
+        log.info('SESSION_TOKEN_REFRESH')
 
         username = os.environ.get("BETFAIR_USERNAME")
         password = os.environ.get("BETFAIR_PASSWORD")
@@ -362,21 +961,40 @@ class OverUnderStrategy:
         headers = {'X-Application': 'daemon',
                    'Content-Type': 'application/x-www-form-urlencoded'}
 
-        # OLD https://identitysso.betfair.com/api/certlogin
-        resp = requests.post('https://identitysso-cert.betfair.com/api/certlogin',
-                             data=payload, cert=('client-2048.crt', 'client-2048.key'), headers=headers)
+        # imported here - a warm start with a live session never logs in
+        import requests
+
+        def login(timeout):
+            # OLD https://identitysso.betfair.com/api/certlogin
+            resp = requests.post('https://identitysso-cert.betfair.com/api/certlogin',
+                                 data=payload, cert=('client-2048.crt', 'client-2048.key'), headers=headers, timeout=timeout)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp
+
+        # a failed login leaves the token expired, so the next tick tries again (at once while identity is down)
+        resilience = self.betfairSettings.resilience
+        try:
+            if resilience is not None:
+                resp = resilience.call(
+                    'identity', 'certlogin', login, self.betfairSettings.timeoutSeconds)
+            else:
+                resp = login(self.betfairSettings.timeoutSeconds)
+        except (CircuitOpenError, requests.RequestException) as e:
+            log.error('LOGIN_FAILED', error=repr(e))
+            self.sessionToken = None
+            return
 
         if resp.status_code == 200:
             resp_json = resp.json()
-            print(resp_json['loginStatus'])
-            print(resp_json['sessionToken'])
+            log.info('LOGIN', loginStatus=resp_json['loginStatus'])
             self.sessionToken = resp_json['sessionToken']
             self.sessionTokenExpiresAt = self.sessionTokenExpiresAt + \
                 datetime.timedelta(minutes=self.sessionTokenValidForMinutes)
             self.betfairSettings.sessionToken = self.sessionToken
             self.betfairSettings.updateHeaders()
         else:
-            print("Login Request failed.")
+            log.error('LOGIN_FAILED', statusCode=resp.status_code)
             self.sessionToken = None
 
 
@@ -394,8 +1012,10 @@ if __name__ == '__main__':
     bettingURL = "https://api.betfair.com/exchange/betting/json-rpc/v1"
     accountsURL = "https://api.betfair.com/exchange/account/json-rpc/v1"
 
+    # reads slower than their recent p95 are sent again; no request may hang a tick, failed reads are
+    # retried and an endpoint that is down fails fast
     betfairSettings = BetfairSettings(
-        appKey, sessionToken, bettingURL, accountsURL)
+        appKey, sessionToken, bettingURL, accountsURL, timeoutSeconds=10.0, hedging=HedgedReads(), resilience=Resilience())
 
     # strategySettings
     eventLookAheadMinutes = 10
@@ -461,10 +1081,59 @@ if __name__ == '__main__':
     strategySettings = StrategySettings(eventLookAheadMinutes, minBackStake, minBackPrice, maxBackPrice, minLayPrice, maxLayPrice, placementThresholdMinutes,
                                         targetProfitPercent, stopLossThresholdMinutes, stopLossPercent, overroundThreshold, matchedAmountThreshold, marketsToTrade, excludedTeams)
 
+    # local prometheus scrape endpoint
+    metricsPort = 9100
+    metrics.serve(metricsPort)
+
+    # span tracing (load trace.json in chrome://tracing or ui.perfetto.dev)
+    tracer.enabled = True
+
+    # read prices published by a shared feeder (python pricefeed.py) rather than polling them
+    betfairFactory = Betfair
+    priceFeedName = os.environ.get("PRICE_FEED")
+    if priceFeedName:
+        from pricefeed import PriceTable, FeedBetfair
+        priceTable = PriceTable.attach(priceFeedName)
+        betfairFactory = functools.partial(FeedBetfair, priceTable=priceTable)
+
+    # paper trading: live reads, orders and funds simulated locally (PAPER_TRADING=<starting balance>)
+    journalPath = 'positions.journal'
+    snapshotPath = 'daemon.snapshot'
+    paperBalance = os.environ.get("PAPER_TRADING")
+    if paperBalance:
+        from paper import PaperExchange, PaperBetfair
+        paperExchange = PaperExchange(balance=float(paperBalance))
+        betfairFactory = functools.partial(PaperBetfair, paperExchange=paperExchange)
+        journalPath = 'paper.journal'
+        snapshotPath = 'paper.snapshot'
+
+    # tracemalloc growth sites every 30 minutes (MEMORY_TRACE=<frames>); costs on every allocation
+    memoryTraceFrames = int(os.environ.get("MEMORY_TRACE", "0"))
+
+    # markets sharded over worker processes (SHARD_WORKERS=<count>, changed live through shard.workers)
+    shardWorkers = int(os.environ.get("SHARD_WORKERS", "0"))
+
     # create and start
-    overUnderStrategy = OverUnderStrategy(strategySettings, betfairSettings)
+    if shardWorkers:
+        from shard import ShardCoordinator
+        if betfairFactory is not Betfair:
+            raise SystemExit('SHARD_WORKERS runs the live client only, not PAPER_TRADING or PRICE_FEED')
+        workerConfig = {'betfairSettings': {'appKey': appKey, 'sessionToken': None, 'bettingURL': bettingURL, 'accountsURL': accountsURL,
+                                            'timeoutSeconds': 10.0, 'hedging': True, 'resilience': True},
+                        'strategySettings': vars(strategySettings), 'journalPath': 'positions.shard-%d.journal',
+                        'betfairFactory': Betfair, 'tickBudgetSeconds': 8.0, 'intervalSeconds': 10}
+        overUnderStrategy = ShardCoordinator(
+            strategySettings, betfairSettings, workerConfig, workers=shardWorkers,
+            maxExposure=float(os.environ.get("SHARD_MAX_EXPOSURE", "100")), memoryTraceFrames=memoryTraceFrames)
+    else:
+        overUnderStrategy = OverUnderStrategy(
+            strategySettings, betfairSettings, journalPath=journalPath, betfairFactory=betfairFactory, snapshotPath=snapshotPath,
+            memoryTraceFrames=memoryTraceFrames)
     overUnderStrategy.iteration()
 
+    # imported after the first tick, it is not needed to start trading
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
     scheduler = BlockingScheduler()
     scheduler.add_job(overUnderStrategy.iteration, 'interval', seconds=10)
 
@@ -472,3 +1141,12 @@ if __name__ == '__main__':
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         pass
+
+    if shardWorkers:
+        overUnderStrategy.close()
+    else:
+        overUnderStrategy.writeSnapshot()
+        overUnderStrategy.ledger.stop()
+    overUnderStrategy.journal.close()
+    tracer.close()
+    log.close()
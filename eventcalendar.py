@@ -0,0 +1,161 @@
+import calendar
+import heapq
+import time
+
+from metrics import metrics
+
+# ----------------------------------
+# EVENT CALENDAR
+# ----------------------------------
+
+
+class EventCalendar:
+    '''
+    Upcoming fixtures held in a min-heap keyed by kick off (epoch seconds).
+
+    Fixtures are loaded once and then refreshed incrementally every refreshSeconds
+    (only the newly uncovered part of the look ahead window), with a full window
+    refresh every fullRefreshSeconds to pick up late additions. eligibleEvents()
+    pops only the events that crossed into the placement window since the last
+    call, plus any the strategy deferred for another attempt before kick off.
+    At most maxEvents fixtures are held; beyond that the later ones are left for
+    a later refresh.
+    '''
+
+    def __init__(self, eventTypeId, lookAheadMinutes, placementThresholdMinutes, refreshSeconds=60, fullRefreshSeconds=900, maxEvents=5000):
+        self.eventTypeId = eventTypeId
+        self.lookAheadSeconds = int(lookAheadMinutes * 60)
+        self.placementThresholdSeconds = int(placementThresholdMinutes * 60)
+        self.refreshSeconds = refreshSeconds
+        self.fullRefreshSeconds = fullRefreshSeconds
+        self.maxEvents = maxEvents
+
+        self.heap = []
+        self.events = {}
+        self.kickOffs = {}
+        self.deferred = {}
+        self.loadedUntil = None
+        self.nextRefreshAt = 0
+        self.nextFullRefreshAt = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def refresh(self, betfair, now=None):
+        now = int(time.time()) if now is None else int(now)
+
+        if now < self.nextRefreshAt:
+            return
+
+        fromEpoch = self.loadedUntil
+        if fromEpoch is None or fromEpoch < now or now >= self.nextFullRefreshAt:
+            fromEpoch = now
+            self.nextFullRefreshAt = now + self.fullRefreshSeconds
+
+        toEpoch = now + self.lookAheadSeconds
+
+        if fromEpoch < toEpoch:
+            events = betfair.listEvents(
+                self.eventTypeId, self.formatDateTime(toEpoch), self.formatDateTime(fromEpoch))
+
+            # retry on the next tick if the API call failed
+            if events is None:
+                return
+
+            for event in events:
+                self.add(event)
+
+            self.loadedUntil = toEpoch
+
+        self.nextRefreshAt = now + self.refreshSeconds
+
+        # forget kicked off fixtures
+        for eventId, kickOff in list(self.kickOffs.items()):
+            if kickOff < now and eventId not in self.events:
+                del self.kickOffs[eventId]
+
+    def add(self, event):
+        eventId = event['event']['id']
+
+        if eventId in self.kickOffs:
+            return
+
+        if len(self.events) >= self.maxEvents:
+            metrics.inc('cache_limit_hits_total', (('cache', 'eventCalendar'),))
+            return
+
+        kickOff = self.parseDateTime(event['event']['openDate'])
+        self.kickOffs[eventId] = kickOff
+        self.events[eventId] = event
+        heapq.heappush(self.heap, (kickOff, eventId))
+
+    def eligibleEvents(self, now=None):
+        now = int(time.time()) if now is None else int(now)
+        placementThreshold = now + self.placementThresholdSeconds
+
+        # events deferred by the strategy get another attempt until kick off
+        eligible = [event for eventId, event in self.deferred.items()
+                    if self.kickOffs.get(eventId, 0) >= now]
+        self.deferred = {}
+
+        while self.heap and self.heap[0][0] <= placementThreshold:
+            kickOff, eventId = heapq.heappop(self.heap)
+            event = self.events.pop(eventId, None)
+            if event is not None and kickOff >= now:
+                eligible.append(event)
+
+        return eligible
+
+    def upcomingEvents(self, leadSeconds, now=None):
+        # events due into the placement window within leadSeconds, left on the heap
+        now = int(time.time()) if now is None else int(now)
+        horizon = now + self.placementThresholdSeconds + leadSeconds
+        return [self.events[eventId] for kickOff, eventId in self.heap if kickOff <= horizon and eventId in self.events]
+
+    def remove(self, eventId):
+        # handed elsewhere: never offered again, its heap entry is dropped when it comes due
+        self.events.pop(eventId, None)
+        self.deferred.pop(eventId, None)
+
+    def defer(self, event):
+        self.deferred[event['event']['id']] = event
+
+    def kickOff(self, eventId):
+        return self.kickOffs.get(eventId)
+
+# ----------------------------------
+# WARM START
+# ----------------------------------
+    def toState(self):
+        return {'events': list(self.events.values()), 'deferred': list(self.deferred.values()),
+                'loadedUntil': self.loadedUntil}
+
+    def restore(self, state, now=None):
+        '''
+        Reloads fixtures saved by toState, dropping those already kicked off. The
+        next refresh only fetches what lies beyond loadedUntil; the full window
+        refresh is pushed back a period as the fixtures were fetched recently.
+        '''
+        now = int(time.time()) if now is None else int(now)
+
+        for event in state['events']:
+            if self.parseDateTime(event['event']['openDate']) >= now:
+                self.add(event)
+
+        for event in state['deferred']:
+            kickOff = self.parseDateTime(event['event']['openDate'])
+            if kickOff >= now:
+                self.kickOffs[event['event']['id']] = kickOff
+                self.defer(event)
+
+        self.loadedUntil = state['loadedUntil']
+        self.nextFullRefreshAt = now + self.fullRefreshSeconds
+
+# ----------------------------------
+# HELPERS
+# ----------------------------------
+    def parseDateTime(self, openDate):
+        return calendar.timegm(time.strptime(openDate, '%Y-%m-%dT%H:%M:%S.%fZ'))
+
+    def formatDateTime(self, epoch):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
@@ -0,0 +1,142 @@
+import atexit
+import collections
+import json
+import sys
+import threading
+import time
+
+# ----------------------------------
+# LEVELS
+# ----------------------------------
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO',
+               WARNING: 'WARNING', ERROR: 'ERROR'}
+
+# ----------------------------------
+# EVENT LOG
+# ----------------------------------
+
+
+class EventLog:
+    '''
+    Structured event log that keeps I/O off the trading thread.
+
+    A log call only checks the level and sampling rate and appends a tuple to a
+    bounded deque (constant time, no locks taken); JSON encoding and writes happen
+    on a background writer thread. When the sink is slow and the queue is full
+    new records are dropped and counted instead of blocking the caller.
+    sampling maps an event name to N, emitting one in every N of that event.
+    '''
+
+    def __init__(self, stream=None, level=INFO, maxQueue=10000, sampling=None, flushIntervalSeconds=0.2):
+        self.stream = stream
+        self.level = level
+        self.maxQueue = maxQueue
+        self.sampling = dict(sampling or {})
+        self.flushIntervalSeconds = flushIntervalSeconds
+
+        self.records = collections.deque()
+        self.sampleCounts = {}
+        self.dropped = 0
+        self.written = 0
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.writer = None
+        self.startLock = threading.Lock()
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, fields)
+
+    def log(self, level, event, fields):
+        if level < self.level:
+            return
+
+        sampleRate = self.sampling.get(event)
+        if sampleRate is not None:
+            count = self.sampleCounts.get(event, 0)
+            self.sampleCounts[event] = count + 1
+            if count % sampleRate != 0:
+                return
+            fields['sampled'] = sampleRate
+
+        if len(self.records) >= self.maxQueue:
+            self.dropped = self.dropped + 1
+            return
+
+        self.records.append((time.time(), level, event, fields))
+
+        if self.writer is None:
+            self.start()
+
+        # errors are flushed straight away, everything else on the next interval
+        if level >= ERROR:
+            self.wakeup.set()
+
+    def start(self):
+        with self.startLock:
+            if self.writer is not None:
+                return
+            self.writer = threading.Thread(
+                target=self.run, name='eventlog', daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.flushIntervalSeconds)
+            self.wakeup.clear()
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        if not self.records:
+            return
+
+        lines = []
+        while self.records:
+            ts, level, event, fields = self.records.popleft()
+            record = {'ts': round(ts, 3), 'level': LEVEL_NAMES[level], 'event': event}
+            record.update(fields)
+            lines.append(json.dumps(
+                record, separators=(',', ':'), default=str))
+
+        if self.dropped:
+            lines.append(json.dumps({'ts': round(time.time(), 3), 'level': 'WARNING',
+                                     'event': 'LOG_DROPPED', 'count': self.dropped}, separators=(',', ':')))
+            self.dropped = 0
+
+        stream = self.stream if self.stream is not None else sys.stdout
+        try:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+        except (OSError, ValueError):
+            return
+
+        self.written = self.written + len(lines)
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.stopping = True
+        self.wakeup.set()
+        self.writer.join(timeout=5)
+        self.writer = None
+        self.stopping = False
+
+
+# shared event log - chatty per tick events are sampled
+log = EventLog(sampling={'TRADING': 6})
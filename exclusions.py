@@ -0,0 +1,149 @@
+import json
+import os
+import re
+import unicodedata
+
+from eventlog import log
+
+# ----------------------------------
+# EXCLUSION RULES
+# ----------------------------------
+
+
+class ExclusionRules:
+    '''
+    Compiled event filter for excluded teams, competitions and event name patterns.
+
+    Team names are normalised (accents stripped, casefolded, punctuation collapsed).
+    The strategy's excludedTeams list keeps its substring semantics - 'Hamburg'
+    still excludes 'Hamburger SV' - through a single regex over the normalised
+    event name. Teams from the rules file match whole words only and are stored
+    as token n-grams in a set, so matching an event name is a handful of set
+    lookups regardless of how many are excluded. Free form patterns are joined
+    into a single regex. Rules from path (JSON with optional teams, teamIds,
+    competitions, competitionIds, eventIds and patterns lists) are merged with
+    the base rules and reloaded whenever the file changes.
+    '''
+
+    def __init__(self, teams=(), competitions=(), patterns=(), path=None):
+        self.baseRules = {'teamSubstrings': list(teams), 'competitions': list(
+            competitions), 'patterns': list(patterns)}
+        self.path = path
+        self.mtime = None
+        self.compile(self.baseRules)
+        self.reloadIfChanged()
+
+    def compile(self, rules):
+        self.teamSubstrings = {}
+        for team in rules.get('teamSubstrings', []):
+            name = self.normalize(team)
+            if name:
+                self.teamSubstrings[name] = 'team:%s' % team
+        self.teamSubstringRegex = None
+        if self.teamSubstrings:
+            # longest first, so the rule reported is the longest name that matched
+            self.teamSubstringRegex = re.compile('|'.join(re.escape(name) for name in sorted(
+                self.teamSubstrings, key=len, reverse=True)))
+
+        self.teams = {}
+        self.maxTeamTokens = 1
+        for team in rules.get('teams', []):
+            tokens = self.normalize(team).split()
+            if tokens:
+                self.teams[' '.join(tokens)] = 'team:%s' % team
+                self.maxTeamTokens = max(self.maxTeamTokens, len(tokens))
+
+        self.competitions = {self.normalize(
+            name): 'competition:%s' % name for name in rules.get('competitions', [])}
+        self.teamIds = {str(teamId): 'teamId:%s' %
+                        teamId for teamId in rules.get('teamIds', [])}
+        self.competitionIds = {str(competitionId): 'competitionId:%s' %
+                               competitionId for competitionId in rules.get('competitionIds', [])}
+        self.eventIds = {str(eventId): 'eventId:%s' %
+                         eventId for eventId in rules.get('eventIds', [])}
+
+        self.patterns = rules.get('patterns', [])
+        self.patternRegex = None
+        if self.patterns:
+            self.patternRegex = re.compile('|'.join('(?P<p%d>%s)' % (i, pattern)
+                                                    for i, pattern in enumerate(self.patterns)), re.IGNORECASE)
+
+    def reloadIfChanged(self):
+        if self.path is None:
+            return False
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+
+        if mtime == self.mtime:
+            return False
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as rulesFile:
+                fileRules = json.load(rulesFile)
+        except (OSError, ValueError) as e:
+            # keep the last good rules
+            log.error('EXCLUSION_RULES_RELOAD_FAILED',
+                      path=self.path, error=str(e))
+            return False
+
+        rules = {key: list(value) for key, value in self.baseRules.items()}
+        for key, value in fileRules.items():
+            rules[key] = rules.get(key, []) + list(value)
+
+        self.compile(rules)
+        self.mtime = mtime
+        log.info('EXCLUSION_RULES_LOADED', path=self.path, teams=len(self.teamSubstrings) + len(self.teams),
+                 competitions=len(self.competitions) + len(self.competitionIds), patterns=len(self.patterns))
+        return True
+
+    def match(self, eventName=None, eventId=None, competitionId=None, competitionName=None, teamIds=()):
+        # returns the rule that excludes the event, or None
+        if eventId is not None and str(eventId) in self.eventIds:
+            return self.eventIds[str(eventId)]
+
+        if competitionId is not None and str(competitionId) in self.competitionIds:
+            return self.competitionIds[str(competitionId)]
+
+        if competitionName is not None:
+            rule = self.competitions.get(self.normalize(competitionName))
+            if rule is not None:
+                return rule
+
+        for teamId in teamIds:
+            rule = self.teamIds.get(str(teamId))
+            if rule is not None:
+                return rule
+
+        if eventName is not None:
+            name = self.normalize(eventName)
+            if self.teamSubstringRegex is not None:
+                teamMatch = self.teamSubstringRegex.search(name)
+                if teamMatch is not None:
+                    return self.teamSubstrings[teamMatch.group(0)]
+
+            tokens = name.split()
+            for start in range(len(tokens)):
+                for end in range(start + 1, min(start + self.maxTeamTokens, len(tokens)) + 1):
+                    rule = self.teams.get(' '.join(tokens[start:end]))
+                    if rule is not None:
+                        return rule
+
+            if self.patternRegex is not None:
+                patternMatch = self.patternRegex.search(eventName)
+                if patternMatch is not None:
+                    group = next(name for name, value in patternMatch.groupdict().items()
+                                 if value is not None and name.startswith('p'))
+                    return 'pattern:%s' % self.patterns[int(group[1:])]
+
+        return None
+
+# ----------------------------------
+# HELPERS
+# ----------------------------------
+    def normalize(self, name):
+        name = unicodedata.normalize('NFKD', name)
+        name = ''.join(c for c in name if not unicodedata.combining(c))
+        return re.sub(r'[\W_]+', ' ', name.casefold()).strip()
@@ -0,0 +1,104 @@
+import time
+
+from eventlog import log
+from metrics import metrics
+
+# ----------------------------------
+# TICK BUDGET
+# ----------------------------------
+
+
+class TickBudget:
+    '''
+    Time left in the current tick. Tasks ask allows(unit) before each unit of
+    optional work; a unit is allowed while the remaining time covers its
+    estimated cost (a moving average of earlier units of that name, measured by
+    the unit(...) context). Work that is not allowed is the task's to defer.
+    '''
+
+    def __init__(self, executor, deadline):
+        self.executor = executor
+        self.deadline = deadline
+
+    def remaining(self):
+        return self.deadline - self.executor.clock()
+
+    def allows(self, unit):
+        return self.remaining() > self.executor.estimates.get(unit, 0.0)
+
+    def unit(self, unit):
+        return UnitTimer(self.executor, unit)
+
+    def defer(self, task, count=1):
+        self.executor.deferred[task] = self.executor.deferred.get(
+            task, 0) + count
+
+
+class UnitTimer:
+    __slots__ = ('executor', 'unit', 'startedAt')
+
+    def __init__(self, executor, unit):
+        self.executor = executor
+        self.unit = unit
+
+    def __enter__(self):
+        self.startedAt = self.executor.clock()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.executor.observe(
+            self.unit, self.executor.clock() - self.startedAt)
+        return False
+
+# ----------------------------------
+# TICK EXECUTOR
+# ----------------------------------
+
+
+class TickExecutor:
+    '''
+    Runs a tick's tasks in priority order against a time budget. Every task is
+    started (a task with nothing affordable returns at once), so the ones first in
+    the list - open position management - always run; later tasks shed their
+    units through the TickBudget and count what they deferred to the next tick.
+    Each run reports the budget used and the deferred counts per task.
+    '''
+
+    def __init__(self, budgetSeconds, clock=time.monotonic, smoothing=0.3):
+        self.budgetSeconds = budgetSeconds
+        self.clock = clock
+        self.smoothing = smoothing
+        self.estimates = {}
+        self.deferred = {}
+        self.lastReport = None
+
+    def observe(self, unit, seconds):
+        estimate = self.estimates.get(unit)
+        self.estimates[unit] = seconds if estimate is None else estimate + \
+            self.smoothing * (seconds - estimate)
+
+    def run(self, tasks, startedAt=None):
+        # tasks: [(name, fn(budget))] highest priority first
+        startedAt = self.clock() if startedAt is None else startedAt
+        budget = TickBudget(self, startedAt + self.budgetSeconds)
+        self.deferred = {}
+        durations = {}
+
+        for name, task in tasks:
+            taskStartedAt = self.clock()
+            task(budget)
+            durations[name] = round(self.clock() - taskStartedAt, 4)
+
+        used = (self.clock() - startedAt) / self.budgetSeconds
+        metrics.observe('tick_budget_used_ratio', used)
+        for name, count in self.deferred.items():
+            metrics.inc('tick_deferred_total', (('task', name),), count)
+        if used > 1.0:
+            metrics.inc('tick_budget_overruns_total')
+
+        self.lastReport = {'budgetUsed': round(used, 3), 'deferred': dict(self.deferred),
+                           'taskSeconds': durations}
+        if self.deferred:
+            log.info('TICK_DEFERRED', budgetUsed=round(used, 3),
+                     deferred=self.deferred)
+        return self.lastReport
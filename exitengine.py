@@ -0,0 +1,186 @@
+import array
+import operator
+
+# ----------------------------------
+# ACTIONS
+# ----------------------------------
+
+CANCEL = 'CANCEL'
+REPRICE = 'REPRICE'
+HEDGE = 'HEDGE'
+CLOSE = 'CLOSE'
+
+
+class ExitAction:
+    # one step of a market's exit; a market's actions run in order, a failed CANCEL ends them
+    __slots__ = ('kind', 'marketId', 'selectionId', 'side',
+                 'stake', 'price', 'profitPercent', 'elapsed', 'laySlope', 'customerRef')
+
+    def __init__(self, kind, marketId, selectionId=None, side=None, stake=None, price=None, profitPercent=None, elapsed=None, laySlope=None):
+        self.kind = kind
+        self.marketId = marketId
+        self.selectionId = selectionId
+        self.side = side
+        self.stake = stake
+        self.price = price
+        self.profitPercent = profitPercent
+        self.elapsed = elapsed
+        self.laySlope = laySlope
+        # set by whoever submits the order
+        self.customerRef = None
+
+    def __repr__(self):
+        return 'ExitAction(%s, %s)' % (self.kind, self.marketId)
+
+# ----------------------------------
+# EXIT ENGINE
+# ----------------------------------
+
+
+class ExitEngine:
+    '''
+    Stop loss stepping for all positions at once. Each position past its stop
+    loss deadline has a row in preallocated columns - matched price, matched
+    size, hedge side and deadline (epoch seconds) - kept dense by moving the last
+    row into a removed one. decide() reads the rows of the positions due this
+    tick in one pass over the columns and returns their actions:
+
+    - the profit target steps back stepPercent every stepSeconds past the
+      deadline, down to 1.0 and then straight to floorPercent;
+    - with a PriceHistory, a hedge whose best lay has risen at least
+      adverseSlopePerMinute over the last trendSeconds, in at least
+      minTrendTicks price changes, is stepped one step further - the price it
+      needs is running away, waiting for the next step costs more;
+    - the hedge is re-sized to matchedSize * profit (at least minStake) and
+      re-priced to keep the original total, snapped to the Betfair ladder;
+    - REPRICE (fill or kill) while above minStake, else HEDGE (persistent) and
+      CLOSE - the position is left to that last order;
+    - CANCEL first only when the market has an unmatched order to cancel.
+
+    Only lay hedges step, as before. Ladder snaps are memoised, the same few
+    prices recur tick after tick.
+    '''
+
+    def __init__(self, targetProfitPercent, applyOddsLadder, minStake=2.0, stepSeconds=10, stepPercent=0.01, floorPercent=0.50,
+                 trendSeconds=60, adverseSlopePerMinute=0.05, minTrendTicks=2, capacity=64):
+        self.targetProfitPercent = targetProfitPercent
+        self.applyOddsLadder = applyOddsLadder
+        self.minStake = minStake
+        self.stepSeconds = stepSeconds
+        # divided rather than multiplied, so the steps round as they always have
+        self.stepDivisor = round(1 / stepPercent)
+        self.floorPercent = floorPercent
+        self.trendSeconds = trendSeconds
+        self.adverseSlopePerMinute = adverseSlopePerMinute
+        self.minTrendTicks = minTrendTicks
+
+        self.rows = {}
+        self.marketIds = []
+        self.selectionIds = []
+        self.matchedPrice = array.array('d', bytes(8 * capacity))
+        self.matchedSize = array.array('d', bytes(8 * capacity))
+        self.stopLossAt = array.array('d', bytes(8 * capacity))
+        self.layHedge = array.array('b', bytes(capacity))
+        self.ladder = {}
+
+    def __len__(self):
+        return len(self.marketIds)
+
+    def add(self, position):
+        row = len(self.marketIds)
+        if row == len(self.matchedPrice):
+            # double the columns
+            for column in (self.matchedPrice, self.matchedSize, self.stopLossAt, self.layHedge):
+                column.extend(column)
+
+        # a position without its matched bet recorded has nothing to re-size, it is never stepped
+        matched = position.matchedPrice is not None and position.matchedSize is not None
+        self.rows[position.marketId] = row
+        self.marketIds.append(position.marketId)
+        self.selectionIds.append(position.selectionId)
+        self.matchedPrice[row] = position.matchedPrice if matched else 0.0
+        self.matchedSize[row] = position.matchedSize if matched else 0.0
+        self.stopLossAt[row] = position.stopLossAt.timestamp()
+        self.layHedge[row] = 1 if matched and position.hedgeSide == 'LAY' else 0
+        return row
+
+    def remove(self, marketId):
+        row = self.rows.pop(marketId, None)
+        if row is None:
+            return
+
+        last = len(self.marketIds) - 1
+        if row != last:
+            movedId = self.marketIds[last]
+            self.rows[movedId] = row
+            self.marketIds[row] = movedId
+            self.selectionIds[row] = self.selectionIds[last]
+            for column in (self.matchedPrice, self.matchedSize, self.stopLossAt, self.layHedge):
+                column[row] = column[last]
+        self.marketIds.pop()
+        self.selectionIds.pop()
+
+    def decide(self, positions, now, resting=(), priceHistory=None):
+        '''
+        Actions for positions (all stepping their stop loss) at epoch seconds now;
+        resting holds the marketIds with an unmatched order to cancel first, and
+        priceHistory (optional) the hedge selections' recent prices.
+        '''
+        rows = [self.rows[position.marketId] if position.marketId in self.rows else self.add(position)
+                for position in positions]
+        rows = [row for row in rows if self.layHedge[row]]
+        if rows == []:
+            return []
+
+        pick = operator.itemgetter(*rows)
+        prices = pick(self.matchedPrice)
+        sizes = pick(self.matchedSize)
+        deadlines = pick(self.stopLossAt)
+        if len(rows) == 1:
+            prices, sizes, deadlines = (prices,), (sizes,), (deadlines,)
+
+        # whole seconds past the deadline within the day, as timedelta.seconds gives
+        elapsed = [int(now - deadline) % 86400 for deadline in deadlines]
+        slopes = [self.laySlope(priceHistory, row, now) for row in rows]
+        start = 1 + self.targetProfitPercent
+        steps = [round(seconds / self.stepSeconds, 0) + (1 if slope is not None and slope >= self.adverseSlopePerMinute else 0)
+                 for seconds, slope in zip(elapsed, slopes)]
+        profits = [round(start - step / self.stepDivisor, 2) for step in steps]
+        profits = [profit if profit >= 1.0 else self.floorPercent for profit in profits]
+        totals = list(map(round, map(operator.mul, sizes, prices), [2] * len(rows)))
+        stakes = [max(stake, self.minStake) for stake in map(
+            round, map(operator.mul, sizes, profits), [2] * len(rows))]
+        newPrices = [self.snap(total / stake)
+                     for total, stake in zip(totals, stakes)]
+
+        actions = []
+        for row, seconds, slope, profit, stake, price in zip(rows, elapsed, slopes, profits, stakes, newPrices):
+            marketId = self.marketIds[row]
+            if marketId in resting:
+                actions.append(ExitAction(CANCEL, marketId))
+            if stake == self.minStake:
+                actions.append(ExitAction(HEDGE, marketId, self.selectionIds[row], 'LAY', stake, price, profit, seconds, slope))
+                actions.append(ExitAction(CLOSE, marketId))
+            else:
+                actions.append(ExitAction(REPRICE, marketId, self.selectionIds[row], 'LAY', stake, price, profit, seconds, slope))
+        return actions
+
+    def laySlope(self, priceHistory, row, now):
+        # best lay change per minute over trendSeconds, None without enough price changes to call it a trend
+        history = priceHistory.get(self.marketIds[row], self.selectionIds[row]) if priceHistory is not None else None
+        if history is None:
+            return None
+        since = now - self.trendSeconds
+        if history.tickCount(since, 'lay') < self.minTrendTicks:
+            return None
+        slope = history.slope(since, 'lay')
+        return round(slope * 60, 4) if slope is not None else None
+
+    def snap(self, odds):
+        odds = round(odds, 2)
+        price = self.ladder.get(odds)
+        if price is None:
+            if len(self.ladder) >= 4096:
+                self.ladder = {}
+            price = self.ladder[odds] = self.applyOddsLadder(odds)
+        return price
@@ -0,0 +1,342 @@
+import argparse
+import concurrent.futures
+import datetime
+import gzip
+import json
+import os
+
+import requests
+
+from betfair import Betfair
+from betfair import BetfairSettings
+from codec import APINGError
+from codec import ClearedOrder
+from codec import CurrentOrder
+from daemon import OverUnderStrategy
+from eventlog import log
+from metrics import metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# columns taken from the journal: the record that placed the order (by its
+# customerOrderRef) over the order's market as a whole
+POSITION_COLUMNS = ('eventName', 'competitionName', 'marketName',
+                    'backPrice', 'hedgePrice', 'closeReason', 'journalEvent')
+
+# ----------------------------------
+# POOLED CLIENT
+# ----------------------------------
+
+
+class PooledBetfair(Betfair):
+    # keep-alive connections shared by the export workers instead of a TLS handshake per page
+
+    def __init__(self, settings, session):
+        Betfair.__init__(self, settings)
+        self.session = session
+
+    def post(self, url, body, timeout=None):
+        response = self.session.post(
+            url, data=body, headers=self.settings.headers, timeout=self.settings.timeoutSeconds if timeout is None else timeout)
+        response.raise_for_status()
+        return response.content
+
+    def postChunks(self, url, body, chunkSize=65536, timeout=None):
+        with self.session.post(url, data=body, headers=self.settings.headers, timeout=self.settings.timeoutSeconds if timeout is None else timeout, stream=True) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunkSize)
+
+
+def pooledSession(connections):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=2, pool_maxsize=connections)
+    session.mount('https://', adapter)
+    return session
+
+# ----------------------------------
+# COLUMN FILES
+# ----------------------------------
+
+
+def writeColumns(directory, name, columns):
+    '''
+    Writes one partition file: parquet (zstd) when pyarrow is installed, otherwise
+    gzip compressed JSON holding one list per column. The file is written beside
+    its final name and renamed, so a partition is either complete or absent.
+    '''
+    os.makedirs(directory, exist_ok=True)
+
+    if pyarrow is not None:
+        path = os.path.join(directory, name + '.parquet')
+        pyarrow.parquet.write_table(pyarrow.table(
+            columns), path + '.tmp', compression='zstd')
+    else:
+        path = os.path.join(directory, name + '.columns.json.gz')
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as columnFile:
+            json.dump(columns, columnFile, separators=(',', ':'))
+
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def readColumns(path):
+    if path.endswith('.parquet'):
+        return pyarrow.parquet.read_table(path).to_pydict()
+    with gzip.open(path, 'rt', encoding='utf-8') as columnFile:
+        return json.load(columnFile)
+
+
+def loadColumns(outputDir, dataset='cleared'):
+    # every day partition of a dataset concatenated into one {column: values}
+    columns = {}
+    datasetDir = os.path.join(outputDir, dataset)
+    if not os.path.isdir(datasetDir):
+        return columns
+
+    for partition in sorted(os.listdir(datasetDir)):
+        partitionDir = os.path.join(datasetDir, partition)
+        for name in sorted(os.listdir(partitionDir)):
+            if name.endswith('.tmp'):
+                continue
+            for column, values in readColumns(os.path.join(partitionDir, name)).items():
+                columns.setdefault(column, []).extend(values)
+    return columns
+
+
+def toColumns(records, slots, journal):
+    columns = dict((name, [getattr(record, name) for record in records])
+                   for name in slots)
+    joined = [journal.lookup(record) for record in records]
+    for name in POSITION_COLUMNS:
+        columns[name] = [fields.get(name) for fields in joined]
+    return columns
+
+# ----------------------------------
+# JOURNAL JOIN
+# ----------------------------------
+
+
+class JournalJoin:
+    '''
+    The daemon's journals, read for the export: position details by marketId
+    (later records overwrite earlier fields, a CLOSED record contributes its
+    reason as closeReason) and, for each record that placed orders (OPENED,
+    REPRICED, HEDGE_PLACED), the position as it stood then by its customerRef.
+    Each journal's .history.1 and .history are read first, oldest first.
+    '''
+
+    def __init__(self):
+        self.positions = {}
+        self.orders = {}
+
+    @classmethod
+    def read(cls, journalPaths):
+        journal = cls()
+        for journalPath in journalPaths:
+            for path in (journalPath + '.history.1', journalPath + '.history', journalPath):
+                if os.path.exists(path):
+                    journal.readFile(path)
+        return journal
+
+    def readFile(self, path):
+        with open(path, 'r', encoding='utf-8') as journalFile:
+            for line in journalFile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                position = self.positions.setdefault(record['marketId'], {})
+                if record.get('event') == 'CLOSED':
+                    position['closeReason'] = record.get('reason')
+                    continue
+                position.update(record)
+                if record.get('customerRef') is not None:
+                    self.orders[record['customerRef']] = dict(
+                        position, journalEvent=record['event'])
+
+    def lookup(self, order):
+        # the order's own record over its market, the market alone for orders placed elsewhere
+        fields = dict(self.positions.get(order.marketId, {}))
+        placed = self.orders.get(order.customerOrderRef)
+        if placed is not None:
+            closeReason = fields.get('closeReason')
+            fields.update(placed)
+            fields['closeReason'] = closeReason
+        return fields
+
+# ----------------------------------
+# EXPORTER
+# ----------------------------------
+
+
+class ClearedOrderExporter:
+    '''
+    Exports settled orders into outputDir/cleared/settled_date=YYYY-MM-DD, one
+    listClearedOrders range per day fetched by a pool of workers, each day written
+    as soon as all its pages are in. state.json records the last day exported
+    in full (today is exported but never marked complete), so a rerun resumes
+    from the day after it and rewrites any partial day. Orders still working
+    are snapshotted into outputDir/current on each run.
+    '''
+
+    def __init__(self, betfair, outputDir, journal, workers=4):
+        self.betfair = betfair
+        self.outputDir = outputDir
+        self.journal = journal
+        self.workers = workers
+        self.statePath = os.path.join(outputDir, 'state.json')
+
+    def readState(self):
+        if not os.path.exists(self.statePath):
+            return {}
+        with open(self.statePath, 'r', encoding='utf-8') as stateFile:
+            return json.load(stateFile)
+
+    def writeState(self, state):
+        with open(self.statePath + '.tmp', 'w', encoding='utf-8') as stateFile:
+            json.dump(state, stateFile)
+        os.replace(self.statePath + '.tmp', self.statePath)
+
+    def run(self, since, today=None):
+        today = today or datetime.datetime.utcnow().date()
+        os.makedirs(self.outputDir, exist_ok=True)
+        state = self.readState()
+
+        startDay = since
+        if state.get('completedThrough'):
+            startDay = max(since, datetime.date.fromisoformat(
+                state['completedThrough']) + datetime.timedelta(days=1))
+
+        days = [startDay + datetime.timedelta(days=i)
+                for i in range((today - startDay).days + 1)]
+        log.info('EXPORT_START', fromDay=str(startDay),
+                 days=len(days), workers=self.workers)
+        if pyarrow is None:
+            log.warning('EXPORT_NO_PYARROW',
+                        fallback='gzip compressed JSON columns (.columns.json.gz)')
+
+        exported = 0
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            # results come back in day order, so completedThrough only moves over whole days
+            for day, count in zip(days, executor.map(self.exportDay, days)):
+                exported = exported + count
+                if day < today:
+                    state['completedThrough'] = str(day)
+                    self.writeState(state)
+
+        self.exportCurrentOrders()
+        log.info('EXPORT_DONE', orders=exported,
+                 completedThrough=state.get('completedThrough'))
+        return exported
+
+    def exportDay(self, day):
+        fromDateTime = day.strftime('%Y-%m-%dT00:00:00Z')
+        toDateTime = (day + datetime.timedelta(days=1)
+                      ).strftime('%Y-%m-%dT00:00:00Z')
+
+        # the range end is inclusive - drop orders settled on the next day's first second
+        orders = [order for order in self.betfair.iterClearedOrders(fromDateTime, toDateTime)
+                  if order.settledDate is not None and order.settledDate[:10] == str(day)]
+
+        metrics.inc('export_orders_total', value=len(orders))
+        if orders:
+            writeColumns(os.path.join(self.outputDir, 'cleared', 'settled_date=%s' % day), 'orders',
+                         toColumns(orders, ClearedOrder.__slots__, self.journal))
+        return len(orders)
+
+    def exportCurrentOrders(self):
+        try:
+            orders = list(self.betfair.streamCurrentOrders())
+        except APINGError as e:
+            self.betfair.logApingError(e)
+            return
+
+        snapshotDay = 'snapshot_date=%s' % datetime.datetime.utcnow().date()
+        writeColumns(os.path.join(self.outputDir, 'current', snapshotDay), 'orders',
+                     toColumns(orders, CurrentOrder.__slots__, self.journal))
+
+# ----------------------------------
+# SUMMARY
+# ----------------------------------
+
+
+def summarise(columns, key):
+    # orders, winners and profit grouped by key(row)
+    groups = {}
+    names = list(columns.keys())
+    for values in zip(*(columns[name] for name in names)):
+        row = dict(zip(names, values))
+        group = groups.setdefault(
+            key(row), {'orders': 0, 'profit': 0.0, 'won': 0})
+        group['orders'] = group['orders'] + 1
+        group['profit'] = round(group['profit'] + (row['profit'] or 0.0), 2)
+        group['won'] = group['won'] + (1 if row['betOutcome'] == 'WON' else 0)
+    return groups
+
+
+def entryPriceBand(row):
+    price = row['backPrice'] or (
+        row['priceMatched'] if row['side'] == 'BACK' else None)
+    if price is None:
+        return None
+    return '%.1f-%.1f' % (int(price * 5) / 5.0, int(price * 5) / 5.0 + 0.2)
+
+# ----------------------------------
+# MAIN
+# ----------------------------------
+
+
+class ExportSession:
+    # certificate login, as the strategy does
+    refreshSessionToken = OverUnderStrategy.refreshSessionToken
+
+    def __init__(self, betfairSettings):
+        self.betfairSettings = betfairSettings
+        self.sessionTokenExpiresAt = datetime.datetime.now()
+        self.sessionTokenValidForMinutes = 10
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Exports settled and current orders to day partitioned column files, resuming from the last full day. '
+                    'Files are parquet (zstd) when pyarrow is installed, otherwise gzip compressed JSON columns (.columns.json.gz).')
+    parser.add_argument('--output-dir', default='exports')
+    parser.add_argument('--days', type=int, default=90,
+                        help='history to export on the first run (Betfair keeps 90 days)')
+    parser.add_argument('--journal', action='append', default=None,
+                        help='position journal(s) to join on customerOrderRef, else marketId (default positions.journal)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--summary', action='store_true',
+                        help='print profit by market type, competition and entry price from the export and exit')
+    args = parser.parse_args()
+
+    if args.summary:
+        columns = loadColumns(args.output_dir)
+        if columns:
+            for title, key in (('market type', lambda row: row['marketType']), ('competition', lambda row: row['competitionName']),
+                               ('entry price', entryPriceBand)):
+                print('# profit by %s' % title)
+                for group, totals in sorted(summarise(columns, key).items(), key=lambda item: str(item[0])):
+                    print('%-40s orders=%d won=%d profit=%.2f' %
+                          (group, totals['orders'], totals['won'], totals['profit']))
+        log.close()
+        raise SystemExit(0)
+
+    betfairSettings = BetfairSettings(os.environ.get("BETFAIR_LIVE_KEY"), None, "https://api.betfair.com/exchange/betting/json-rpc/v1",
+                                      "https://api.betfair.com/exchange/account/json-rpc/v1")
+    ExportSession(betfairSettings).refreshSessionToken()
+
+    session = pooledSession(args.workers)
+    exporter = ClearedOrderExporter(PooledBetfair(betfairSettings, session), args.output_dir,
+                                    JournalJoin.read(args.journal or ['positions.journal']), args.workers)
+    exporter.run(datetime.datetime.utcnow().date() -
+                 datetime.timedelta(days=args.days))
+
+    session.close()
+    log.close()
@@ -0,0 +1,465 @@
+import datetime
+import json
+import math
+import random
+import threading
+import time
+
+from multiprocessing.managers import BaseManager
+
+from betfair import Betfair
+from betfair import BetfairSettings
+
+from daemon import StrategySettings
+from daemon import OverUnderStrategy
+
+from ledger import marketLiability
+
+UNDER_SELECTION_ID = 47972
+OVER_SELECTION_ID = 47973
+
+# ----------------------------------
+# FAKE EXCHANGE
+# ----------------------------------
+
+
+class FakeExchange:
+    '''
+    In-process stand-in for the API-NG betting and accounts endpoints, used by the
+    benchmark and load test harnesses. It synthesises events with an Over/Under 2.5
+    market, a Match Odds market and filler markets, prices each market from
+    pricePath(market, secondsSinceKickOff) and matches orders against those prices:
+    FOK orders fill or lapse at placement, resting orders fill once the price
+    reaches them. latency(operation) seconds are slept per call when given,
+    outside the lock that serialises calls from concurrent clients; a call
+    slower than the client's timeout raises TimeoutError once it has waited
+    that long. failure(url, operation), when given, returns the error a call
+    raises (an HTTPError for an outage) or None.
+    '''
+
+    def __init__(self, events=20, marketsPerEvent=30, kickOffSpreadMinutes=10, balance=1000.0, seed=1, pricePath=None, latency=None, clock=time.time, failure=None):
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.pricePath = pricePath if pricePath is not None else self.driftingPricePath
+        self.latency = latency
+        self.failure = failure
+        self.balance = balance
+
+        self.events = []
+        self.eventCount = 0
+        self.catalogues = {}
+        self.markets = {}
+        self.orders = {}
+        self.clearedOrders = []
+        self.calls = {}
+        self.nextBetId = 100000000
+        self.lock = threading.Lock()
+
+        self.addEvents(events, marketsPerEvent, kickOffSpreadMinutes)
+
+    def addEvents(self, count, marketsPerEvent, kickOffSpreadMinutes):
+        now = self.clock()
+
+        for i in range(count):
+            eventIndex = self.eventCount
+            self.eventCount = self.eventCount + 1
+            eventId = str(30000000 + eventIndex)
+            kickOff = now + self.random.uniform(0, kickOffSpreadMinutes * 60)
+            event = {'id': eventId, 'name': 'Home %d v Away %d' % (eventIndex, eventIndex), 'countryCode': 'GB',
+                     'timezone': 'GMT', 'openDate': self.formatDateTime(kickOff)}
+            self.events.append({'event': event, 'marketCount': marketsPerEvent})
+
+            markets = []
+            for m in range(marketsPerEvent):
+                marketId = '1.%d' % (170000000 + eventIndex * 1000 + m)
+                if m == 0:
+                    marketName = 'Over/Under 2.5 Goals'
+                    runners = [(UNDER_SELECTION_ID, 'Under 2.5 Goals'), (OVER_SELECTION_ID, 'Over 2.5 Goals')]
+                elif m == 1:
+                    marketName = 'Match Odds'
+                    runners = [(1000 + eventIndex * 2, 'Home %d' % eventIndex),
+                               (1001 + eventIndex * 2, 'Away %d' % eventIndex), (58805, 'The Draw')]
+                else:
+                    marketName = 'Filler Market %d' % m
+                    runners = [(2000000 + m * 10 + r, 'Runner %d' % r) for r in range(3)]
+
+                market = {'marketId': marketId, 'marketName': marketName, 'marketStartTime': event['openDate'],
+                          'totalMatched': round(self.random.uniform(2000, 50000), 2),
+                          'competition': {'id': '10932509', 'name': 'English Premier League'},
+                          'runners': [{'selectionId': selectionId, 'runnerName': runnerName, 'handicap': 0.0, 'sortPriority': r + 1,
+                                       'metadata': {'runnerId': str(selectionId)}} for r, (selectionId, runnerName) in enumerate(runners)]}
+                markets.append(market)
+                self.markets[marketId] = {'kickOff': kickOff, 'basePrice': round(self.random.uniform(1.7, 2.6), 2), 'phase': self.random.uniform(0, 6.28),
+                                          'selectionIds': [selectionId for selectionId, runnerName in runners], 'version': 1}
+
+            self.catalogues[eventId] = markets
+
+    def settleEvents(self, keep):
+        # all but the newest keep events finish: their markets and orders go away
+        split = max(len(self.events) - keep, 0)
+        settled, self.events = self.events[:split], self.events[split:]
+        for event in settled:
+            for market in self.catalogues.pop(event['event']['id']):
+                del self.markets[market['marketId']]
+                self.orders.pop(market['marketId'], None)
+        return len(settled)
+
+    def addOpenPositions(self, count, placedMinutesAgo=5.0, backStake=2.0):
+        # back matched and hedge lay resting on the first count Over/Under markets
+        marketIds = [markets[0]['marketId']
+                     for markets in self.catalogues.values()][:count]
+        placedAt = self.clock() - placedMinutesAgo * 60
+
+        for marketId in marketIds:
+            backPrice = self.markets[marketId]['basePrice']
+            hedgeStake = round(backStake * 1.16, 2)
+            self.addOrder(marketId, UNDER_SELECTION_ID, 'BACK', backStake,
+                          backPrice, sizeMatched=backStake, placedAt=placedAt)
+            self.addOrder(marketId, UNDER_SELECTION_ID, 'LAY', hedgeStake, ladderPrice(
+                backPrice * backStake / hedgeStake), placedAt=placedAt)
+
+        return marketIds
+
+    def handle(self, url, body, timeout=None):
+        request = json.loads(body)
+        operation = request['method'].split('/')[-1]
+
+        if self.latency is not None:
+            seconds = self.latency(operation)
+            if timeout is not None and seconds > timeout:
+                time.sleep(timeout)
+                raise TimeoutError('timed out')
+            time.sleep(seconds)
+
+        if self.failure is not None:
+            error = self.failure(url, operation)
+            if error is not None:
+                raise error
+
+        params = request.get('params', {})
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            result = getattr(self, operation)(params)
+        return json.dumps({'jsonrpc': '2.0', 'result': result, 'id': request.get('id', 1)}).encode('utf-8')
+
+    def resetCalls(self):
+        calls = self.calls
+        self.calls = {}
+        return calls
+
+    def addClearedOrders(self, count, days=30, customerRefs=None):
+        # settled back/lay pairs on Over/Under markets spread over the last days, settledDate ascending
+        now = self.clock()
+        for i in range(count):
+            settledAt = now - days * 86400 * (count - i) / float(count)
+            marketId = '1.%d' % (160000000 + i)
+            customerRef = customerRefs[i] if customerRefs is not None else '%032x' % self.random.getrandbits(128)
+            backPrice = round(self.random.uniform(1.7, 2.6), 2)
+            won = self.random.random() < 0.5
+            for side, price, size in (('BACK', backPrice, 2.0), ('LAY', ladderPrice(backPrice * 2.0 / 2.32), 2.32)):
+                profit = (size * (price - 1.0) if won else -size) if side == 'BACK' else (-size * (price - 1.0) if won else size)
+                self.nextBetId = self.nextBetId + 1
+                self.clearedOrders.append({'eventTypeId': '1', 'eventId': str(29000000 + i), 'marketId': marketId,
+                                           'selectionId': UNDER_SELECTION_ID, 'handicap': 0.0, 'betId': str(self.nextBetId),
+                                           'placedDate': self.formatDateTime(settledAt - 7200), 'persistenceType': 'PERSIST',
+                                           'orderType': 'LIMIT', 'side': side, 'betOutcome': 'WON' if profit > 0 else 'LOST',
+                                           'priceRequested': price, 'settledDate': self.formatDateTime(settledAt),
+                                           'lastMatchedDate': self.formatDateTime(settledAt - 7000), 'betCount': 1,
+                                           'priceMatched': price, 'priceReduced': False, 'sizeSettled': size,
+                                           'profit': round(profit, 2), 'customerOrderRef': customerRef,
+                                           'itemDescription': {'eventTypeDesc': 'Soccer', 'eventDesc': 'Home %d v Away %d' % (i, i),
+                                                               'marketDesc': 'Over/Under 2.5 Goals', 'marketType': 'OVER_UNDER_25',
+                                                               'marketStartTime': self.formatDateTime(settledAt - 7200),
+                                                               'runnerDesc': 'Under 2.5 Goals', 'numberOfWinners': 1}})
+
+# ----------------------------------
+# OPERATIONS
+# ----------------------------------
+    def listEvents(self, params):
+        marketStartTime = params['filter'].get('marketStartTime', {})
+        fromEpoch = self.parseDateTime(marketStartTime.get('from'), 0)
+        toEpoch = self.parseDateTime(marketStartTime.get('to'), float('inf'))
+        return [event for event in self.events
+                if fromEpoch <= self.markets[self.catalogues[event['event']['id']][0]['marketId']]['kickOff'] <= toEpoch]
+
+    def listMarketCatalogue(self, params):
+        eventIds = params['filter'].get('eventIds')
+        if eventIds is None:
+            eventIds = list(self.catalogues.keys())
+
+        markets = []
+        for eventId in eventIds:
+            markets.extend(self.catalogues.get(eventId, []))
+        return markets[:int(params.get('maxResults', 1000))]
+
+    def listMarketBook(self, params):
+        return [self.marketBook(marketId) for marketId in params['marketIds'] if marketId in self.markets]
+
+    def listCurrentOrders(self, params):
+        marketIds = params.get('marketIds')
+        if marketIds is None:
+            marketIds = list(self.orders.keys())
+
+        currentOrders = []
+        for marketId in marketIds:
+            self.matchRestingOrders(marketId)
+            currentOrders.extend(self.orders.get(marketId, []))
+        return {'currentOrders': currentOrders, 'moreAvailable': False}
+
+    def listClearedOrders(self, params):
+        settledDateRange = params.get('settledDateRange', {})
+        fromEpoch = self.parseDateTime(settledDateRange.get('from'), 0)
+        toEpoch = self.parseDateTime(settledDateRange.get('to'), float('inf'))
+        clearedOrders = [order for order in self.clearedOrders
+                         if fromEpoch <= self.parseDateTime(order['settledDate'][:19] + 'Z', 0) < toEpoch]
+
+        fromRecord = params.get('fromRecord', 0)
+        toRecord = fromRecord + min(params.get('recordCount', 1000), 1000)
+        return {'clearedOrders': clearedOrders[fromRecord:toRecord], 'moreAvailable': toRecord < len(clearedOrders)}
+
+    def placeOrders(self, params):
+        marketId = params['marketId']
+        reports = []
+
+        for instruction in params['instructions']:
+            limitOrder = instruction['limitOrder']
+            side = instruction['side']
+            price = float(limitOrder['price'])
+            size = float(limitOrder['size'])
+            fillOrKill = limitOrder.get('timeInForce') == 'FILL_OR_KILL'
+
+            bestBack, bestLay = self.bestPrices(marketId)
+            matchable = bestBack >= price if side == 'BACK' else bestLay <= price
+
+            if fillOrKill and not matchable:
+                reports.append({'status': 'SUCCESS', 'orderStatus': 'EXPIRED', 'sizeMatched': 0.0,
+                                'instruction': instruction})
+                continue
+
+            order = self.addOrder(marketId, int(instruction['selectionId']), side, size, price,
+                                  sizeMatched=size if matchable else 0.0, customerOrderRef=instruction.get('customerOrderRef'))
+            reports.append({'status': 'SUCCESS', 'betId': order['betId'], 'orderStatus': order['status'],
+                            'sizeMatched': order['sizeMatched'], 'instruction': instruction})
+
+        return {'status': 'SUCCESS', 'marketId': marketId, 'customerRef': params.get('customerRef'), 'instructionReports': reports}
+
+    def cancelOrders(self, params):
+        marketId = params['marketId']
+        reports = []
+
+        for order in self.orders.get(marketId, []):
+            if order['sizeRemaining'] > 0.0:
+                reports.append({'status': 'SUCCESS', 'sizeCancelled': order['sizeRemaining'],
+                                'instruction': {'betId': order['betId']}})
+                order['sizeCancelled'] = order['sizeRemaining']
+                order['sizeRemaining'] = 0.0
+                order['status'] = 'EXECUTION_COMPLETE'
+
+        # fully cancelled orders drop out of listCurrentOrders
+        self.orders[marketId] = [order for order in self.orders.get(
+            marketId, []) if order['sizeMatched'] > 0.0]
+        if not self.orders[marketId]:
+            del self.orders[marketId]
+
+        return {'status': 'SUCCESS', 'marketId': marketId, 'instructionReports': reports}
+
+    def replaceOrders(self, params):
+        marketId = params['marketId']
+        reports = []
+
+        for instruction in params['instructions']:
+            for order in self.orders.get(marketId, []):
+                if order['betId'] == instruction['betId'] and order['sizeRemaining'] > 0.0:
+                    order['priceSize']['price'] = float(instruction['newPrice'])
+                    reports.append({'status': 'SUCCESS'})
+
+        return {'status': 'SUCCESS', 'marketId': marketId, 'instructionReports': reports}
+
+    def getAccountFunds(self, params):
+        exposure = 0.0
+        for orders in self.orders.values():
+            exposure += marketLiability([(order['selectionId'], order['side'], order['priceSize']['price'], order['sizeMatched'],
+                                          order['sizeRemaining']) for order in orders])
+        return {'availableToBetBalance': round(self.balance - exposure, 2), 'exposure': -round(exposure, 2),
+                'retainedCommission': 0.0, 'exposureLimit': -10000.0, 'discountRate': 0.0, 'pointsBalance': 0, 'wallet': 'UK'}
+
+# ----------------------------------
+# HELPERS
+# ----------------------------------
+    def addOrder(self, marketId, selectionId, side, size, price, sizeMatched=0.0, placedAt=None, customerOrderRef=None):
+        self.nextBetId = self.nextBetId + 1
+        order = {'betId': str(self.nextBetId), 'marketId': marketId, 'selectionId': selectionId, 'handicap': 0.0,
+                 'priceSize': {'price': price, 'size': size}, 'bspLiability': 0.0, 'side': side,
+                 'status': 'EXECUTION_COMPLETE' if sizeMatched >= size else 'EXECUTABLE', 'persistenceType': 'PERSIST',
+                 'orderType': 'LIMIT', 'placedDate': self.formatDateTime(self.clock() if placedAt is None else placedAt),
+                 'averagePriceMatched': price if sizeMatched else 0.0, 'sizeMatched': sizeMatched,
+                 'sizeRemaining': round(size - sizeMatched, 2), 'sizeLapsed': 0.0, 'sizeCancelled': 0.0, 'sizeVoided': 0.0,
+                 'regulatorCode': 'GIBRALTAR REGULATOR'}
+        if customerOrderRef is not None:
+            order['customerOrderRef'] = customerOrderRef
+        self.orders.setdefault(marketId, []).append(order)
+        self.markets[marketId]['version'] += 1
+        return order
+
+    def matchRestingOrders(self, marketId):
+        orders = self.orders.get(marketId)
+        if not orders:
+            return
+
+        bestBack, bestLay = self.bestPrices(marketId)
+        for order in orders:
+            if order['sizeRemaining'] == 0.0:
+                continue
+            price = order['priceSize']['price']
+            if (order['side'] == 'LAY' and bestLay <= price) or (order['side'] == 'BACK' and bestBack >= price):
+                order['sizeMatched'] = order['priceSize']['size']
+                order['sizeRemaining'] = 0.0
+                order['averagePriceMatched'] = price
+                order['status'] = 'EXECUTION_COMPLETE'
+
+    def bestPrices(self, marketId):
+        market = self.markets[marketId]
+        back = self.pricePath(market, self.clock() - market['kickOff'])
+        return back, ladderPrice(back * 1.02)
+
+    def marketBook(self, marketId):
+        market = self.markets[marketId]
+        inPlay = self.clock() >= market['kickOff']
+        back, lay = self.bestPrices(marketId)
+
+        runners = []
+        for r, selectionId in enumerate(market['selectionIds']):
+            runnerBack = back if r == 0 else ladderPrice(back / (back - 1.0) if back > 1.05 else 20.0)
+            runnerLay = lay if r == 0 else ladderPrice(runnerBack * 1.02)
+            runners.append({'selectionId': selectionId, 'handicap': 0.0, 'status': 'ACTIVE', 'totalMatched': 0.0,
+                            'lastPriceTraded': runnerBack,
+                            'ex': {'availableToBack': [{'price': runnerBack, 'size': 250.0}, {'price': ladderPrice(runnerBack * 0.98), 'size': 410.0},
+                                                       {'price': ladderPrice(runnerBack * 0.96), 'size': 900.0}],
+                                   'availableToLay': [{'price': runnerLay, 'size': 180.0}, {'price': ladderPrice(runnerLay * 1.02), 'size': 320.0},
+                                                      {'price': ladderPrice(runnerLay * 1.04), 'size': 700.0}],
+                                   'tradedVolume': []}})
+
+        return {'marketId': marketId, 'isMarketDataDelayed': False, 'status': 'OPEN', 'betDelay': 5 if inPlay else 0,
+                'bspReconciled': False, 'complete': True, 'inplay': inPlay, 'numberOfWinners': 1,
+                'numberOfRunners': len(runners), 'numberOfActiveRunners': len(runners),
+                'totalMatched': 0.0, 'totalAvailable': 0.0, 'crossMatching': True, 'runnersVoidable': False,
+                'version': market['version'], 'runners': runners}
+
+    def driftingPricePath(self, market, elapsed):
+        # Unders shorten steadily once in play, with a little noise
+        price = market['basePrice']
+        if elapsed > 0:
+            price = price * (1.0 - min(elapsed / 5400.0, 0.45))
+        price = price + 0.02 * math.sin(elapsed / 30.0 + market['phase'])
+        return ladderPrice(max(price, 1.01))
+
+    def parseDateTime(self, value, default):
+        if value is None:
+            return default
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def formatDateTime(self, epoch):
+        return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class GaussLatency:
+    # picklable latency(operation) for exchanges served to other processes
+
+    def __init__(self, mean, jitter, seed=1):
+        self.mean = mean
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def __call__(self, operation):
+        return max(0.0, self.random.gauss(self.mean, self.jitter))
+
+# ----------------------------------
+# SHARED EXCHANGE
+# ----------------------------------
+
+
+class SharedExchange:
+    '''
+    A FakeExchange served to several processes by FakeExchangeManager.
+    call(name, ...) runs any other FakeExchange method under the exchange's lock.
+    '''
+
+    def __init__(self, **options):
+        self.exchange = FakeExchange(**options)
+
+    def handle(self, url, body, timeout=None):
+        return self.exchange.handle(url, body, timeout)
+
+    def call(self, name, *args, **kwargs):
+        with self.exchange.lock:
+            return getattr(self.exchange, name)(*args, **kwargs)
+
+
+class FakeExchangeManager(BaseManager):
+    pass
+
+
+FakeExchangeManager.register('SharedExchange', SharedExchange)
+
+
+class SharedExchangeFactory:
+    # betfairFactory over a SharedExchange proxy; picklable, so it can be handed to worker processes
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+
+    def __call__(self, settings):
+        return FakeBetfair(settings, self.exchange)
+
+# ----------------------------------
+# FAKE CLIENT
+# ----------------------------------
+
+
+class FakeBetfair(Betfair):
+    def __init__(self, settings, exchange):
+        Betfair.__init__(self, settings)
+        self.exchange = exchange
+
+    def post(self, url, body, timeout=None):
+        return self.exchange.handle(url, body, timeout)
+
+    def postChunks(self, url, body, chunkSize=65536, timeout=None):
+        response = self.exchange.handle(url, body, timeout)
+        for i in range(0, len(response), chunkSize):
+            yield response[i:i + chunkSize]
+
+
+class OfflineStrategy(OverUnderStrategy):
+    # skips the certificate login so the strategy can run against a FakeExchange
+
+    def refreshSessionToken(self):
+        self.sessionTokenExpiresAt = datetime.datetime.now() + datetime.timedelta(days=365)
+        self.betfairSettings.sessionToken = 'offline'
+        self.betfairSettings.updateHeaders()
+
+
+def createOfflineStrategy(exchange, journalPath, strategySettings=None, strategyClass=OfflineStrategy, snapshotPath=None):
+    if strategySettings is None:
+        strategySettings = defaultStrategySettings()
+
+    betfairSettings = BetfairSettings(
+        'offline', None, 'https://betting.invalid/json-rpc/v1', 'https://accounts.invalid/json-rpc/v1')
+
+    return strategyClass(strategySettings, betfairSettings, journalPath=journalPath, exclusionRulesPath=None,
+                           betfairFactory=lambda settings: FakeBetfair(settings, exchange), snapshotPath=snapshotPath)
+
+
+def defaultStrategySettings(**overrides):
+    # mirrors the settings in daemon.py __main__
+    settings = {'eventLookAheadMinutes': 10, 'minBackStake': 2.0, 'minBackPrice': 1.6, 'maxBackPrice': 2.8,
+                'minLayPrice': 1.9, 'maxLayPrice': 2.2, 'placementThresholdMinutes': 2, 'targetProfitPercent': 0.16,
+                'stopLossThresholdMinutes': 16, 'stopLossPercent': 0.4, 'overroundThreshold': 105,
+                'matchedAmountThreshold': 1000, 'marketsToTrade': ['Over/Under 2.5 Goals'],
+                'excludedTeams': ['Man City', 'Fulham', 'Newcastle', 'Celtic', 'Rangers', 'Paris St-G', 'Bayern Munich']}
+    settings.update(overrides)
+    return StrategySettings(**settings)
+
+
+def ladderPrice(price):
+    return OverUnderStrategy.applyOddsLadder(None, max(min(price, 1000.0), 1.01))
@@ -0,0 +1,124 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+from metrics import metrics
+
+# read only operations - safe to send twice. Order operations are never hedged
+READ_OPERATIONS = frozenset(['listEventTypes', 'listEvents', 'listMarketCatalogue', 'listMarketBook',
+                             'listCurrentOrders', 'listClearedOrders', 'getAccountFunds'])
+
+# ----------------------------------
+# HEDGED READS
+# ----------------------------------
+
+
+class HedgedReads:
+    '''
+    Tail latency cut for idempotent reads. The request is sent on a worker
+    thread (its own connection); if no response has arrived by the operation's
+    hedge delay - the given percentile of its recent latencies, clamped to
+    [minDelaySeconds, maxDelaySeconds] - a duplicate is sent and whichever
+    returns first is used. The loser runs to completion (or its socket timeout)
+    in the background. Until minSamples latencies are known an operation is
+    sent once, without hedging.
+    '''
+
+    def __init__(self, percentile=0.95, minDelaySeconds=0.05, maxDelaySeconds=2.0, window=200, minSamples=20, workers=16):
+        self.percentile = percentile
+        self.minDelaySeconds = minDelaySeconds
+        self.maxDelaySeconds = maxDelaySeconds
+        self.window = window
+        self.minSamples = minSamples
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix='hedge')
+        self.latencies = {}
+        self.hedged = 0
+        self.wins = 0
+        self.lock = threading.Lock()
+
+    def hedgeDelay(self, operation):
+        with self.lock:
+            latencies = self.latencies.get(operation)
+            if latencies is None or len(latencies) < self.minSamples:
+                return None
+            ordered = sorted(latencies)
+        delay = ordered[min(len(ordered) - 1,
+                            int(self.percentile * len(ordered)))]
+        return min(self.maxDelaySeconds, max(self.minDelaySeconds, delay))
+
+    def record(self, operation, seconds):
+        with self.lock:
+            latencies = self.latencies.get(operation)
+            if latencies is None:
+                latencies = self.latencies[operation] = collections.deque(
+                    maxlen=self.window)
+            latencies.append(seconds)
+
+    def timed(self, key, send):
+        startedAt = time.perf_counter()
+        response = send()
+        self.record(key, time.perf_counter() - startedAt)
+        return response
+
+    def call(self, operation, send, key=None, discard=None):
+        '''
+        send() posts the request and returns the response, raising on transport
+        errors. key separates latency histories (defaults to the operation);
+        discard(response) releases a losing duplicate's response.
+        '''
+        if operation not in READ_OPERATIONS:
+            return send()
+
+        key = operation if key is None else key
+        delay = self.hedgeDelay(key)
+        primary = self.pool.submit(self.timed, key, send)
+        if delay is None:
+            return primary.result()
+
+        done, pending = concurrent.futures.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        labels = (('operation', operation),)
+        metrics.inc('betfair_hedged_requests_total', labels)
+        self.hedged = self.hedged + 1
+        duplicate = self.pool.submit(self.timed, key, send)
+        pending = set([primary, duplicate])
+
+        # first success wins; an error only counts once both have failed
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is duplicate:
+                        metrics.inc('betfair_hedge_wins_total', labels)
+                        self.wins = self.wins + 1
+                    if discard is not None:
+                        for loser in pending:
+                            loser.add_done_callback(
+                                lambda loser: loser.exception() is None and discard(loser.result()))
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stream(self, operation, openChunks):
+        '''
+        Hedges a streamed read up to its first chunk, the wait that carries the
+        latency; the winner's remaining chunks are read on the caller's thread and
+        the loser's response is closed.
+        '''
+        def firstChunk():
+            chunks = openChunks()
+            return next(chunks, b''), chunks
+
+        first, chunks = self.call(operation, firstChunk, operation + ':stream',
+                                  lambda response: response[1].close())
+        yield first
+        yield from chunks
+
+    def close(self):
+        self.pool.shutdown(wait=False)
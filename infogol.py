@@ -4,6 +4,8 @@ import re
 
 from datetime import datetime, timedelta
 
+from eventlog import log
+
 
 class Infogol:
 
@@ -36,14 +38,14 @@ class Infogol:
 
         matches = json.loads(response.text)
 
-        print('*** Match Day: ' + str(startDate.strftime("%Y-%m-%d") + ' ***'))
+        log.info('INFOGOL_MATCH_DAY', matchDay=startDate.strftime("%Y-%m-%d"))
 
         filteredBets = list()
 
         for match in matches:
             if match['VerdictConfidence'] >= minConfidence:
-                print(match['HomeTeam'], 'v', match['AwayTeam'], 'Verdict:',
-                      match['VerdictText'], 'Confidence', match['VerdictConfidence'])
+                log.info('INFOGOL_MATCH', homeTeam=match['HomeTeam'], awayTeam=match['AwayTeam'],
+                         verdict=match['VerdictText'], confidence=match['VerdictConfidence'])
                 filteredBets.append(match)
 
         return filteredBets
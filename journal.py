@@ -0,0 +1,141 @@
+import json
+import os
+import time
+
+# ----------------------------------
+# POSITION LIFECYCLE EVENTS
+# ----------------------------------
+
+OPENED = 'OPENED'
+BACK_MATCHED = 'BACK_MATCHED'
+HEDGE_PLACED = 'HEDGE_PLACED'
+REPRICED = 'REPRICED'
+CLOSED = 'CLOSED'
+
+# ----------------------------------
+# JOURNAL
+# ----------------------------------
+
+
+class PositionJournal:
+    '''
+    Append-only log of position lifecycle events, one compact JSON record per line.
+
+    Writes are flushed to the OS on every record but only fsync'd every syncEvery
+    records or syncIntervalSeconds, whichever comes first; the strategy also calls
+    sync() at the end of each iteration so at most one tick of events is exposed
+    to a crash. Anything lost that way is recovered by the startup reconcile.
+
+    compact() moves the records written since the last compaction to
+    <path>.history; once that passes historyMaxBytes it is rotated to
+    <path>.history.1, so two generations of history are kept.
+    '''
+
+    def __init__(self, path, syncEvery=16, syncIntervalSeconds=1.0, historyMaxBytes=64 * 1024 * 1024):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.syncIntervalSeconds = syncIntervalSeconds
+        self.historyMaxBytes = historyMaxBytes
+        self.pending = 0
+        self.lastSyncAt = time.monotonic()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def replay(self):
+        # returns {marketId: position} for every position not yet CLOSED
+        positions = {}
+
+        with open(self.path, 'r', encoding='utf-8') as journalFile:
+            for line in journalFile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write from a crash mid-append
+                    continue
+
+                self.apply(positions, record)
+
+        return positions
+
+    def apply(self, positions, record):
+        marketId = record['marketId']
+        event = record['event']
+
+        if event == CLOSED:
+            positions.pop(marketId, None)
+            return
+
+        position = positions.setdefault(marketId, {'marketId': marketId})
+        position.update(record)
+        position['state'] = event
+        del position['event']
+        position.pop('compacted', None)
+
+    def record(self, event, marketId, **fields):
+        record = {'ts': round(time.time(), 3),
+                  'event': event, 'marketId': marketId}
+        record.update(fields)
+
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.pending = self.pending + 1
+
+        if self.pending >= self.syncEvery or time.monotonic() - self.lastSyncAt >= self.syncIntervalSeconds:
+            self.sync()
+
+        return record
+
+    def sync(self):
+        if self.pending == 0:
+            return
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.lastSyncAt = time.monotonic()
+
+    def compact(self, positions):
+        '''
+        Rewrites the journal as one record per open position. Those records are
+        marked compacted: they restate records already moved to history, so the
+        next compaction moves only what was written after them.
+        '''
+        compactPath = self.path + '.compact'
+        historyPath = self.path + '.history'
+
+        self.file.flush()
+        if os.path.exists(historyPath) and os.path.getsize(historyPath) >= self.historyMaxBytes:
+            os.replace(historyPath, historyPath + '.1')
+
+        with open(self.path, 'rb') as journalFile, open(historyPath, 'ab') as historyFile:
+            for line in journalFile:
+                if not isCompacted(line):
+                    historyFile.write(line)
+            historyFile.flush()
+            os.fsync(historyFile.fileno())
+
+        with open(compactPath, 'w', encoding='utf-8') as compactFile:
+            for position in positions.values():
+                record = dict(position)
+                record['event'] = record.pop('state', OPENED)
+                record['compacted'] = True
+                compactFile.write(json.dumps(
+                    record, separators=(',', ':')) + '\n')
+            compactFile.flush()
+            os.fsync(compactFile.fileno())
+
+        self.file.close()
+        os.replace(compactPath, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.pending = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def isCompacted(line):
+    try:
+        return json.loads(line).get('compacted', False)
+    except ValueError:
+        # torn write from a crash mid-append
+        return False
@@ -0,0 +1,177 @@
+import threading
+import time
+
+from eventlog import log
+from metrics import metrics
+
+# ----------------------------------
+# FUNDS LEDGER
+# ----------------------------------
+
+
+class FundsLedger:
+    '''
+    In-process view of available balance and exposure, kept current from our own
+    order activity so stake sizing never waits on the accounts endpoint.
+
+    Each traded market's liability is the worst case loss over its orders
+    (unmatched orders count only against us, as Betfair does). A reconcile takes
+    getAccountFunds as the new baseline, reports the drift from the ledger and
+    drops markets closed since the last reconcile, whose settlement is now in the
+    account figure. Until then a closed market keeps its last liability, so the
+    ledger errs on the side of a smaller stake.
+    '''
+
+    def __init__(self, fetchFunds, reconcileIntervalSeconds=60.0, driftTolerance=0.01):
+        self.fetchFunds = fetchFunds
+        self.reconcileIntervalSeconds = reconcileIntervalSeconds
+        self.driftTolerance = driftTolerance
+
+        self.availableToBetBalance = None
+        self.liability = 0.0
+        self.marketLiabilities = {}
+        self.marketOrders = {}
+        self.closedMarketIds = set()
+        self.accountAvailable = None
+        self.liabilityAtReconcile = 0.0
+        self.reconciledAt = None
+        self.lastDrift = None
+
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def exposure(self):
+        # same sign convention as getAccountFunds
+        return -round(self.liability, 2)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name='ledger', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.reconcileIntervalSeconds):
+            try:
+                self.reconcile()
+            except Exception as e:
+                log.error('LEDGER_RECONCILE_FAILED', error=repr(e))
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def reconcile(self):
+        # the account figure is of the moment it was fetched: the ledger is read then, not after
+        with self.lock:
+            liabilityAtFetch = self.liability
+            availableAtFetch = self.availableToBetBalance
+            closedAtFetch = self.closedMarketIds
+            self.closedMarketIds = set()
+
+        accountFunds = self.fetchFunds()
+        if accountFunds is None:
+            with self.lock:
+                self.closedMarketIds |= closedAtFetch
+            metrics.inc('funds_reconciles_total', (('result', 'failed'),))
+            return False
+
+        with self.lock:
+            if availableAtFetch is not None:
+                drift = round(accountFunds.availableToBetBalance -
+                              availableAtFetch, 2)
+                self.lastDrift = drift
+                metrics.set('funds_ledger_drift', drift)
+                if abs(drift) >= self.driftTolerance:
+                    log.warning('FUNDS_DRIFT', drift=drift, ledgerAvailable=availableAtFetch,
+                                accountAvailable=accountFunds.availableToBetBalance,
+                                ledgerExposure=-round(liabilityAtFetch, 2), accountExposure=accountFunds.exposure)
+
+            # settled in the account figure; orders placed or filled during the fetch stay on top of it
+            for marketId in closedAtFetch:
+                liability = self.marketLiabilities.pop(marketId, 0.0)
+                self.liability -= liability
+                liabilityAtFetch -= liability
+                self.marketOrders.pop(marketId, None)
+
+            self.accountAvailable = accountFunds.availableToBetBalance
+            self.liabilityAtReconcile = liabilityAtFetch
+            self.availableToBetBalance = round(
+                self.accountAvailable - (self.liability - self.liabilityAtReconcile), 2)
+            self.reconciledAt = time.time()
+
+        metrics.inc('funds_reconciles_total', (('result', 'ok'),))
+        metrics.set('funds_available', self.availableToBetBalance)
+        return True
+
+# ----------------------------------
+# ORDER ACTIVITY
+# ----------------------------------
+    def updateMarket(self, marketId, orders):
+        # orders as returned by listCurrentOrders - covers fills and cancellations
+        with self.lock:
+            self.marketOrders[marketId] = [(order.selectionId, order.side, order.price, order.sizeMatched, order.sizeRemaining)
+                                           for order in orders]
+            self.setLiability(marketId)
+
+    def placed(self, marketId, selectionId, side, size, price):
+        with self.lock:
+            self.marketOrders.setdefault(marketId, []).append(
+                (selectionId, side, price, 0.0, size))
+            self.setLiability(marketId)
+
+    def cancelled(self, marketId):
+        with self.lock:
+            orders = self.marketOrders.get(marketId)
+            if orders is None:
+                return
+            self.marketOrders[marketId] = [(selectionId, side, price, sizeMatched, 0.0)
+                                           for selectionId, side, price, sizeMatched, sizeRemaining in orders if sizeMatched > 0.0]
+            self.setLiability(marketId)
+
+    def closed(self, marketId):
+        with self.lock:
+            self.closedMarketIds.add(marketId)
+
+# ----------------------------------
+# HELPERS
+# ----------------------------------
+    def setLiability(self, marketId):
+        # called with the lock held
+        liability = marketLiability(self.marketOrders[marketId])
+        self.liability += liability - \
+            self.marketLiabilities.get(marketId, 0.0)
+        self.marketLiabilities[marketId] = liability
+
+        if self.accountAvailable is not None:
+            self.availableToBetBalance = round(
+                self.accountAvailable - (self.liability - self.liabilityAtReconcile), 2)
+
+
+def marketLiability(orders):
+    '''
+    Worst case loss over (selectionId, side, price, sizeMatched, sizeRemaining)
+    orders on one market: profit is evaluated with each ordered selection winning
+    and with some other runner winning. Unmatched size only ever adds loss.
+    '''
+    selectionIds = set(order[0] for order in orders)
+    worst = 0.0
+
+    for winner in list(selectionIds) + [None]:
+        profit = 0.0
+        for selectionId, side, price, sizeMatched, sizeRemaining in orders:
+            wins = selectionId == winner
+            if side == 'BACK':
+                profit += sizeMatched * (price - 1.0) if wins else -sizeMatched
+                profit -= 0.0 if wins else sizeRemaining
+            else:
+                profit += -sizeMatched * (price - 1.0) if wins else sizeMatched
+                profit -= sizeRemaining * (price - 1.0) if wins else 0.0
+        worst = min(worst, profit)
+
+    return -worst
@@ -0,0 +1,465 @@
+import argparse
+import csv
+import datetime
+import gc
+import json
+import os
+import random
+import signal
+import statistics
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+
+from betfair import BetfairSettings
+from eventlog import log
+from eventlog import WARNING
+from fakebetfair import FakeExchange
+from fakebetfair import FakeExchangeManager
+from fakebetfair import GaussLatency
+from fakebetfair import OfflineStrategy
+from fakebetfair import SharedExchangeFactory
+from fakebetfair import createOfflineStrategy
+from fakebetfair import defaultStrategySettings
+from hedging import HedgedReads
+from memdiag import growthSites
+from memdiag import objectCounts
+from memdiag import residentBytes
+from metrics import metrics
+from resilience import Resilience
+from shard import ShardCoordinator
+
+# ----------------------------------
+# LOAD TEST STRATEGY
+# ----------------------------------
+
+
+class LoadTestStrategy(OfflineStrategy):
+    # records how late the first stop loss step ran after each deadline passed
+
+    def __init__(self, *args, **kwargs):
+        self.stopLossLags = {}
+        OfflineStrategy.__init__(self, *args, **kwargs)
+
+    def stepStopLosses(self, positions, resting):
+        now = datetime.datetime.now()
+        for position in positions:
+            if position.marketId not in self.stopLossLags:
+                self.stopLossLags[position.marketId] = (
+                    now - position.stopLossAt).total_seconds()
+        OfflineStrategy.stepStopLosses(self, positions, resting)
+
+
+class OfflineCoordinator(ShardCoordinator):
+    refreshSessionToken = OfflineStrategy.refreshSessionToken
+
+# ----------------------------------
+# RUN
+# ----------------------------------
+
+
+def runWindow(events, positions, duration, interval, timeScale, latencyMean, latencyJitter, stopLossMinutes, seed,
+              spikeProbability=0.0, spikeSeconds=0.0, hedging=False, errorProbability=0.0, outageSeconds=0.0, resilience=False):
+    '''
+    Runs the strategy on a fixed rate schedule for duration seconds against a
+    FakeExchange with events and positions open positions whose stop loss all fall
+    due mid window. Prices follow the drifting in-play path sped up by timeScale.
+    Like the daemon's interval scheduler, a tick that overruns skips the slots it
+    ran into rather than queueing them. A call stalls for an extra spikeSeconds
+    with spikeProbability; with hedging the reads go through HedgedReads. A call
+    fails with HTTP 503 with errorProbability, and every betting call does for
+    outageSeconds from a third of the way in; with resilience the client retries
+    reads and breaks the circuit of an endpoint that is down.
+    '''
+    latencyRandom = random.Random(seed)
+    outage = {'from': None}
+
+    def latency(operation):
+        spike = spikeSeconds if latencyRandom.random() < spikeProbability else 0.0
+        return max(0.0, latencyRandom.gauss(latencyMean, latencyJitter)) + spike
+
+    def failure(url, operation):
+        outageFrom = outage['from']
+        if latencyRandom.random() < errorProbability or \
+                ('betting' in url and outageFrom is not None and outageFrom <= time.monotonic() < outageFrom + outageSeconds):
+            return urllib.error.HTTPError(url, 503, 'Service Unavailable', {}, None)
+        return None
+
+    exchange = FakeExchange(events=events, marketsPerEvent=30, kickOffSpreadMinutes=duration / 60.0,
+                            seed=seed, latency=latency if latencyMean > 0 or spikeProbability > 0 else None,
+                            failure=failure if errorProbability > 0 or outageSeconds > 0 else None)
+    exchange.pricePath = lambda market, elapsed: exchange.driftingPricePath(
+        market, elapsed * timeScale)
+    exchange.addOpenPositions(positions, placedMinutesAgo=0.0)
+
+    durations = []
+    callsPerTick = []
+    budgetUsed = []
+    deferred = 0
+    skipped = 0
+    errors = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        strategy = createOfflineStrategy(exchange, os.path.join(directory, 'loadtest.journal'),
+                                         defaultStrategySettings(stopLossThresholdMinutes=stopLossMinutes), LoadTestStrategy)
+        # leave a fifth of each interval as headroom, like the daemon's 8 of 10 seconds
+        strategy.executor.budgetSeconds = interval * 0.8
+        hedgedReads = HedgedReads() if hedging else None
+        strategy.betfairSettings.hedging = hedgedReads
+        # an open circuit probes again after three intervals, as the daemon's 30 seconds are
+        strategy.betfairSettings.resilience = Resilience(
+            resetSeconds=interval * 3, seed=seed) if resilience else None
+
+        startedAt = time.monotonic()
+        outage['from'] = startedAt + duration / 3
+        nextRunAt = startedAt
+        while nextRunAt < startedAt + duration:
+            delay = nextRunAt - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            exchange.resetCalls()
+            tickStartedAt = time.perf_counter()
+            try:
+                strategy.iteration()
+            except Exception as e:
+                errors = errors + 1
+                log.error('LOADTEST_TICK_FAILED', error=repr(e))
+            durations.append(time.perf_counter() - tickStartedAt)
+            callsPerTick.append(sum(exchange.calls.values()))
+            if strategy.executor.lastReport is not None:
+                budgetUsed.append(strategy.executor.lastReport['budgetUsed'])
+                deferred = deferred + \
+                    sum(strategy.executor.lastReport['deferred'].values())
+
+            nextRunAt = nextRunAt + interval
+            now = time.monotonic()
+            while nextRunAt < now:
+                skipped = skipped + 1
+                nextRunAt = nextRunAt + interval
+
+        # drift between the ledger and the exchange after the window
+        strategy.ledger.reconcile()
+        strategy.ledger.stop()
+        strategy.journal.close()
+        strategy.memory.close()
+        strategy.exitPool.shutdown()
+        if hedgedReads is not None:
+            hedgedReads.close()
+
+    report = strategy.betfairSettings.resilience.report(
+    ) if resilience else {'retries': 0, 'rejected': {}, 'circuits': {}}
+    lags = sorted(strategy.stopLossLags.values())
+    # the first tick also bootstraps positions and loads the calendar
+    steady = sorted(durations[1:])
+    durations.sort()
+    budgetUsed.sort()
+    return {'events': events, 'positions': positions, 'hedging': hedging, 'resilience': resilience, 'ticks': len(durations), 'skipped_runs': skipped, 'errors': errors,
+            'tick_p50_ms': percentile(durations, 0.50, 1e3), 'tick_p95_ms': percentile(durations, 0.95, 1e3),
+            'tick_p99_ms': percentile(durations, 0.99, 1e3), 'tick_max_ms': percentile(durations, 1.0, 1e3),
+            'steady_tick_p99_ms': percentile(steady, 0.99, 1e3),
+            'stop_losses': len(lags), 'stop_loss_lag_p50_s': percentile(lags, 0.50),
+            'stop_loss_lag_p95_s': percentile(lags, 0.95), 'stop_loss_lag_max_s': percentile(lags, 1.0),
+            'budget_used_p50': percentile(budgetUsed, 0.50), 'budget_used_p95': percentile(budgetUsed, 0.95),
+            'deferred_units': deferred,
+            'api_calls_per_tick': round(statistics.mean(callsPerTick), 2) if callsPerTick else None,
+            'hedged_requests': hedgedReads.hedged if hedgedReads is not None else 0,
+            'hedge_wins': hedgedReads.wins if hedgedReads is not None else 0,
+            'retries': report['retries'], 'circuit_rejections': sum(report['rejected'].values()),
+            'circuits_at_end': report['circuits'],
+            'open_positions_at_end': len(strategy.positions), 'ledger_drift': strategy.ledger.lastDrift}
+
+
+# ----------------------------------
+# SHARDS
+# ----------------------------------
+
+
+def runShards(workers, events, positions, duration, interval, latencyMean, latencyJitter, stopLossMinutes, seed,
+              kill=False, scaleUp=False):
+    '''
+    Runs a ShardCoordinator with workers processes for duration seconds against
+    one FakeExchange served from a manager process, so every worker's calls go
+    through the same exchange with the same injected latency. The positions are
+    open on the account at start and unowned, so the first orphan scan hands them
+    to their hash owners. With kill one worker is SIGKILLed a third of the way in,
+    with scaleUp a worker is added two thirds of the way in; either way no market
+    may be reported by two workers at once.
+    '''
+    manager = FakeExchangeManager()
+    manager.start()
+    exchange = manager.SharedExchange(latency=GaussLatency(latencyMean, latencyJitter, seed) if latencyMean > 0 else None,
+                                      events=events, marketsPerEvent=30, kickOffSpreadMinutes=duration / 60.0, seed=seed)
+    exchange.call('addOpenPositions', positions, placedMinutesAgo=0.0)
+    factory = SharedExchangeFactory(exchange)
+
+    strategySettings = defaultStrategySettings(
+        stopLossThresholdMinutes=stopLossMinutes)
+    counters = ['shard_ownership_conflicts_total', 'shard_orphans_adopted_total', 'shard_handoffs_total',
+                'shard_worker_deaths_total', 'shard_entries_blocked_total']
+    baseline = dict((name, metrics.counter(name)) for name in counters)
+    budgetUsed = {}
+    positionsSeen = set()
+    killed = None
+    calls = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        workerConfig = {'betfairSettings': {'appKey': 'offline', 'sessionToken': None, 'bettingURL': 'https://betting.invalid/json-rpc/v1',
+                                            'accountsURL': 'https://accounts.invalid/json-rpc/v1', 'timeoutSeconds': 10.0, 'hedging': False, 'resilience': False},
+                        'strategySettings': vars(strategySettings), 'journalPath': os.path.join(directory, 'shard-%d.journal'),
+                        'betfairFactory': factory, 'tickBudgetSeconds': interval * 0.8, 'intervalSeconds': interval,
+                        'logLevel': log.level}
+        betfairSettings = BetfairSettings(
+            'offline', None, workerConfig['betfairSettings']['bettingURL'], workerConfig['betfairSettings']['accountsURL'])
+        coordinator = OfflineCoordinator(strategySettings, betfairSettings, workerConfig, workers=workers,
+                                         maxExposure=1000.0, workerTimeoutSeconds=max(10.0, interval * 10), exclusionRulesPath=None,
+                                         betfairFactory=factory, tickBudgetSeconds=interval * 0.8,
+                                         workerCountPath=os.path.join(directory, 'shard.workers'))
+
+        exchange.call('resetCalls')
+        startedAt = time.monotonic()
+        nextRunAt = startedAt
+        while nextRunAt < startedAt + duration:
+            delay = nextRunAt - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elapsed = time.monotonic() - startedAt
+
+            if kill and killed is None and elapsed >= duration / 3:
+                killed = min(coordinator.shards)
+                os.kill(coordinator.shards[killed].process.pid, signal.SIGKILL)
+            if scaleUp and elapsed >= duration * 2 / 3:
+                scaleUp = False
+                coordinator.setWorkerCount(len(coordinator.liveShards()) + 1)
+
+            coordinator.iteration()
+            for shard in coordinator.shards.values():
+                if shard.report is not None:
+                    positionsSeen.update(shard.report['records'])
+                    if shard.report['budgetUsed'] is not None:
+                        budgetUsed.setdefault(shard.shardId, []).append(
+                            shard.report['budgetUsed'])
+
+            nextRunAt = nextRunAt + interval
+            while nextRunAt < time.monotonic():
+                nextRunAt = nextRunAt + interval
+
+        seconds = time.monotonic() - startedAt
+        calls = sum(exchange.call('resetCalls').values())
+        owned = len(coordinator.owners)
+        liveWorkers = len(coordinator.liveShards())
+        coordinator.close()
+    manager.shutdown()
+
+    counts = dict((name, metrics.counter(name) - baseline[name])
+                  for name in counters)
+    usedP95 = [percentile(sorted(values), 0.95)
+               for shardId, values in sorted(budgetUsed.items())]
+    return {'workers': workers, 'workers_at_end': liveWorkers, 'events': events, 'positions': positions, 'killed': killed,
+            'seconds': round(seconds, 1), 'api_calls_per_second': round(calls / seconds, 1),
+            'worker_budget_used_p95': usedP95, 'positions_seen': len(positionsSeen), 'owned_at_end': owned,
+            'ownership_conflicts': counts['shard_ownership_conflicts_total'],
+            'orphans_adopted': counts['shard_orphans_adopted_total'], 'handoffs': counts['shard_handoffs_total'],
+            'worker_deaths': counts['shard_worker_deaths_total'], 'entries_blocked': counts['shard_entries_blocked_total']}
+
+# ----------------------------------
+# LEAK CHECK
+# ----------------------------------
+
+
+def runLeakCheck(ticks, warmupTicks=600, eventsPerTick=2, liveEvents=40, sampleEvery=100, toleranceBytesPerTick=32.0, seed=1):
+    '''
+    Runs ticks back to back against a fake exchange whose fixtures keep turning
+    over: each tick adds eventsPerTick events kicking off within seconds and
+    settles all but the newest liveEvents, so markets are discovered, staged,
+    entered and closed for the whole run. The strategy's time windows are shrunk
+    to match and the ledger reconciles every sixth tick, as the daemon's 60
+    seconds do at 10 second ticks. It runs the plain OfflineStrategy: the load
+    test's stop loss lags are kept per market for the report, which would be
+    measured as a leak. warmupTicks run first, until the strategy's caches and
+    the fixtures have filled, and are not measured. Traced memory is then
+    sampled after a collection every sampleEvery of the ticks measured; the
+    check fails when the least squares growth exceeds toleranceBytesPerTick, so
+    a leak of a small object per tick fails it while allocator noise does not.
+    Open positions keep their journalled fields until they close, so traced
+    memory moves with the number open rather than with the ticks run.
+    '''
+    tracemalloc.start(1)
+    exchange = FakeExchange(events=0, seed=seed)
+    samples = []
+    errors = 0
+    entered = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        strategy = createOfflineStrategy(exchange, os.path.join(directory, 'leakcheck.journal'),
+                                         defaultStrategySettings(stopLossThresholdMinutes=0.05), OfflineStrategy)
+        strategy.eventCalendar.refreshSeconds = 0
+        strategy.eventCalendar.fullRefreshSeconds = 0
+        strategy.priceHistoryIdleSeconds = 5
+
+        startedAt = time.monotonic()
+        for tick in range(warmupTicks + ticks):
+            exchange.addEvents(eventsPerTick, 5, 0.1)
+            exchange.settleEvents(liveEvents)
+            exchange.resetCalls()
+            try:
+                strategy.iteration()
+            except Exception as e:
+                errors = errors + 1
+                log.error('LEAKCHECK_TICK_FAILED', error=repr(e))
+            entered = entered + exchange.calls.get('placeOrders', 0)
+            if tick % 6 == 5:
+                strategy.ledger.reconcile()
+
+            if tick == warmupTicks:
+                gc.collect()
+                baseline = tracemalloc.take_snapshot()
+            if tick >= warmupTicks and (tick - warmupTicks) % sampleEvery == 0:
+                gc.collect()
+                samples.append((tick, tracemalloc.get_traced_memory()[0]))
+
+        gc.collect()
+        sites = growthSites(baseline, tracemalloc.take_snapshot(), 10)
+        counts = objectCounts(10)
+        caches = dict((name, entries)
+                      for name, (entries, limit) in strategy.memory.cacheSizes().items())
+        seconds = time.monotonic() - startedAt
+
+        strategy.ledger.stop()
+        strategy.journal.close()
+        strategy.memory.close()
+        strategy.exitPool.shutdown()
+    tracemalloc.stop()
+
+    # least squares bytes per tick over the sampled part of the run
+    meanTick = statistics.mean(tick for tick, traced in samples)
+    meanTraced = statistics.mean(traced for tick, traced in samples)
+    slope = sum((tick - meanTick) * (traced - meanTraced) for tick, traced in samples) / \
+        sum((tick - meanTick) ** 2 for tick, traced in samples)
+    growth = slope * (samples[-1][0] - samples[0][0])
+
+    return {'ticks': ticks, 'warmup_ticks': warmupTicks, 'errors': errors, 'orders_placed_calls': entered, 'seconds': round(seconds, 1),
+            'traced_first_bytes': samples[0][1], 'traced_last_bytes': samples[-1][1],
+            'growth_bytes': round(growth), 'bytes_per_tick': round(slope, 1), 'tolerance_bytes_per_tick': toleranceBytesPerTick,
+            'passed': slope <= toleranceBytesPerTick and errors == 0, 'resident_bytes': residentBytes(),
+            'caches': caches, 'growth_sites': sites, 'object_counts': counts}
+
+
+def percentile(values, q, scale=1.0):
+    # nearest rank on an already sorted list
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))
+    return round(values[index] * scale, 3)
+
+# ----------------------------------
+# MAIN
+# ----------------------------------
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Scaling curve for the strategy against a fake exchange with injected latency.')
+    parser.add_argument('--events', default='10,50,100,200',
+                        help='comma separated event counts, one run each')
+    parser.add_argument('--positions-per-event', type=float, default=0.5)
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='seconds of wall clock per run')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='scheduler interval in seconds (daemon uses 10)')
+    parser.add_argument('--time-scale', type=float, default=60.0,
+                        help='match seconds per wall clock second')
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--jitter-ms', type=float, default=15.0)
+    parser.add_argument('--stop-loss-minutes', type=float, default=0.25)
+    parser.add_argument('--spike-probability', type=float, default=0.0,
+                        help='chance that a call stalls for --spike-ms on top of its latency')
+    parser.add_argument('--spike-ms', type=float, default=1000.0)
+    parser.add_argument('--hedging', default='off',
+                        help='comma separated off/on, one run each per event count')
+    parser.add_argument('--error-probability', type=float, default=0.0,
+                        help='chance that a call fails with HTTP 503')
+    parser.add_argument('--outage-seconds', type=float, default=0.0,
+                        help='the betting endpoint answers 503 for this long from a third of the way into each run')
+    parser.add_argument('--resilience', default='off',
+                        help='comma separated off/on (retries and circuit breakers), one run each per event count')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output-dir', default='loadtest-results')
+    parser.add_argument('--leak-check', type=int, default=0, metavar='TICKS',
+                        help='run TICKS back to back ticks with turning over fixtures, fail unless memory stays flat')
+    parser.add_argument('--leak-warmup', type=int, default=600, metavar='TICKS',
+                        help='ticks run before the leak check starts measuring')
+    parser.add_argument('--leak-tolerance', type=float, default=32.0,
+                        help='allowed memory growth in bytes per tick')
+    parser.add_argument('--shards', default='',
+                        help='comma separated worker counts: run the sharded coordinator instead, one run each')
+    parser.add_argument('--shard-kill', action='store_true',
+                        help='kill a worker a third of the way into each sharded run')
+    parser.add_argument('--shard-scale-up', action='store_true',
+                        help='add a worker two thirds of the way into each sharded run')
+    args = parser.parse_args()
+
+    # keep the background log writer quiet while measuring
+    log.level = WARNING
+
+    if args.leak_check:
+        result = runLeakCheck(
+            args.leak_check, warmupTicks=args.leak_warmup, toleranceBytesPerTick=args.leak_tolerance, seed=args.seed)
+        print(('leak check %s: ' % ('passed' if result['passed'] else 'FAILED')) +
+              'ticks=%(ticks)d (after %(warmup_ticks)d warm-up) errors=%(errors)d placeOrders=%(orders_placed_calls)d traced=%(traced_first_bytes)d->%(traced_last_bytes)d '
+              'growth=%(growth_bytes)d bytes (%(bytes_per_tick)s/tick, tolerance %(tolerance_bytes_per_tick)s) in %(seconds)ss' % result)
+        print('caches: %s' % result['caches'])
+        for site, sizeDiff, countDiff in result['growth_sites'][:5]:
+            print('  %-60s %+10d bytes %+6d blocks' % (site, sizeDiff, countDiff))
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, time.strftime('leakcheck-%Y%m%d-%H%M%S.json')), 'w') as jsonFile:
+            json.dump(result, jsonFile, indent=2)
+        raise SystemExit(0 if result['passed'] else 1)
+
+    if args.shards:
+        rows = []
+        for workers in [int(value) for value in args.shards.split(',')]:
+            for events in [int(value) for value in args.events.split(',')]:
+                row = runShards(workers, events, int(events * args.positions_per_event), args.duration, args.interval,
+                                args.latency_ms / 1e3, args.jitter_ms / 1e3, args.stop_loss_minutes, args.seed,
+                                args.shard_kill, args.shard_scale_up)
+                rows.append(row)
+                print('workers=%(workers)d->%(workers_at_end)d events=%(events)d positions=%(positions)d api calls/s=%(api_calls_per_second)s '
+                      'worker budget p95=%(worker_budget_used_p95)s seen=%(positions_seen)d adopted=%(orphans_adopted)d '
+                      'handoffs=%(handoffs)d deaths=%(worker_deaths)d conflicts=%(ownership_conflicts)d' % row)
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, time.strftime('shards-%Y%m%d-%H%M%S.json')), 'w') as jsonFile:
+            json.dump({'args': vars(args), 'runs': rows}, jsonFile, indent=2)
+        raise SystemExit(1 if any(row['ownership_conflicts'] for row in rows) else 0)
+
+    rows = []
+    for events in [int(value) for value in args.events.split(',')]:
+        for hedging in args.hedging.split(','):
+            for resilience in args.resilience.split(','):
+                row = runWindow(events, int(events * args.positions_per_event), args.duration, args.interval, args.time_scale,
+                                args.latency_ms / 1e3, args.jitter_ms / 1e3, args.stop_loss_minutes, args.seed,
+                                args.spike_probability, args.spike_ms / 1e3, hedging == 'on',
+                                args.error_probability, args.outage_seconds, resilience == 'on')
+                rows.append(row)
+                print('events=%(events)d positions=%(positions)d hedging=%(hedging)s resilience=%(resilience)s ticks=%(ticks)d '
+                      'skipped=%(skipped_runs)d errors=%(errors)d '
+                      'tick p50/p99/max=%(tick_p50_ms)s/%(tick_p99_ms)s/%(tick_max_ms)s ms steady p99=%(steady_tick_p99_ms)s ms '
+                      'budget p95=%(budget_used_p95)s deferred=%(deferred_units)d hedged=%(hedged_requests)d retries=%(retries)d '
+                      'rejected=%(circuit_rejections)d stop loss lag p95=%(stop_loss_lag_p95_s)s s api calls/tick=%(api_calls_per_tick)s' % row)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    basePath = os.path.join(args.output_dir, time.strftime('scaling-%Y%m%d-%H%M%S'))
+
+    with open(basePath + '.json', 'w') as jsonFile:
+        json.dump({'args': vars(args), 'runs': rows}, jsonFile, indent=2)
+
+    with open(basePath + '.csv', 'w', newline='') as csvFile:
+        writer = csv.DictWriter(csvFile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print('written: %s.json, %s.csv' % (basePath, basePath))
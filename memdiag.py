@@ -0,0 +1,206 @@
+import collections
+import gc
+import io
+import os
+import signal
+import time
+import tracemalloc
+
+from eventlog import log
+from metrics import metrics
+
+# ----------------------------------
+# PROCESS MEMORY
+# ----------------------------------
+
+
+def residentBytes():
+    # current RSS from /proc (Linux), None elsewhere
+    try:
+        with open('/proc/self/statm', 'r') as statmFile:
+            return int(statmFile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def objectCounts(top=25):
+    # gc tracked objects per type name, most numerous first
+    counts = collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+    return counts.most_common(top)
+
+
+def growthSites(before, after, top=15):
+    # tracemalloc allocation sites that grew the most between two snapshots
+    stats = after.compare_to(before, 'lineno')
+    return [(str(stat.traceback[0]), stat.size_diff, stat.count_diff)
+            for stat in stats[:top] if stat.size_diff > 0]
+
+# ----------------------------------
+# GC PAUSES
+# ----------------------------------
+
+
+class GcPauses:
+    '''
+    Times collections through gc.callbacks. The callback only updates a few
+    preallocated counters - it may run inside any allocation, the metrics
+    registry included - and flush() moves them to the metrics on the tick.
+    '''
+
+    def __init__(self):
+        self.startedAt = None
+        self.collections = [0, 0, 0]
+        self.seconds = [0.0, 0.0, 0.0]
+        self.maxSeconds = 0.0
+        self.flushed = [0, 0, 0]
+        self.flushedSeconds = [0.0, 0.0, 0.0]
+        gc.callbacks.append(self.onCollect)
+
+    def onCollect(self, phase, info):
+        if phase == 'start':
+            self.startedAt = time.perf_counter()
+            return
+        if self.startedAt is None:
+            return
+
+        pause = time.perf_counter() - self.startedAt
+        generation = info['generation']
+        self.collections[generation] += 1
+        self.seconds[generation] += pause
+        if pause > self.maxSeconds:
+            self.maxSeconds = pause
+        self.startedAt = None
+
+    def flush(self):
+        for generation in range(3):
+            labels = (('generation', str(generation)),)
+            metrics.inc('gc_collections_total', labels,
+                        self.collections[generation] - self.flushed[generation])
+            metrics.add('gc_pause_seconds_total', self.seconds[generation] -
+                        self.flushedSeconds[generation], labels)
+            self.flushed[generation] = self.collections[generation]
+            self.flushedSeconds[generation] = self.seconds[generation]
+        metrics.set('gc_pause_max_seconds', self.maxSeconds)
+
+    def close(self):
+        if self.onCollect in gc.callbacks:
+            gc.callbacks.remove(self.onCollect)
+
+# ----------------------------------
+# MEMORY DIAGNOSTICS
+# ----------------------------------
+
+
+class MemoryDiagnostics:
+    '''
+    Memory as a tick metric. After every tick: RSS, GC collections and pauses and
+    the entry count of each tracked cache are exported. With traceFrames > 0
+    tracemalloc runs (slowing every allocation, so it is off by default) and every
+    diffIntervalSeconds the top growth sites since the previous diff are logged
+    as MEMORY_GROWTH. A full report - RSS, GC stats, cache sizes, object counts
+    per type and growth sites - is written to memory-<time>.txt on SIGUSR2 or
+    when the trigger file appears.
+    '''
+
+    def __init__(self, triggerPath='memory.trigger', outputDir='.', traceFrames=0, diffIntervalSeconds=1800, topSites=15):
+        self.triggerPath = triggerPath
+        self.outputDir = outputDir
+        self.diffIntervalSeconds = diffIntervalSeconds
+        self.topSites = topSites
+        self.caches = {}
+        self.gcPauses = GcPauses()
+        self.requested = False
+        self.baseline = None
+        self.baselineAt = time.monotonic()
+
+        if traceFrames > 0:
+            tracemalloc.start(traceFrames)
+            self.baseline = tracemalloc.take_snapshot()
+
+        if hasattr(signal, 'SIGUSR2'):
+            try:
+                signal.signal(signal.SIGUSR2, self.onSignal)
+            except ValueError:
+                # not the main thread; file trigger only
+                pass
+
+    def onSignal(self, signum, frame):
+        self.requested = True
+
+    def track(self, name, size, limit=None):
+        # size() returns the cache's entry count; limit is its bound, reported alongside
+        self.caches[name] = (size, limit)
+
+    def cacheSizes(self):
+        return dict((name, (size(), limit)) for name, (size, limit) in self.caches.items())
+
+    def afterTick(self):
+        rss = residentBytes()
+        if rss is not None:
+            metrics.set('process_resident_bytes', rss)
+        self.gcPauses.flush()
+        for name, (entries, limit) in self.cacheSizes().items():
+            metrics.set('cache_entries', entries, (('cache', name),))
+
+        if self.baseline is not None:
+            metrics.set('tracemalloc_traced_bytes',
+                        tracemalloc.get_traced_memory()[0])
+            if time.monotonic() - self.baselineAt >= self.diffIntervalSeconds:
+                log.info('MEMORY_GROWTH', sites=[
+                         list(site) for site in self.diff()[:5]])
+
+        if os.path.exists(self.triggerPath):
+            try:
+                os.remove(self.triggerPath)
+            except OSError:
+                pass
+            self.requested = True
+
+        if self.requested:
+            self.requested = False
+            self.writeReport()
+
+    def diff(self):
+        # growth since the previous diff, which becomes the new baseline
+        snapshot = tracemalloc.take_snapshot()
+        sites = growthSites(self.baseline, snapshot, self.topSites)
+        self.baseline = snapshot
+        self.baselineAt = time.monotonic()
+        return sites
+
+    def report(self):
+        out = io.StringIO()
+        out.write('resident bytes: %s\n' % residentBytes())
+        out.write('gc collections: %s  pause seconds: %s  max pause: %.6f\n' % (
+            self.gcPauses.collections, [round(seconds, 6) for seconds in self.gcPauses.seconds], self.gcPauses.maxSeconds))
+        out.write('gc thresholds: %s  counts: %s\n' %
+                  (gc.get_threshold(), gc.get_count()))
+
+        out.write('\n# caches (entries / limit)\n')
+        for name, (entries, limit) in sorted(self.cacheSizes().items()):
+            out.write('%-24s %8d / %s\n' % (name, entries, limit))
+
+        out.write('\n# objects by type\n')
+        for name, count in objectCounts():
+            out.write('%-32s %10d\n' % (name, count))
+
+        if self.baseline is not None:
+            out.write('\n# growth since the last diff (bytes, blocks)\n')
+            for site, sizeDiff, countDiff in self.diff():
+                out.write('%-60s %+12d %+8d\n' % (site, sizeDiff, countDiff))
+
+        return out.getvalue()
+
+    def writeReport(self):
+        path = os.path.join(
+            self.outputDir, time.strftime('memory-%Y%m%d-%H%M%S.txt'))
+        with open(path, 'w', encoding='utf-8') as reportFile:
+            reportFile.write(self.report())
+        log.info('MEMORY_REPORT', path=path)
+        return path
+
+    def close(self):
+        self.gcPauses.close()
+        if self.baseline is not None:
+            tracemalloc.stop()
+            self.baseline = None
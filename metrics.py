@@ -0,0 +1,177 @@
+import bisect
+import http.server
+import threading
+import time
+
+from eventlog import log
+
+# ----------------------------------
+# METRICS
+# ----------------------------------
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+
+class Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'startedAt')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.startedAt = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.observe(
+            self.name, time.perf_counter() - self.startedAt, self.labels)
+
+
+class Metrics:
+    '''
+    In-process counters, gauges and histograms keyed by (name, labels), where
+    labels is a tuple of (key, value) pairs. Updates come from the trading thread
+    and from the hedge, exit, ledger and validation threads, so every update and
+    the copy taken for rendering (on the HTTP thread) holds one lock.
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def add(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def time(self, name, labels=()):
+        return Timer(self, name, labels)
+
+    def counter(self, name, labels=()):
+        return self.counters.get((name, labels), 0)
+
+    def histogram(self, name, labels=()):
+        return self.histograms.get((name, labels))
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        with self.lock:
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+            histograms = [(key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                          for key, histogram in self.histograms.items()]
+
+        for (name, labels), value in sorted(counters):
+            self.appendType(lines, typed, name, 'counter')
+            lines.append('%s%s %s' % (name, self.formatLabels(labels), value))
+
+        for (name, labels), value in sorted(gauges):
+            self.appendType(lines, typed, name, 'gauge')
+            lines.append('%s%s %s' % (name, self.formatLabels(labels), value))
+
+        for (name, labels), buckets, counts, total, count in sorted(histograms, key=lambda item: item[0]):
+            self.appendType(lines, typed, name, 'histogram')
+            cumulative = 0
+            for bound, bucketCount in zip(buckets + (float('inf'),), counts):
+                cumulative += bucketCount
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (
+                    name, self.formatLabels(labels + (('le', le),)), cumulative))
+            lines.append('%s_sum%s %f' %
+                         (name, self.formatLabels(labels), total))
+            lines.append('%s_count%s %d' %
+                         (name, self.formatLabels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(
+            (host, port), MetricsHandler)
+        thread = threading.Thread(
+            target=self.server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        log.info('METRICS', url='http://{}:{}/metrics'.format(host, port))
+        return self.server
+
+# ----------------------------------
+# HELPERS
+# ----------------------------------
+    def appendType(self, lines, typed, name, metricType):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE %s %s' % (name, metricType))
+
+    def formatLabels(self, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+
+# shared registry - Betfair clients are short lived so metrics live here
+metrics = Metrics()
@@ -0,0 +1,359 @@
+import datetime
+import threading
+import time
+
+from betfair import Betfair
+from codec import AccountFunds
+from codec import CurrentOrder
+from eventlog import log
+from ledger import marketLiability
+from metrics import metrics
+
+# ----------------------------------
+# PAPER ORDERS
+# ----------------------------------
+
+
+class PaperOrder(CurrentOrder):
+    # queueAhead: size ahead of us at our price, lastVisibleSize: that price level's size when last seen
+    __slots__ = ('persistenceType', 'queueAhead', 'lastVisibleSize')
+
+    def __init__(self, betId, marketId, selectionId, side, price, size, persistenceType, placedDate):
+        CurrentOrder.__init__(self, betId, marketId, selectionId, side, 'EXECUTABLE', price, size,
+                              sizeRemaining=size, placedDate=placedDate)
+        self.persistenceType = persistenceType
+        self.queueAhead = 0.0
+        self.lastVisibleSize = 0.0
+
+    def fill(self, size, price):
+        size = round(min(size, self.sizeRemaining), 2)
+        if size <= 0.0:
+            return 0.0
+        matched = self.sizeMatched + size
+        self.averagePriceMatched = round(
+            (self.averagePriceMatched * self.sizeMatched + price * size) / matched, 2)
+        self.sizeMatched = round(matched, 2)
+        self.sizeRemaining = round(self.sizeRemaining - size, 2)
+        if self.sizeRemaining == 0.0:
+            self.status = 'EXECUTION_COMPLETE'
+        return size
+
+# ----------------------------------
+# PAPER EXCHANGE
+# ----------------------------------
+
+
+class PaperExchange:
+    '''
+    Simulated order book for paper trading against live prices. Orders are
+    matched against the best offers of the latest listMarketBook seen for their
+    market: crossing size fills at once (FILL_OR_KILL orders fill in full or
+    lapse), the remainder rests at its price. A resting order fills when the price
+    trades through it, or once the size queued ahead of it at its price has gone
+    (visible size reductions are assumed to come from ahead of us) and the last
+    traded price is ours. LAPSE orders lapse at the in-play turn, CLOSED markets
+    settle against the WINNER runner. Books are kept for at most maxBooks
+    markets; past that the oldest books of markets without orders are dropped.
+    '''
+
+    def __init__(self, balance=1000.0, maxBookAgeSeconds=1.0, maxBooks=2000):
+        self.balance = balance
+        self.maxBookAgeSeconds = maxBookAgeSeconds
+        self.maxBooks = maxBooks
+        self.orders = {}
+        self.books = {}
+        self.inplay = {}
+        self.nextBetId = 1
+        self.lock = threading.Lock()
+
+    def observe(self, marketBook, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.books[marketBook.marketId] = (now, marketBook)
+            if len(self.books) > self.maxBooks:
+                self.pruneBooks()
+            orders = self.orders.get(marketBook.marketId)
+            if not orders:
+                return
+
+            if marketBook.status == 'CLOSED':
+                self.settle(marketBook)
+                return
+
+            if marketBook.inplay and not self.inplay.get(marketBook.marketId):
+                for order in orders:
+                    if order.persistenceType == 'LAPSE' and order.sizeRemaining > 0.0:
+                        order.sizeRemaining = 0.0
+                        order.status = 'EXECUTION_COMPLETE'
+                self.removeEmptyOrders(marketBook.marketId)
+            self.inplay[marketBook.marketId] = marketBook.inplay
+
+            for order in self.orders.get(marketBook.marketId, ()):
+                if order.sizeRemaining > 0.0:
+                    self.matchResting(order, marketBook)
+
+    def staleMarketIds(self, marketIds=None, withOrders=True, now=None):
+        # markets (with orders, unless withOrders is False) whose book is older than maxBookAgeSeconds
+        now = time.time() if now is None else now
+        with self.lock:
+            if marketIds is None:
+                marketIds = list(self.orders.keys())
+            elif withOrders:
+                marketIds = [
+                    marketId for marketId in marketIds if marketId in self.orders]
+            return [marketId for marketId in marketIds
+                    if now - self.books.get(marketId, (0, None))[0] > self.maxBookAgeSeconds]
+
+# ----------------------------------
+# ORDER OPERATIONS
+# ----------------------------------
+    def placeOrders(self, marketId, instructions, customerRef):
+        with self.lock:
+            book = self.books.get(marketId, (0, None))[1]
+            if book is None:
+                return {'status': 'FAILURE', 'errorCode': 'MARKET_NOT_OPEN_FOR_BETTING', 'marketId': marketId,
+                        'customerRef': customerRef, 'instructionReports': []}
+
+            reports = []
+            for instruction in instructions:
+                reports.append(self.placeInstruction(
+                    marketId, instruction, book))
+
+            metrics.inc('paper_orders_total', value=len(instructions))
+            return {'status': 'SUCCESS', 'marketId': marketId, 'customerRef': customerRef, 'instructionReports': reports}
+
+    def placeInstruction(self, marketId, instruction, book):
+        limitOrder = instruction['limitOrder']
+        side = instruction['side']
+        price = float(limitOrder['price'])
+        size = float(limitOrder['size'])
+        runner = self.runnerBook(book, int(instruction['selectionId']))
+        crossing = self.crossingSize(runner, side, price)
+
+        if limitOrder.get('timeInForce') == 'FILL_OR_KILL' and crossing < size:
+            return {'status': 'SUCCESS', 'orderStatus': 'EXPIRED', 'sizeMatched': 0.0, 'instruction': instruction}
+
+        order = PaperOrder(str(self.nextBetId), marketId, int(instruction['selectionId']), side, price, size,
+                           limitOrder.get('persistenceType', 'LAPSE'), formatDateTime(time.time()))
+        self.nextBetId = self.nextBetId + 1
+        order.fill(crossing, price)
+
+        # rests behind the size already offered at our price
+        if order.sizeRemaining > 0.0:
+            order.queueAhead = order.lastVisibleSize = self.restingLevelSize(
+                runner, side, price)
+        self.orders.setdefault(marketId, []).append(order)
+
+        return {'status': 'SUCCESS', 'betId': order.betId, 'orderStatus': order.status,
+                'sizeMatched': order.sizeMatched, 'averagePriceMatched': order.averagePriceMatched, 'instruction': instruction}
+
+    def cancelOrders(self, marketId, customerRef):
+        with self.lock:
+            reports = []
+            for order in self.orders.get(marketId, ()):
+                if order.sizeRemaining > 0.0:
+                    reports.append({'status': 'SUCCESS', 'sizeCancelled': order.sizeRemaining,
+                                    'instruction': {'betId': order.betId}})
+                    order.sizeRemaining = 0.0
+                    order.status = 'EXECUTION_COMPLETE'
+            self.removeEmptyOrders(marketId)
+            return {'status': 'SUCCESS', 'marketId': marketId, 'customerRef': customerRef, 'instructionReports': reports}
+
+    def replaceOrders(self, marketId, instructions, customerRef):
+        with self.lock:
+            book = self.books.get(marketId, (0, None))[1]
+            reports = []
+            for instruction in instructions:
+                for order in list(self.orders.get(marketId, ())):
+                    if order.betId != instruction['betId'] or order.sizeRemaining == 0.0:
+                        continue
+                    # cancel the remainder and place it again at the new price
+                    remaining = order.sizeRemaining
+                    order.sizeRemaining = 0.0
+                    order.status = 'EXECUTION_COMPLETE'
+                    if book is not None:
+                        reports.append(self.placeInstruction(marketId, {'selectionId': order.selectionId, 'side': order.side,
+                                                                        'limitOrder': {'price': instruction['newPrice'], 'size': remaining,
+                                                                                       'persistenceType': order.persistenceType}}, book))
+            self.removeEmptyOrders(marketId)
+            return {'status': 'SUCCESS', 'marketId': marketId, 'customerRef': customerRef, 'instructionReports': reports}
+
+    def currentOrders(self, marketIds=None):
+        with self.lock:
+            if marketIds is None:
+                marketIds = list(self.orders.keys())
+            return [order for marketId in marketIds for order in self.orders.get(marketId, ())]
+
+    def accountFunds(self):
+        with self.lock:
+            liability = sum(marketLiability([(order.selectionId, order.side, order.price, order.sizeMatched, order.sizeRemaining)
+                                             for order in orders]) for orders in self.orders.values())
+            return AccountFunds(round(self.balance - liability, 2), -round(liability, 2), wallet='PAPER')
+
+# ----------------------------------
+# MATCHING
+# ----------------------------------
+    def matchResting(self, order, book):
+        runner = self.runnerBook(book, order.selectionId)
+        if runner is None:
+            return
+
+        crossing = self.crossingSize(runner, order.side, order.price)
+        if crossing > 0.0:
+            order.fill(crossing, order.price)
+            return
+
+        visibleSize = self.restingLevelSize(runner, order.side, order.price)
+        if visibleSize < order.lastVisibleSize:
+            order.queueAhead = max(
+                0.0, order.queueAhead - (order.lastVisibleSize - visibleSize))
+        order.lastVisibleSize = visibleSize
+
+        if order.queueAhead == 0.0 and runner.lastPriceTraded == order.price:
+            order.fill(order.sizeRemaining, order.price)
+
+    def crossingSize(self, runner, side, price):
+        # size we could match immediately at our price or better
+        if runner is None or runner.status != 'ACTIVE':
+            return 0.0
+        if side == 'BACK':
+            return sum(size for offerPrice, size in runner.availableToBack if offerPrice >= price)
+        return sum(size for offerPrice, size in runner.availableToLay if offerPrice <= price)
+
+    def restingLevelSize(self, runner, side, price):
+        # a resting back is offered to layers (availableToLay) and vice versa
+        if runner is None:
+            return 0.0
+        offers = runner.availableToLay if side == 'BACK' else runner.availableToBack
+        for offerPrice, size in offers:
+            if offerPrice == price:
+                return size
+        return 0.0
+
+    def runnerBook(self, book, selectionId):
+        for runner in book.runners:
+            if runner.selectionId == selectionId:
+                return runner
+        return None
+
+    def settle(self, book):
+        # called with the lock held
+        winners = set(
+            runner.selectionId for runner in book.runners if runner.status == 'WINNER')
+        profit = 0.0
+        for order in self.orders.pop(book.marketId, ()):
+            won = order.selectionId in winners
+            if order.side == 'BACK':
+                profit += order.sizeMatched * \
+                    (order.averagePriceMatched - 1.0) if won else -order.sizeMatched
+            else:
+                profit += -order.sizeMatched * \
+                    (order.averagePriceMatched - 1.0) if won else order.sizeMatched
+
+        self.balance = round(self.balance + profit, 2)
+        self.inplay.pop(book.marketId, None)
+        self.books.pop(book.marketId, None)
+        metrics.inc('paper_settled_markets_total')
+        log.info('PAPER_SETTLED', marketId=book.marketId,
+                 profit=round(profit, 2), balance=self.balance)
+
+    def pruneBooks(self):
+        # called with the lock held; drops down to half the bound so pruning is occasional
+        idle = sorted((observedAt, marketId) for marketId, (observedAt, book) in self.books.items()
+                      if marketId not in self.orders)
+        for observedAt, marketId in idle[:len(self.books) - self.maxBooks // 2]:
+            del self.books[marketId]
+            self.inplay.pop(marketId, None)
+        metrics.inc('cache_limit_hits_total', (('cache', 'paperBooks'),))
+
+    def removeEmptyOrders(self, marketId):
+        # unmatched and fully cancelled/lapsed orders drop out, as on the exchange
+        orders = [order for order in self.orders.get(marketId, ())
+                  if order.sizeRemaining > 0.0 or order.sizeMatched > 0.0]
+        if orders:
+            self.orders[marketId] = orders
+        else:
+            self.orders.pop(marketId, None)
+
+# ----------------------------------
+# PAPER CLIENT
+# ----------------------------------
+
+
+class PaperBetfair(Betfair):
+    '''
+    Betfair client whose order operations and account funds go to a PaperExchange
+    while reads (events, catalogues, books) still go to the API. Every book read
+    is fed to the simulator; markets with working orders whose book is stale are
+    refreshed in one batched listMarketBook per 40 markets. The funds read
+    refreshes every market still holding orders, so markets the strategy no
+    longer queries (positions closed HEDGED or MINSTAKE) settle when they close.
+    '''
+
+    def __init__(self, settings, paperExchange):
+        Betfair.__init__(self, settings)
+        self.paperExchange = paperExchange
+
+    def getMarketBookBestOffers(self, marketId):
+        marketBooks = Betfair.getMarketBookBestOffers(self, marketId)
+        if marketBooks is not None:
+            for marketBook in marketBooks:
+                self.paperExchange.observe(marketBook)
+        return marketBooks
+
+    def refreshPaperBooks(self, marketIds=None, withOrders=True):
+        staleMarketIds = self.paperExchange.staleMarketIds(
+            marketIds, withOrders)
+        for i in range(0, len(staleMarketIds), 40):
+            marketBooks = self.listMarketBooks(staleMarketIds[i:i + 40])
+            for marketBook in marketBooks or ():
+                self.paperExchange.observe(marketBook)
+
+    def submitOrders(self, marketId, instructions, customerRef):
+        # fill against a book no older than the one a live order would meet
+        self.refreshPaperBooks([marketId], withOrders=False)
+        place_order_result = self.paperExchange.placeOrders(
+            marketId, instructions, customerRef)
+
+        log.info('PLACE_ORDER_STATUS', marketId=marketId,
+                 status=place_order_result['status'], customerRef=customerRef, paper=True)
+
+        if place_order_result['status'] != 'SUCCESS':
+            log.warning('PLACE_ORDER_FAILED', marketId=marketId,
+                        result=place_order_result)
+            return False
+
+        return True
+
+    def cancelOrders(self, marketId):
+        self.paperExchange.cancelOrders(marketId, None)
+        log.info('CANCEL_ORDERS_STATUS', marketId=marketId,
+                 status='SUCCESS', paper=True)
+        return True
+
+    def replaceOrder(self, marketId, betId, newPrice):
+        self.paperExchange.replaceOrders(
+            marketId, [{'betId': betId, 'newPrice': newPrice}], None)
+        log.info('REPLACE_ORDER_STATUS', marketId=marketId,
+                 status='SUCCESS', paper=True)
+        return True
+
+    def listCurrentOrders(self, marketId=None, marketIds=None):
+        if marketId is not None:
+            marketIds = [marketId]
+        self.refreshPaperBooks(marketIds)
+        return self.paperExchange.currentOrders(marketIds)
+
+    def streamCurrentOrders(self, marketIds=None, predicate=None):
+        for order in self.listCurrentOrders(marketIds=marketIds):
+            if predicate is None or predicate(order):
+                yield order
+
+    def getAccountFunds(self):
+        # settles closed markets first, their P&L is in the balance
+        self.refreshPaperBooks(None)
+        return self.paperExchange.accountFunds()
+
+
+def formatDateTime(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
@@ -0,0 +1,169 @@
+import datetime
+import heapq
+
+# ----------------------------------
+# POSITION STATES
+# ----------------------------------
+
+PENDING_BACK = 'PENDING_BACK'              # pair placed, FOK back outcome unknown
+BACKED = 'BACKED'                          # back matched, no hedge working
+HEDGE_WORKING = 'HEDGE_WORKING'            # back matched, hedge lay resting
+STOP_LOSS_STEPPING = 'STOP_LOSS_STEPPING'  # past stop loss threshold, repricing hedge
+CLOSED = 'CLOSED'
+
+OPEN_STATES = (PENDING_BACK, BACKED, HEDGE_WORKING, STOP_LOSS_STEPPING)
+
+# journal lifecycle event -> state a replayed position resumes in
+JOURNAL_STATES = {'OPENED': PENDING_BACK, 'BACK_MATCHED': HEDGE_WORKING,
+                  'HEDGE_PLACED': STOP_LOSS_STEPPING, 'REPRICED': STOP_LOSS_STEPPING}
+
+# state -> journal lifecycle event written when the journal is compacted
+STATE_EVENTS = {PENDING_BACK: 'OPENED', BACKED: 'BACK_MATCHED',
+                HEDGE_WORKING: 'BACK_MATCHED', STOP_LOSS_STEPPING: 'REPRICED'}
+
+# ----------------------------------
+# POSITION
+# ----------------------------------
+
+
+class Position:
+    __slots__ = ('marketId', 'eventId', 'eventName', 'selectionId', 'state',
+                 'backStake', 'backPrice', 'hedgeSide', 'hedgeStake', 'hedgePrice',
+                 'matchedPrice', 'matchedSize', 'placedDate', 'placedAt', 'stopLossAt')
+
+    def __init__(self, marketId, selectionId=None, state=PENDING_BACK):
+        self.marketId = marketId
+        self.eventId = None
+        self.eventName = None
+        self.selectionId = selectionId
+        self.state = state
+        self.backStake = None
+        self.backPrice = None
+        self.hedgeSide = 'LAY'
+        self.hedgeStake = None
+        self.hedgePrice = None
+        self.matchedPrice = None
+        self.matchedSize = None
+        self.placedDate = None
+        self.placedAt = None
+        self.stopLossAt = None
+
+    @classmethod
+    def fromRecord(cls, record):
+        position = cls(record['marketId'], state=JOURNAL_STATES.get(
+            record.get('state'), PENDING_BACK))
+        position.update(record)
+        return position
+
+    def update(self, fields):
+        # copies known attributes, ignoring journal only fields (ts, reason, ...)
+        for name, value in fields.items():
+            if name in Position.__slots__ and name != 'state':
+                setattr(self, name, value)
+
+        if self.placedDate is not None and self.placedAt is None:
+            self.placedAt = datetime.datetime.strptime(
+                self.placedDate, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def toRecord(self):
+        record = {'state': STATE_EVENTS[self.state]}
+        for name in Position.__slots__:
+            value = getattr(self, name)
+            if value is not None and name not in ('state', 'placedAt', 'stopLossAt'):
+                record[name] = value
+        return record
+
+    def __repr__(self):
+        return 'Position(%s, %s)' % (self.marketId, self.state)
+
+# ----------------------------------
+# REGISTRY
+# ----------------------------------
+
+
+class PositionRegistry:
+    '''
+    Open positions indexed by marketId and by state, with a min-heap of stop loss
+    deadlines so that HEDGE_WORKING positions are promoted to STOP_LOSS_STEPPING
+    without re-deriving their placedDate every tick.
+    '''
+
+    def __init__(self):
+        self.positions = {}
+        self.byState = {state: {} for state in OPEN_STATES}
+        self.deadlines = []
+
+    def __contains__(self, marketId):
+        return marketId in self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return iter(list(self.positions.values()))
+
+    def get(self, marketId):
+        return self.positions.get(marketId)
+
+    def marketIds(self):
+        return list(self.positions.keys())
+
+    def add(self, position):
+        self.positions[position.marketId] = position
+        self.byState[position.state][position.marketId] = position
+        if position.stopLossAt is not None:
+            heapq.heappush(self.deadlines,
+                           (position.stopLossAt, position.marketId))
+        return position
+
+    def transition(self, position, state):
+        if position.state == state:
+            return
+
+        del self.byState[position.state][position.marketId]
+        position.state = state
+
+        if state == CLOSED:
+            del self.positions[position.marketId]
+        else:
+            self.byState[state][position.marketId] = position
+
+    def remove(self, marketId):
+        position = self.positions.get(marketId)
+        if position is not None:
+            self.transition(position, CLOSED)
+            self.compactDeadlines()
+        return position
+
+    def scheduleStopLoss(self, position, stopLossAt):
+        position.stopLossAt = stopLossAt
+        heapq.heappush(self.deadlines, (stopLossAt, position.marketId))
+
+    def compactDeadlines(self):
+        # closed positions leave their deadline on the heap until it falls due - rebuild once they outnumber the live ones
+        if len(self.deadlines) <= 2 * len(self.positions) + 64:
+            return
+        self.deadlines = [(position.stopLossAt, position.marketId) for position in self.positions.values()
+                          if position.stopLossAt is not None]
+        heapq.heapify(self.deadlines)
+
+    def popDue(self, now):
+        # stale heap entries (closed or rescheduled positions) are dropped lazily
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            stopLossAt, marketId = heapq.heappop(self.deadlines)
+            position = self.positions.get(marketId)
+            if position is None or position.stopLossAt != stopLossAt:
+                continue
+            if position.state in (BACKED, HEDGE_WORKING):
+                due.append(position)
+        return due
+
+    def inState(self, *states):
+        positions = []
+        for state in states:
+            positions.extend(self.byState[state].values())
+        return positions
+
+    def counts(self):
+        return {state: len(self.byState[state]) for state in OPEN_STATES}
@@ -0,0 +1,423 @@
+import argparse
+import datetime
+import os
+import struct
+import time
+
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+from betfair import Betfair
+from betfair import BetfairSettings
+from hedging import HedgedReads
+from resilience import Resilience
+from codec import MarketBook
+from codec import RunnerBook
+from daemon import OverUnderStrategy
+from eventlog import log
+from metrics import metrics
+
+# ----------------------------------
+# TABLE LAYOUT
+# ----------------------------------
+
+MAGIC = b'OUPRICE2'
+
+# magic, slot size, capacity, slots in use, generation (bumped when slots are recycled)
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_SIZE = 64
+
+# seq | marketNumber, selectionId, version | back, backSize, lay, laySize, lastPriceTraded, updatedAt
+#     | marketPrefix, marketStatus, runnerStatus, inplay, marketNumberDigits
+SEQ = struct.Struct('<Q')
+SLOT_BODY = struct.Struct('<qqqddddddBBBBB3x')
+SLOT_SIZE = SEQ.size + SLOT_BODY.size
+MAX_READ_ATTEMPTS = 10000
+
+MARKET_STATUSES = ('', 'INACTIVE', 'OPEN', 'SUSPENDED', 'CLOSED')
+RUNNER_STATUSES = ('', 'ACTIVE', 'WINNER', 'LOSER',
+                   'PLACED', 'REMOVED_VACANT', 'REMOVED', 'HIDDEN')
+MARKET_STATUS_CODES = {status: code for code,
+                       status in enumerate(MARKET_STATUSES)}
+RUNNER_STATUS_CODES = {status: code for code,
+                       status in enumerate(RUNNER_STATUSES)}
+
+# ----------------------------------
+# PRICE TABLE
+# ----------------------------------
+
+
+class PriceTable:
+    '''
+    Fixed layout table of best prices per (marketId, selectionId) in a named
+    multiprocessing.shared_memory block, written by one feeder process and read by
+    any number of strategy processes.
+
+    Each slot is guarded by a sequence number (seqlock): the writer makes it odd,
+    writes the slot and makes it even again; a reader unpacks straight from the
+    shared buffer and retries if the sequence was odd or changed underneath it, so
+    readers never lock or block the writer. Slots are claimed in order and keys
+    never move, except that the feeder recycles slots of CLOSED markets when full
+    and then bumps the header's generation; a reader rebuilds its index when a
+    lookup misses and the generation moved, or when it reads a changed key. A
+    market's slots are all claimed before any is written, so a reader never sees
+    part of its runners.
+    '''
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.buffer = shm.buf
+        magic, slotSize, self.capacity, count, self.generation = HEADER.unpack_from(
+            self.buffer, 0)
+        if magic != MAGIC or slotSize != SLOT_SIZE:
+            raise ValueError('%s is not a price table' % shm.name)
+
+        # (marketId, selectionId) -> slot, marketId -> [slot]
+        self.slots = {}
+        self.marketSlots = {}
+        self.indexedCount = 0
+        self.indexedGeneration = None
+
+    @classmethod
+    def create(cls, name, capacity=4096):
+        shm = shared_memory.SharedMemory(
+            name=name, create=True, size=HEADER_SIZE + capacity * SLOT_SIZE)
+        HEADER.pack_into(shm.buf, 0, MAGIC, SLOT_SIZE, capacity, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before 3.13 attaching registers the block with the resource tracker,
+            # which would unlink it when this reader exits
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm, owner=False)
+
+    def close(self):
+        self.buffer.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# ----------------------------------
+# WRITER
+# ----------------------------------
+    def publish(self, marketBook, now=None):
+        # one slot per runner; returns False, writing nothing, when the table has no room for the market
+        now = time.time() if now is None else now
+        prefix, number, digits = splitMarketId(marketBook.marketId)
+        marketStatus = MARKET_STATUS_CODES.get(marketBook.status, 0)
+        inplay = 1 if marketBook.inplay else 0
+        version = marketBook.version or 0
+
+        count = self.slotCount()
+        missing = [runner.selectionId for runner in marketBook.runners
+                   if (marketBook.marketId, runner.selectionId) not in self.slots]
+        claimed = self.claimSlots(
+            marketBook.marketId, missing, count) if missing else []
+        if claimed is None:
+            return False
+
+        for runner in marketBook.runners:
+            slot = self.slots[(marketBook.marketId, runner.selectionId)]
+            back, backSize = runner.availableToBack[0] if runner.availableToBack else (
+                0.0, 0.0)
+            lay, laySize = runner.availableToLay[0] if runner.availableToLay else (
+                0.0, 0.0)
+            self.writeSlot(slot, (number, runner.selectionId, version, back, backSize, lay, laySize,
+                                  runner.lastPriceTraded or 0.0, now, prefix, marketStatus,
+                                  RUNNER_STATUS_CODES.get(runner.status, 0), inplay, digits))
+
+        # readers only index slots below the count and rebuild on a new generation, so both follow the keys
+        fresh = len([slot for slot in claimed if slot >= count])
+        if fresh < len(claimed):
+            self.generation = self.generation + 1
+        if claimed:
+            HEADER.pack_into(self.buffer, 0, MAGIC, SLOT_SIZE,
+                             self.capacity, count + fresh, self.generation)
+        return True
+
+    def claimSlots(self, marketId, selectionIds, count):
+        # slots past the count first, then recycled ones of CLOSED markets; all of them or None
+        slots = list(range(count, min(count + len(selectionIds), self.capacity)))
+        if len(slots) < len(selectionIds):
+            recycled = self.recycleClosedSlots(
+                len(selectionIds) - len(slots), marketId)
+            if recycled is None:
+                return None
+            slots.extend(recycled)
+
+        for selectionId, slot in zip(selectionIds, slots):
+            self.slots[(marketId, selectionId)] = slot
+            self.marketSlots.setdefault(marketId, []).append(slot)
+        return slots
+
+    def recycleClosedSlots(self, needed, forMarketId):
+        closed = []
+        for key, slot in self.slots.items():
+            values = self.readSlot(slot)
+            if key[0] != forMarketId and values is not None and values[10] == MARKET_STATUS_CODES['CLOSED']:
+                closed.append(key)
+                if len(closed) == needed:
+                    break
+        if len(closed) < needed:
+            return None
+
+        slots = []
+        for marketId, selectionId in closed:
+            slot = self.slots.pop((marketId, selectionId))
+            self.marketSlots[marketId].remove(slot)
+            if not self.marketSlots[marketId]:
+                del self.marketSlots[marketId]
+            slots.append(slot)
+        return slots
+
+    def writeSlot(self, slot, values):
+        offset = HEADER_SIZE + slot * SLOT_SIZE
+        seq = SEQ.unpack_from(self.buffer, offset)[0]
+        SEQ.pack_into(self.buffer, offset, seq + 1)
+        SLOT_BODY.pack_into(self.buffer, offset + SEQ.size, *values)
+        SEQ.pack_into(self.buffer, offset, seq + 2)
+
+# ----------------------------------
+# READER
+# ----------------------------------
+    def readSlot(self, slot):
+        # None if no consistent read was possible (e.g. the writer died mid write)
+        offset = HEADER_SIZE + slot * SLOT_SIZE
+        buffer = self.buffer
+        for attempt in range(MAX_READ_ATTEMPTS):
+            seq = SEQ.unpack_from(buffer, offset)[0]
+            if seq & 1:
+                continue
+            values = SLOT_BODY.unpack_from(buffer, offset + SEQ.size)
+            if SEQ.unpack_from(buffer, offset)[0] == seq:
+                return values
+        return None
+
+    def slotCount(self):
+        return HEADER.unpack_from(self.buffer, 0)[3]
+
+    def refreshIndex(self, rebuild=False):
+        count, generation = HEADER.unpack_from(self.buffer, 0)[3:5]
+        if rebuild or generation != self.indexedGeneration:
+            self.slots = {}
+            self.marketSlots = {}
+            self.indexedCount = 0
+            self.indexedGeneration = generation
+
+        for slot in range(self.indexedCount, count):
+            values = self.readSlot(slot)
+            if values is None:
+                count = slot
+                break
+            marketId = joinMarketId(values[9], values[0], values[13])
+            self.slots[(marketId, values[1])] = slot
+            self.marketSlots.setdefault(marketId, []).append(slot)
+        self.indexedCount = count
+
+    def marketBook(self, marketId, maxAgeSeconds=5.0, now=None):
+        # MarketBook with best offers only, or None if absent or stale
+        slots = self.marketSlots.get(marketId)
+        if slots is None:
+            self.refreshIndex()
+            slots = self.marketSlots.get(marketId)
+            if slots is None:
+                return None
+
+        now = time.time() if now is None else now
+        prefix, number, digits = splitMarketId(marketId)
+        runners = []
+        marketStatus = inplay = version = None
+
+        for slot in slots:
+            values = self.readSlot(slot)
+            if values is None:
+                return None
+            if values[0] != number or values[9] != prefix:
+                # slot recycled for another market
+                self.refreshIndex(rebuild=True)
+                return None
+            if now - values[8] > maxAgeSeconds:
+                return None
+
+            version, marketStatus, inplay = values[2], values[10], values[12]
+            runners.append(RunnerBook(values[1], RUNNER_STATUSES[values[11]], values[7] or None,
+                                      [(values[3], values[4])] if values[3] else [],
+                                      [(values[5], values[6])] if values[5] else []))
+
+        return MarketBook(marketId, MARKET_STATUSES[marketStatus], bool(inplay), version, runners=runners)
+
+# ----------------------------------
+# STRATEGY SIDE CLIENT
+# ----------------------------------
+
+
+class FeedBetfair(Betfair):
+    # reads best offers from the shared table; only markets the feeder does not carry hit the API
+
+    def __init__(self, settings, priceTable, maxAgeSeconds=5.0):
+        Betfair.__init__(self, settings)
+        self.priceTable = priceTable
+        self.maxAgeSeconds = maxAgeSeconds
+
+    def getMarketBookBestOffers(self, marketId):
+        marketBook = self.priceTable.marketBook(marketId, self.maxAgeSeconds)
+        if marketBook is not None:
+            metrics.inc('pricefeed_reads_total', (('result', 'hit'),))
+            return [marketBook]
+
+        metrics.inc('pricefeed_reads_total', (('result', 'miss'),))
+        return Betfair.getMarketBookBestOffers(self, marketId)
+
+    def listMarketBooks(self, marketIds):
+        # table hits as they are, the misses in one request (dropped if it fails)
+        marketBooks = []
+        missing = []
+        for marketId in marketIds:
+            marketBook = self.priceTable.marketBook(marketId, self.maxAgeSeconds)
+            if marketBook is None:
+                missing.append(marketId)
+            else:
+                marketBooks.append(marketBook)
+        metrics.inc('pricefeed_reads_total', (('result', 'hit'),), len(marketBooks))
+        if not missing:
+            return marketBooks
+
+        metrics.inc('pricefeed_reads_total', (('result', 'miss'),), len(missing))
+        return marketBooks + (Betfair.listMarketBooks(self, missing) or [])
+
+# ----------------------------------
+# FEEDER
+# ----------------------------------
+
+
+class PriceFeeder:
+    '''
+    Owns price collection for every strategy process on the host: discovers the
+    markets of interest from kick off (lookAheadMinutes ahead) to inPlayMinutes
+    after, and publishes their books into the price table each interval, batching
+    marketIds per listMarketBook call.
+    '''
+
+    def __init__(self, betfairSettings, priceTable, marketNames, lookAheadMinutes=15, inPlayMinutes=120,
+                 intervalSeconds=1.0, discoverySeconds=60, marketsPerRequest=40, betfairFactory=Betfair):
+        self.betfairSettings = betfairSettings
+        self.priceTable = priceTable
+        self.marketNames = set(marketNames)
+        self.lookAheadMinutes = lookAheadMinutes
+        self.inPlayMinutes = inPlayMinutes
+        self.intervalSeconds = intervalSeconds
+        self.discoverySeconds = discoverySeconds
+        self.marketsPerRequest = marketsPerRequest
+        self.betfairFactory = betfairFactory
+
+        self.sessionTokenExpiresAt = datetime.datetime.now()
+        self.sessionTokenValidForMinutes = 10
+        self.betfair = None
+        self.marketIds = []
+        self.nextDiscoveryAt = 0
+
+    # same certificate login as the strategy
+    refreshSessionToken = OverUnderStrategy.refreshSessionToken
+
+    def run(self):
+        while True:
+            startedAt = time.monotonic()
+            self.tick()
+            time.sleep(max(0.0, self.intervalSeconds -
+                           (time.monotonic() - startedAt)))
+
+    def tick(self):
+        if self.sessionTokenExpiresAt < datetime.datetime.now():
+            self.refreshSessionToken()
+        self.betfair = self.betfairFactory(self.betfairSettings)
+
+        if time.time() >= self.nextDiscoveryAt:
+            self.discover()
+
+        with metrics.time('pricefeed_publish_seconds'):
+            for i in range(0, len(self.marketIds), self.marketsPerRequest):
+                marketBooks = self.betfair.listMarketBooks(
+                    self.marketIds[i:i + self.marketsPerRequest])
+                if marketBooks is None:
+                    continue
+
+                now = time.time()
+                for marketBook in marketBooks:
+                    if not self.priceTable.publish(marketBook, now):
+                        metrics.inc('pricefeed_table_full_total')
+                        log.warning('PRICEFEED_TABLE_FULL',
+                                    marketId=marketBook.marketId)
+
+    def discover(self):
+        now = time.time()
+        markets = self.betfair.streamMarketCatalogueInWindow('1', formatDateTime(now - self.inPlayMinutes * 60),
+                                                             formatDateTime(
+                                                                 now + self.lookAheadMinutes * 60),
+                                                             lambda market: market.marketName in self.marketNames)
+        marketIds = self.betfair.collect(
+            market.marketId for market in markets)
+        if marketIds is None:
+            return
+
+        self.marketIds = marketIds
+        self.nextDiscoveryAt = now + self.discoverySeconds
+        metrics.set('pricefeed_markets', len(self.marketIds))
+        log.info('PRICEFEED_MARKETS', markets=len(self.marketIds))
+
+# ----------------------------------
+# HELPERS
+# ----------------------------------
+
+
+def splitMarketId(marketId):
+    prefix, number = marketId.split('.', 1)
+    return int(prefix), int(number), len(number)
+
+
+def joinMarketId(prefix, number, digits):
+    return '%d.%0*d' % (prefix, digits, number)
+
+
+def formatDateTime(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+# ----------------------------------
+# MAIN
+# ----------------------------------
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Publishes best prices for every strategy process on this host into shared memory.')
+    parser.add_argument('--name', default='overunder-prices')
+    parser.add_argument('--capacity', type=int, default=4096,
+                        help='selections the table can hold')
+    parser.add_argument('--markets', default='Over/Under 2.5 Goals',
+                        help='comma separated market names')
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--metrics-port', type=int, default=9101)
+    args = parser.parse_args()
+
+    betfairSettings = BetfairSettings(os.environ.get("BETFAIR_LIVE_KEY"), None, "https://api.betfair.com/exchange/betting/json-rpc/v1",
+                                      "https://api.betfair.com/exchange/account/json-rpc/v1", timeoutSeconds=5.0, hedging=HedgedReads(), resilience=Resilience())
+
+    metrics.serve(args.metrics_port)
+
+    priceTable = PriceTable.create(args.name, args.capacity)
+    feeder = PriceFeeder(betfairSettings, priceTable, args.markets.split(','),
+                         intervalSeconds=args.interval)
+
+    try:
+        feeder.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+    priceTable.close()
+    log.close()
@@ -0,0 +1,183 @@
+import array
+import collections
+import itertools
+import operator
+
+# ----------------------------------
+# SELECTION HISTORY
+# ----------------------------------
+
+FIELDS = ('timestamp', 'back', 'lay', 'lastPriceTraded', 'totalMatched')
+
+
+class SelectionHistory:
+    '''
+    Fixed capacity ring buffer of one selection's prices: timestamp, best back,
+    best lay, last traded price and the runner's cumulative matched volume, one
+    preallocated array('d') per field (capacity * 40 bytes in all). Appends
+    overwrite the oldest sample in place; window queries find the first sample at
+    or after `since` by bisection (samples arrive in time order) and reduce
+    the window with C level builtins over array slices.
+    '''
+
+    __slots__ = ('capacity', 'count', 'head') + FIELDS
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.head = 0
+        for field in FIELDS:
+            setattr(self, field, array.array('d', bytes(8 * capacity)))
+
+    @property
+    def nbytes(self):
+        return len(FIELDS) * 8 * self.capacity
+
+    def append(self, timestamp, back, lay, lastPriceTraded, totalMatched):
+        # missing prices are stored as 0.0
+        head = self.head
+        self.timestamp[head] = timestamp
+        self.back[head] = back or 0.0
+        self.lay[head] = lay or 0.0
+        self.lastPriceTraded[head] = lastPriceTraded or 0.0
+        self.totalMatched[head] = totalMatched or 0.0
+
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count = self.count + 1
+
+    def latest(self, field='back'):
+        if self.count == 0:
+            return None
+        return getattr(self, field)[self.head - 1]
+
+# ----------------------------------
+# WINDOWS
+# ----------------------------------
+    def samplesSince(self, since):
+        # samples with timestamp >= since, by bisection over the logical order
+        start = self.head - self.count
+        timestamp = self.timestamp
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if timestamp[(start + middle) % self.capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return self.count - low
+
+    def window(self, field, since):
+        # the field's values since `since`, oldest first, as one array
+        values = getattr(self, field)
+        size = self.samplesSince(since)
+        start = (self.head - size) % self.capacity
+        if size == 0:
+            return values[0:0]
+        if start + size <= self.capacity:
+            return values[start:start + size]
+        return values[start:] + values[:self.head]
+
+    def tickCount(self, since, field='back'):
+        # how many times the price changed since `since`
+        values = self.window(field, since)
+        return sum(map(operator.ne, values[1:], values[:-1]))
+
+    def vwap(self, since):
+        '''
+        Volume weighted last traded price over the window: each step's increase in
+        matched volume is attributed to the last traded price at its end. None
+        when nothing traded in the window.
+        '''
+        volumes = self.window('totalMatched', since)
+        prices = self.window('lastPriceTraded', since)[1:]
+        traded = list(map(operator.sub, volumes[1:], volumes[:-1]))
+        volume = sum(traded)
+        if volume <= 0.0:
+            return None
+        return sum(map(operator.mul, prices, traded)) / volume
+
+    def slope(self, since, field='back'):
+        # least squares price change per second, None with fewer than 2 priced samples
+        timestamps = self.window('timestamp', since)
+        values = self.window(field, since)
+        if 0.0 in values:
+            pairs = [(t, v) for t, v in zip(timestamps, values) if v != 0.0]
+            timestamps = array.array('d', [t for t, v in pairs])
+            values = array.array('d', [v for t, v in pairs])
+
+        n = len(values)
+        if n < 2:
+            return None
+        # centred on the first sample so epoch seconds squared keep their precision
+        times = array.array('d', map(operator.sub, timestamps,
+                                     itertools.repeat(timestamps[0])))
+        sumT = sum(times)
+        sumV = sum(values)
+        sumTT = sum(map(operator.mul, times, times))
+        sumTV = sum(map(operator.mul, times, values))
+        denominator = n * sumTT - sumT * sumT
+        if denominator == 0.0:
+            return None
+        return (n * sumTV - sumT * sumV) / denominator
+
+# ----------------------------------
+# PRICE HISTORY
+# ----------------------------------
+
+
+class PriceHistory:
+    '''
+    SelectionHistory per (marketId, selectionId), fed from market books. At most
+    maxSelections are tracked, the least recently updated selection's buffers
+    are dropped beyond that, so memory is bounded by
+    maxSelections * capacity * 40 bytes - 3.7 MB by default, an hour of 10
+    second ticks for each of 256 selections. The daemon only feeds the selections
+    it is about to enter or holds a position on. expire() drops selections that
+    have not been updated for a while, long before the count bound is reached.
+    '''
+
+    def __init__(self, capacity=360, maxSelections=256):
+        self.capacity = capacity
+        self.maxSelections = maxSelections
+        self.selections = collections.OrderedDict()
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        return len(self.selections) * len(FIELDS) * 8 * self.capacity
+
+    def record(self, marketBook, now, selectionIds=None):
+        for runner in marketBook.runners:
+            if selectionIds is not None and runner.selectionId not in selectionIds:
+                continue
+
+            key = (marketBook.marketId, runner.selectionId)
+            history = self.selections.get(key)
+            if history is None:
+                history = self.selections[key] = SelectionHistory(
+                    self.capacity)
+                if len(self.selections) > self.maxSelections:
+                    self.selections.popitem(last=False)
+                    self.evictions = self.evictions + 1
+            else:
+                self.selections.move_to_end(key)
+
+            history.append(now, runner.availableToBack[0][0] if runner.availableToBack else None,
+                           runner.availableToLay[0][0] if runner.availableToLay else None,
+                           runner.lastPriceTraded, runner.totalMatched)
+
+    def get(self, marketId, selectionId):
+        return self.selections.get((marketId, selectionId))
+
+    def discard(self, marketId):
+        for key in [key for key in self.selections if key[0] == marketId]:
+            del self.selections[key]
+
+    def expire(self, before):
+        # least recently updated first, so stop at the first selection updated since `before`
+        while self.selections:
+            key, history = next(iter(self.selections.items()))
+            if history.latest('timestamp') >= before:
+                return
+            del self.selections[key]
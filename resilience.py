@@ -0,0 +1,230 @@
+import random
+import threading
+import time
+
+from eventlog import log
+from hedging import READ_OPERATIONS
+from metrics import metrics
+
+ENDPOINTS = ('betting', 'accounts', 'identity')
+
+CLOSED = 'CLOSED'
+OPEN = 'OPEN'
+HALF_OPEN = 'HALF_OPEN'
+
+# exported as betfair_circuit_state
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint):
+        Exception.__init__(self, '%s: circuit open' % endpoint)
+        self.endpoint = endpoint
+
+
+def isTransient(error):
+    # transport failures, 5xx and 429; any other answer means the endpoint is up
+    status = getattr(error, 'code', None)
+    response = getattr(error, 'response', None)
+    if response is not None:
+        status = getattr(response, 'status_code', status)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return isinstance(error, OSError)
+
+# ----------------------------------
+# CIRCUIT BREAKER
+# ----------------------------------
+
+
+class CircuitBreaker:
+    '''
+    Fails calls to one endpoint fast while it is down. failureThreshold
+    consecutive transport failures open the circuit; after resetSeconds a single
+    call goes through as a probe (HALF_OPEN) - its success closes the circuit,
+    its failure opens it for another resetSeconds.
+    '''
+
+    def __init__(self, endpoint, failureThreshold=5, resetSeconds=30.0, clock=time.monotonic):
+        self.endpoint = endpoint
+        self.failureThreshold = failureThreshold
+        self.resetSeconds = resetSeconds
+        self.clock = clock
+        self.labels = (('endpoint', endpoint),)
+
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.probing = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+        metrics.set('betfair_circuit_state', STATE_VALUES[CLOSED], self.labels)
+
+    def allow(self):
+        with self.lock:
+            if self.state == OPEN and self.clock() - self.openedAt >= self.resetSeconds:
+                self.transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejected = self.rejected + 1
+
+        metrics.inc('betfair_circuit_rejections_total', self.labels)
+        return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != CLOSED:
+                self.transition(CLOSED)
+
+    def failure(self, error):
+        with self.lock:
+            self.failures = self.failures + 1
+            self.probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failureThreshold):
+                self.openedAt = self.clock()
+                self.transition(OPEN, error)
+
+    def release(self):
+        # the call failed for a reason that says nothing about the endpoint
+        with self.lock:
+            self.probing = False
+
+    def transition(self, state, error=None):
+        # called under the lock
+        self.state = state
+        metrics.set('betfair_circuit_state', STATE_VALUES[state], self.labels)
+        metrics.inc('betfair_circuit_transitions_total',
+                    self.labels + (('state', state),))
+        if state == OPEN:
+            log.error('CIRCUIT_OPEN', endpoint=self.endpoint, failures=self.failures,
+                      resetSeconds=self.resetSeconds, error=repr(error))
+        else:
+            log.warning('CIRCUIT_' + state, endpoint=self.endpoint)
+
+# ----------------------------------
+# RESILIENCE
+# ----------------------------------
+
+
+class Resilience:
+    '''
+    Timeouts, retries and circuit breakers for the API-NG transport, shared by
+    every client built from one BetfairSettings (clients are rebuilt each tick).
+
+    - timeouts: inside a tick (startTick(deadline) .. endTick()) a request gets
+      what is left of the tick budget, clamped to [minTimeoutSeconds, the
+      settings' timeoutSeconds]. Orders get at least minOrderTimeoutSeconds, as
+      an order cut short leaves its outcome unknown. The deadline is kept per
+      thread: the ledger and validation threads keep the settings' timeout.
+    - retries: reads (READ_OPERATIONS) that fail in transport - connection
+      errors, timeouts, 5xx, 429 - are sent again up to attempts times in all,
+      after a full jitter backoff, while the circuit is closed and the tick has
+      time left for another attempt. Orders are never retried.
+    - circuit breakers: one per endpoint (betting, accounts, identity); while
+      one is open its calls raise CircuitOpenError without being sent.
+    '''
+
+    def __init__(self, attempts=3, baseDelaySeconds=0.1, maxDelaySeconds=1.0, minTimeoutSeconds=0.5, minOrderTimeoutSeconds=3.0,
+                 failureThreshold=5, resetSeconds=30.0, clock=time.monotonic, seed=None):
+        self.attempts = attempts
+        self.baseDelaySeconds = baseDelaySeconds
+        self.maxDelaySeconds = maxDelaySeconds
+        self.minTimeoutSeconds = minTimeoutSeconds
+        self.minOrderTimeoutSeconds = minOrderTimeoutSeconds
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.breakers = dict((endpoint, CircuitBreaker(endpoint, failureThreshold, resetSeconds, clock))
+                             for endpoint in ENDPOINTS)
+        self.tick = threading.local()
+        self.retries = 0
+
+    def startTick(self, deadline):
+        # deadline on the clock, normally the TickExecutor's budget end; applies to this thread's requests
+        self.tick.deadline = deadline
+
+    def endTick(self):
+        self.tick.deadline = None
+
+    def tickDeadline(self):
+        return getattr(self.tick, 'deadline', None)
+
+    def available(self, endpoint):
+        # False while the endpoint's circuit is open (a probe may still be due)
+        breaker = self.breakers[endpoint]
+        return breaker.state != OPEN or self.clock() - breaker.openedAt >= breaker.resetSeconds
+
+    def timeout(self, operation, timeoutSeconds):
+        deadline = self.tickDeadline()
+        if deadline is None:
+            return timeoutSeconds
+        floor = self.minTimeoutSeconds if operation in READ_OPERATIONS else self.minOrderTimeoutSeconds
+        return min(timeoutSeconds, max(floor, deadline - self.clock()))
+
+    def backoff(self, attempt):
+        return self.random.uniform(0.0, min(self.maxDelaySeconds, self.baseDelaySeconds * 2 ** (attempt - 1)))
+
+    def call(self, endpoint, operation, send, timeoutSeconds):
+        '''
+        send(timeout) posts the request and returns the response, raising on
+        transport errors; timeoutSeconds is the ceiling for each attempt. Raises
+        CircuitOpenError, or the last attempt's error.
+        '''
+        breaker = self.breakers[endpoint]
+        if not breaker.allow():
+            raise CircuitOpenError(endpoint)
+
+        attempts = self.attempts if operation in READ_OPERATIONS else 1
+        attempt = 1
+        while True:
+            try:
+                response = send(self.timeout(operation, timeoutSeconds))
+            except Exception as e:
+                if not isTransient(e):
+                    breaker.release()
+                    raise
+                breaker.failure(e)
+                delay = self.backoff(attempt)
+                deadline = self.tickDeadline()
+                if attempt >= attempts or breaker.state != CLOSED or \
+                        (deadline is not None and deadline - self.clock() < delay + self.minTimeoutSeconds):
+                    raise
+                metrics.inc('betfair_retries_total',
+                            (('operation', operation),))
+                self.retries = self.retries + 1
+                log.debug('APING_RETRY', operation=operation,
+                          attempt=attempt, delay=round(delay, 3), error=repr(e))
+                time.sleep(delay)
+                attempt = attempt + 1
+                continue
+
+            breaker.success()
+            return response
+
+    def stream(self, endpoint, operation, openChunks, timeoutSeconds):
+        '''
+        A streamed read is retried up to its first chunk, the part a call can
+        send again; a transport failure after that counts against the circuit
+        and is raised to the reader.
+        '''
+        def firstChunk(timeout):
+            chunks = openChunks(timeout)
+            return next(chunks, b''), chunks
+
+        first, chunks = self.call(endpoint, operation, firstChunk, timeoutSeconds)
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            if isTransient(e):
+                self.breakers[endpoint].failure(e)
+            raise
+
+    def report(self):
+        return {'retries': self.retries,
+                'circuits': dict((endpoint, breaker.state) for endpoint, breaker in self.breakers.items()),
+                'rejected': dict((endpoint, breaker.rejected) for endpoint, breaker in self.breakers.items())}
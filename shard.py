@@ -0,0 +1,630 @@
+import bisect
+import datetime
+import hashlib
+import multiprocessing
+import os
+import queue
+import time
+
+from betfair import BetfairSettings
+from daemon import OverUnderStrategy
+from daemon import StagedMarket
+from daemon import StrategySettings
+from eventlog import log
+from hedging import HedgedReads
+from resilience import Resilience
+from journal import OPENED
+from metrics import metrics
+from position import Position
+
+# ----------------------------------
+# HASH RING
+# ----------------------------------
+
+
+def hashKey(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    '''
+    Consistent hashing of marketIds onto shard ids. Each shard holds `replicas`
+    points on a 64 bit ring and a key belongs to the first point at or after its
+    hash, so adding or removing a shard only moves the keys on the arcs it gains
+    or loses - about 1/N of them - and every other market keeps its owner.
+    '''
+
+    def __init__(self, shardIds=(), replicas=64):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for shardId in shardIds:
+            self.add(shardId)
+
+    def __len__(self):
+        return len(set(self.owners.values()))
+
+    def __contains__(self, shardId):
+        return shardId in self.owners.values()
+
+    def add(self, shardId):
+        for replica in range(self.replicas):
+            point = hashKey('%s#%d' % (shardId, replica))
+            self.owners[point] = shardId
+            bisect.insort(self.points, point)
+
+    def remove(self, shardId):
+        self.points = [point for point in self.points
+                       if self.owners[point] != shardId]
+        self.owners = dict((point, owner) for point, owner in self.owners.items()
+                           if owner != shardId)
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect_left(self.points, hashKey(key))
+        return self.owners[self.points[index % len(self.points)]]
+
+# ----------------------------------
+# WORKER
+# ----------------------------------
+
+
+class ShardWorker(OverUnderStrategy):
+    '''
+    Position management for one shard, in its own process with its own client,
+    journal and ledger. It trades the positions it owns and enters the events the
+    coordinator assigns to it (already staged, their markets hashed to this
+    shard); discovery and the account wide risk limit are the coordinator's.
+    Messages are read at the start of each tick and a report of its open
+    positions, liability and stake still waiting for entry is sent at the end.
+    '''
+
+    def __init__(self, shardId, inbox, outbox, strategySettings, betfairSettings, journalPath, **options):
+        self.shardId = shardId
+        self.inbox = inbox
+        self.outbox = outbox
+        self.lastSeq = 0
+        self.assignments = {}
+        self.stopping = False
+        OverUnderStrategy.__init__(self, strategySettings, betfairSettings,
+                                   journalPath=journalPath, exclusionRulesPath=None, **options)
+
+    def refreshSessionToken(self):
+        # the coordinator logs in and sends the token on
+        self.sessionTokenExpiresAt = datetime.datetime.now(
+        ) + datetime.timedelta(minutes=self.sessionTokenValidForMinutes)
+
+    def bootstrapPositions(self):
+        # the coordinator reconciles the account across shards and hands over unowned markets
+        self.replayJournal()
+        self.journal.compact(
+            {position.marketId: position.toRecord() for position in self.positions})
+
+    def resolveEventMarkets(self, event):
+        # a deferred event takes the full path again - only this shard's markets of it
+        markets = OverUnderStrategy.resolveEventMarkets(self, event)
+        if not markets:
+            return markets
+        return [market for market in markets if market.marketId in self.assignments]
+
+    def iterationStages(self):
+        self.receive()
+        self.betfair = self.betfairFactory(self.betfairSettings)
+
+        self.runTasks([('positions', self.managePositions), ('reconcile', self.reconcileFunds),
+                       ('entry', self.enterPositions)])
+
+        self.journal.sync()
+        self.priceHistory.expire(time.time() - self.priceHistoryIdleSeconds)
+        self.changes.expire(time.time() - self.priceHistoryIdleSeconds)
+        self.report()
+
+    def run(self, intervalSeconds):
+        parent = multiprocessing.parent_process()
+        nextRunAt = time.monotonic()
+        while not self.stopping and (parent is None or parent.is_alive()):
+            self.iteration()
+            nextRunAt = max(nextRunAt + intervalSeconds, time.monotonic())
+            time.sleep(max(0.0, nextRunAt - time.monotonic()))
+
+        self.ledger.stop()
+        self.journal.close()
+
+# ----------------------------------
+# WORKER MESSAGES
+# ----------------------------------
+    def receive(self):
+        while True:
+            try:
+                message = self.inbox.get_nowait()
+            except queue.Empty:
+                return
+
+            # (kind, seq, payload...) - the report echoes the last seq applied
+            kind = message[0]
+            if kind == 'enter':
+                self.assign(message[2], message[3])
+            elif kind == 'adopt':
+                self.adopt(message[2])
+            elif kind == 'release':
+                self.release(message[2])
+            elif kind == 'session':
+                self.betfairSettings.sessionToken = message[2]
+                self.betfairSettings.updateHeaders()
+                self.sessionTokenExpiresAt = datetime.datetime.fromisoformat(
+                    message[3])
+            elif kind == 'stop':
+                self.stopping = True
+            self.lastSeq = message[1]
+
+    def assign(self, event, stagedStates):
+        eventId = event['event']['id']
+        stagedMarkets = [StagedMarket.fromState(
+            state) for state in stagedStates]
+        for staged in stagedMarkets:
+            self.assignments[staged.market.marketId] = (eventId, staged.stake)
+
+        # entered when it reaches the placement window; an event already popped is offered again
+        self.stagedEvents.setdefault(eventId, []).extend(stagedMarkets)
+        if self.eventCalendar.kickOff(eventId) is None:
+            self.eventCalendar.add(event)
+        elif eventId not in self.eventCalendar.events:
+            self.eventCalendar.defer(event)
+
+    def adopt(self, records):
+        for record in records:
+            marketId = record['marketId']
+            if marketId in self.positions:
+                continue
+            position = Position.fromRecord(record)
+            if position.placedAt is not None:
+                position.stopLossAt = self.stopLossDeadline(position.placedAt)
+            self.positions.add(position)
+
+            # journalled in its current state, so a restart replays it
+            fields = dict((name, value) for name, value in record.items()
+                          if name not in ('marketId', 'state'))
+            self.journal.record(record.get('state', OPENED),
+                                marketId, adopted=True, **fields)
+            log.info('SHARD_ADOPTED', shard=self.shardId,
+                     marketId=marketId, state=position.state)
+
+    def release(self, marketIds):
+        records = []
+        for marketId in marketIds:
+            position = self.positions.get(marketId)
+            if position is None:
+                continue
+            records.append(position.toRecord())
+            self.closePosition(marketId, 'RELEASED')
+        # marketIds closed in the meantime come back without a record
+        self.outbox.put(('released', self.shardId, marketIds, records))
+
+    def report(self):
+        now = time.time()
+        for marketId, (eventId, stake) in list(self.assignments.items()):
+            kickOff = self.eventCalendar.kickOff(eventId)
+            if marketId in self.positions or kickOff is None or kickOff < now:
+                del self.assignments[marketId]
+
+        # the worker never refreshes its calendar, so kicked off fixtures are forgotten here
+        for eventId, kickOff in list(self.eventCalendar.kickOffs.items()):
+            if kickOff < now and eventId not in self.eventCalendar.events:
+                del self.eventCalendar.kickOffs[eventId]
+
+        budgetUsed = self.executor.lastReport['budgetUsed'] if self.executor.lastReport else None
+        self.outbox.put(('report', self.shardId, {'seq': self.lastSeq, 'liability': round(self.ledger.liability, 2),
+                                                  'pendingStake': round(sum(stake for eventId, stake in self.assignments.values()), 2),
+                                                  'records': dict((position.marketId, position.toRecord()) for position in self.positions),
+                                                  'budgetUsed': budgetUsed}))
+
+
+def runWorker(shardId, inbox, outbox, config):
+    # process entry point - config holds only picklable values (see ShardCoordinator)
+    if 'logLevel' in config:
+        log.level = config['logLevel']
+    settings = config['betfairSettings']
+    betfairSettings = BetfairSettings(settings['appKey'], settings['sessionToken'], settings['bettingURL'],
+                                      settings['accountsURL'], timeoutSeconds=settings['timeoutSeconds'],
+                                      hedging=HedgedReads() if settings['hedging'] else None,
+                                      resilience=Resilience() if settings['resilience'] else None)
+
+    worker = ShardWorker(shardId, inbox, outbox, StrategySettings(**config['strategySettings']), betfairSettings,
+                         config['journalPath'] % shardId, betfairFactory=config['betfairFactory'],
+                         tickBudgetSeconds=config['tickBudgetSeconds'])
+    worker.run(config['intervalSeconds'])
+
+# ----------------------------------
+# COORDINATOR
+# ----------------------------------
+
+
+class ShardHandle:
+    __slots__ = ('shardId', 'process', 'inbox', 'report', 'reportedAt',
+                 'startedAt', 'inFlight', 'retiring')
+
+    def __init__(self, shardId, process, inbox, startedAt):
+        self.shardId = shardId
+        self.process = process
+        self.inbox = inbox
+        self.report = None
+        self.reportedAt = None
+        self.startedAt = startedAt
+        self.inFlight = []
+        self.retiring = False
+
+
+class ShardCoordinator(OverUnderStrategy):
+    '''
+    Discovery, staging and risk for N ShardWorker processes. Each staged market
+    goes to the worker its marketId hashes to, provided the account wide limit
+    holds: worker liabilities, stake assigned but not yet entered and stake still
+    in flight to a worker stay within maxExposure and the available balance.
+
+    Every market has at most one owner. When a worker is added or retired the
+    markets whose hash owner changed are released by their old owner (journalled
+    CLOSED 'RELEASED') and only then adopted by the new one; a worker that dies,
+    or stops reporting for workerTimeoutSeconds and is terminated, is replaced and
+    has its last reported positions adopted straight away (held until a worker is
+    back if none is live) and its unentered assignments staged again. Once every live worker has reported after a start or a death, an
+    account wide order query hands markets with unmatched orders and no owner to
+    their hash owner.
+    '''
+
+    def __init__(self, strategySettings, betfairSettings, workerConfig, workers=2, maxExposure=100.0,
+                 workerTimeoutSeconds=60.0, workerCountPath='shard.workers', **options):
+        self.workerConfig = workerConfig
+        self.maxExposure = maxExposure
+        self.workerTimeoutSeconds = workerTimeoutSeconds
+        self.workerCountPath = workerCountPath
+        self.workerCountMtime = None
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+        self.ring = HashRing()
+        self.shards = {}
+        self.owners = {}
+        self.handoffs = {}
+        self.adopting = {}
+        self.pendingAdoptions = {}
+        self.assigned = {}
+        self.workerCount = 0
+        self.nextSeq = 0
+        self.nextShardId = 0
+        self.orphanScanAfter = None
+        self.reconciledAt = None
+        self.liabilityAtReconcile = 0.0
+
+        # the coordinator holds no positions of its own
+        OverUnderStrategy.__init__(
+            self, strategySettings, betfairSettings, journalPath=os.devnull, **options)
+        self.setWorkerCount(workers)
+
+    def bootstrapPositions(self):
+        # positions are the workers'; unowned markets are found once they have all reported
+        self.orphanScanAfter = time.monotonic()
+
+    def iterationStages(self):
+        if self.sessionTokenExpiresAt < datetime.datetime.now():
+            self.refreshSessionToken()
+            for shardId in self.shards:
+                self.send(shardId, ('session', self.betfairSettings.sessionToken,
+                                    self.sessionTokenExpiresAt.isoformat()))
+        self.betfair = self.betfairFactory(self.betfairSettings)
+
+        self.receive()
+        self.supervise()
+
+        self.runTasks([('reconcile', self.reconcileFunds), ('discovery', self.discoverEvents),
+                       ('assign', self.assignEvents)])
+
+        metrics.set('shard_workers', len(self.liveShards()))
+        metrics.set('shard_exposure', sum(self.shardExposure()))
+        for shard in self.shards.values():
+            if shard.report is not None:
+                metrics.set('shard_positions', len(
+                    shard.report['records']), (('shard', str(shard.shardId)),))
+
+    def reconcileFunds(self, budget):
+        OverUnderStrategy.reconcileFunds(self, budget)
+        # the account balance has the liability of this moment taken off, not what workers add after it
+        if self.ledger.reconciledAt != self.reconciledAt:
+            self.reconciledAt = self.ledger.reconciledAt
+            self.liabilityAtReconcile = self.shardExposure()[0]
+
+    def close(self):
+        for shardId in self.shards:
+            self.send(shardId, ('stop',))
+        for shard in self.shards.values():
+            shard.process.join(timeout=10)
+        self.ledger.stop()
+
+# ----------------------------------
+# WORKERS
+# ----------------------------------
+    def setWorkerCount(self, count):
+        self.workerCount = count
+        live = sorted(shard.shardId for shard in self.liveShards())
+        for i in range(count - len(live)):
+            self.startWorker()
+        # the newest workers retire first, after handing their markets back
+        for shardId in live[count:]:
+            self.shards[shardId].retiring = True
+            self.ring.remove(shardId)
+        log.info('SHARD_WORKERS', workers=count)
+
+    def startWorker(self):
+        shardId = self.nextShardId
+        self.nextShardId = self.nextShardId + 1
+        config = dict(self.workerConfig)
+        config['betfairSettings'] = dict(config['betfairSettings'],
+                                         sessionToken=self.betfairSettings.sessionToken)
+
+        inbox = self.context.Queue()
+        process = self.context.Process(target=runWorker, args=(shardId, inbox, self.outbox, config),
+                                       name='shard-%d' % shardId, daemon=True)
+        process.start()
+        self.shards[shardId] = ShardHandle(
+            shardId, process, inbox, time.monotonic())
+        self.ring.add(shardId)
+        log.info('SHARD_STARTED', shard=shardId, pid=process.pid)
+
+    def liveShards(self):
+        return [shard for shard in self.shards.values() if not shard.retiring]
+
+    def supervise(self):
+        now = time.monotonic()
+
+        # desired worker count from the control file
+        try:
+            mtime = os.path.getmtime(self.workerCountPath)
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != self.workerCountMtime:
+            self.workerCountMtime = mtime
+            try:
+                with open(self.workerCountPath, 'r') as countFile:
+                    self.setWorkerCount(max(1, int(countFile.read().strip())))
+            except ValueError:
+                log.warning('SHARD_WORKERS_UNREADABLE',
+                            path=self.workerCountPath)
+
+        for shard in list(self.shards.values()):
+            lastSeenAt = shard.reportedAt or shard.startedAt
+            if shard.process.is_alive() and now - lastSeenAt > self.workerTimeoutSeconds:
+                log.error('SHARD_UNRESPONSIVE', shard=shard.shardId,
+                          silentSeconds=round(now - lastSeenAt, 1))
+                shard.process.terminate()
+                shard.process.join(timeout=5)
+
+            if not shard.process.is_alive():
+                self.workerDied(shard)
+            elif shard.retiring and shard.report is not None and not shard.report['records'] \
+                    and not shard.report['pendingStake'] and not self.handoffsFrom(shard.shardId):
+                self.send(shard.shardId, ('stop',))
+                shard.process.join(timeout=10)
+                del self.shards[shard.shardId]
+                log.info('SHARD_RETIRED', shard=shard.shardId)
+
+        # positions left without any live worker go to the first one back
+        if self.pendingAdoptions and self.ring.points:
+            pending = self.pendingAdoptions
+            self.pendingAdoptions = {}
+            for record in pending.values():
+                self.adopt(record)
+
+        self.rebalance()
+        self.scanOrphans()
+
+    def workerDied(self, shard):
+        metrics.inc('shard_worker_deaths_total')
+        log.error('SHARD_DIED', shard=shard.shardId,
+                  exitCode=shard.process.exitcode)
+        del self.shards[shard.shardId]
+        self.ring.remove(shard.shardId)
+
+        # replaced before its positions are handed out, so the ring has an owner for them
+        if not shard.retiring:
+            while len(self.liveShards()) < self.workerCount:
+                self.startWorker()
+
+        # its positions are adopted from the last report, unentered assignments staged again
+        records = shard.report['records'] if shard.report is not None else {}
+        for marketId in [marketId for marketId, owner in self.owners.items() if owner == shard.shardId]:
+            del self.owners[marketId]
+            self.adopting.pop(marketId, None)
+        for record in records.values():
+            self.adopt(record)
+        for marketId, (shardId, event, state) in list(self.assigned.items()):
+            if shardId == shard.shardId and marketId not in records:
+                del self.assigned[marketId]
+                self.stagedEvents.setdefault(event['event']['id'], []).append(
+                    StagedMarket.fromState(state))
+                self.eventCalendar.kickOffs.setdefault(
+                    event['event']['id'], self.eventCalendar.parseDateTime(event['event']['openDate']))
+        # releases it never confirmed: the position is still in its last report, adopted above
+        for marketId in self.handoffsFrom(shard.shardId):
+            del self.handoffs[marketId]
+
+        # a position it entered after its last report has no owner now
+        self.orphanScanAfter = time.monotonic()
+
+    def rebalance(self):
+        # markets whose hash owner changed are released first, adopted when the release is confirmed
+        if not self.ring.points:
+            return
+        moves = 0
+        for marketId, shardId in self.owners.items():
+            if marketId in self.handoffs or self.ring.owner(marketId) == shardId:
+                continue
+            self.handoffs[marketId] = shardId
+            self.send(shardId, ('release', [marketId]))
+            moves = moves + 1
+        if moves:
+            metrics.inc('shard_handoffs_total', value=moves)
+            log.info('SHARD_REBALANCE', moves=moves,
+                     workers=len(self.ring))
+
+    def handoffsFrom(self, shardId):
+        return [marketId for marketId, owner in self.handoffs.items() if owner == shardId]
+
+    def scanOrphans(self):
+        if self.orphanScanAfter is None or not self.shards:
+            return
+        if any(shard.reportedAt is None or shard.reportedAt < self.orphanScanAfter for shard in self.shards.values()):
+            return
+        self.orphanScanAfter = None
+
+        ordersByMarketId = self.fetchAccountOrders(self.betfair)
+        if ordersByMarketId is None:
+            self.orphanScanAfter = time.monotonic()
+            return
+
+        for marketId, orders in ordersByMarketId.items():
+            unmatched = [order for order in orders if order.sizeMatched == 0.0]
+            if not unmatched or marketId in self.owners or marketId in self.handoffs or marketId in self.pendingAdoptions:
+                continue
+            assigned = self.assigned.get(marketId)
+            if assigned is not None and assigned[0] in self.shards:
+                continue
+
+            self.adopt({'marketId': marketId, 'selectionId': unmatched[0].selectionId,
+                        'state': OPENED, 'reconciled': True})
+            metrics.inc('shard_orphans_adopted_total')
+
+# ----------------------------------
+# COORDINATOR MESSAGES
+# ----------------------------------
+    def send(self, shardId, message):
+        self.nextSeq = self.nextSeq + 1
+        self.shards[shardId].inbox.put(
+            (message[0], self.nextSeq) + message[1:])
+        return self.nextSeq
+
+    def adopt(self, record):
+        # the hash owner takes the position and owns it from now on, whatever its next report says
+        marketId = record['marketId']
+        if not self.ring.points:
+            log.error('SHARD_ADOPTION_PENDING', marketId=marketId)
+            self.pendingAdoptions[marketId] = record
+            return
+        shardId = self.ring.owner(marketId)
+        self.adopting[marketId] = self.send(shardId, ('adopt', [record]))
+        self.owners[marketId] = shardId
+
+    def receive(self):
+        while True:
+            try:
+                message = self.outbox.get_nowait()
+            except queue.Empty:
+                return
+
+            kind, shardId = message[0], message[1]
+            shard = self.shards.get(shardId)
+            if shard is None:
+                continue
+
+            if kind == 'report':
+                self.applyReport(shard, message[2])
+            elif kind == 'released':
+                for marketId in message[2]:
+                    self.handoffs.pop(marketId, None)
+                    if self.owners.get(marketId) == shardId:
+                        del self.owners[marketId]
+                for record in message[3]:
+                    self.adopt(record)
+
+    def applyReport(self, shard, report):
+        shard.report = report
+        shard.reportedAt = time.monotonic()
+        shard.inFlight = [(seq, stake) for seq, stake in shard.inFlight
+                          if seq > report['seq']]
+
+        for marketId in report['records']:
+            owner = self.owners.get(marketId)
+            if owner is not None and owner != shard.shardId and owner in self.shards \
+                    and self.shards[owner].report is not None and marketId in self.shards[owner].report['records']:
+                metrics.inc('shard_ownership_conflicts_total')
+                log.error('SHARD_OWNERSHIP_CONFLICT', marketId=marketId,
+                          shards=[owner, shard.shardId])
+            if marketId not in self.handoffs and marketId not in self.adopting:
+                self.owners[marketId] = shard.shardId
+            self.assigned.pop(marketId, None)
+
+        # adoptions the worker has applied by now
+        for marketId, seq in list(self.adopting.items()):
+            if self.owners.get(marketId) == shard.shardId and seq <= report['seq']:
+                del self.adopting[marketId]
+
+        # closed positions drop out, unless still on their way to this worker or away from it
+        for marketId in [marketId for marketId, owner in self.owners.items()
+                         if owner == shard.shardId and marketId not in report['records']
+                         and marketId not in self.adopting and marketId not in self.handoffs]:
+            del self.owners[marketId]
+
+# ----------------------------------
+# ASSIGNMENT
+# ----------------------------------
+    def shardExposure(self):
+        # (liability of open positions, stake assigned but not yet entered)
+        liability = 0.0
+        reserved = 0.0
+        for shard in self.shards.values():
+            if shard.report is not None:
+                liability += shard.report['liability']
+                reserved += shard.report['pendingStake']
+            reserved += sum(stake for seq, stake in shard.inFlight)
+        return round(liability, 2), round(reserved, 2)
+
+    def assignEvents(self, budget):
+        if not self.canEnter or not self.ring.points:
+            return
+
+        # events reaching the window unstaged are staged now; staged events go out ahead of it
+        now = time.time()
+        eligible = [event for event in self.eventCalendar.eligibleEvents()
+                    if event['event']['id'] not in self.stagedEvents]
+        if eligible:
+            self.stageEventList(eligible, budget, now)
+
+        liability, reserved = self.shardExposure()
+        available = self.availableToBetBalance - \
+            (liability - self.liabilityAtReconcile)
+        for eventId, stagedMarkets in list(self.stagedEvents.items()):
+            event = {'event': stagedMarkets[0].eventDetails} if stagedMarkets else None
+            remaining = []
+            byShard = {}
+            for staged in stagedMarkets:
+                marketId = staged.market.marketId
+                if marketId in self.owners or marketId in self.assigned:
+                    continue
+                if liability + reserved + staged.stake > self.maxExposure or reserved + staged.stake > available:
+                    metrics.inc('shard_entries_blocked_total')
+                    remaining.append(staged)
+                    continue
+                reserved = reserved + staged.stake
+                byShard.setdefault(self.ring.owner(
+                    marketId), []).append(staged)
+
+            for shardId, shardMarkets in byShard.items():
+                seq = self.send(shardId, ('enter', event, [
+                                staged.toState() for staged in shardMarkets]))
+                self.shards[shardId].inFlight.append(
+                    (seq, sum(staged.stake for staged in shardMarkets)))
+                for staged in shardMarkets:
+                    self.assigned[staged.market.marketId] = (
+                        shardId, event, staged.toState())
+                log.info('SHARD_ASSIGNED', eventId=eventId, shard=shardId,
+                         markets=[staged.market.marketId for staged in shardMarkets])
+
+            if remaining:
+                self.stagedEvents[eventId] = remaining
+            else:
+                del self.stagedEvents[eventId]
+                self.eventCalendar.remove(eventId)
+
+        # assignments never entered are forgotten once their event kicked off
+        for marketId, (shardId, event, state) in list(self.assigned.items()):
+            kickOff = self.eventCalendar.kickOff(event['event']['id'])
+            if kickOff is None or kickOff < now:
+                del self.assigned[marketId]
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+from eventlog import log
+
+# bumped when the layout changes; snapshots of another version are ignored
+SNAPSHOT_VERSION = 1
+
+# ----------------------------------
+# STATE SNAPSHOT
+# ----------------------------------
+
+
+class StateSnapshot:
+    '''
+    Daemon state saved for a warm start: written every intervalSeconds and at
+    shutdown, read once at launch. The file is written beside its final name,
+    fsync'd and renamed, so a crash leaves either the previous snapshot or the
+    new one; it is readable by its owner only, as it holds the session token.
+    A snapshot older than maxAgeSeconds, of another version or that fails to
+    parse is ignored and the daemon starts cold.
+    '''
+
+    def __init__(self, path, intervalSeconds=60, maxAgeSeconds=900):
+        self.path = path
+        self.intervalSeconds = intervalSeconds
+        self.maxAgeSeconds = maxAgeSeconds
+        self.writtenAt = time.monotonic()
+
+    def due(self):
+        return time.monotonic() - self.writtenAt >= self.intervalSeconds
+
+    def write(self, state):
+        state = dict(state, version=SNAPSHOT_VERSION,
+                     savedAt=round(time.time(), 3))
+
+        # owner only: the snapshot carries the live session token
+        descriptor = os.open(self.path + '.tmp', os.O_WRONLY |
+                             os.O_CREAT | os.O_TRUNC, 0o600)
+        if hasattr(os, 'fchmod'):
+            # a .tmp left by a crash keeps its old mode through O_CREAT
+            os.fchmod(descriptor, 0o600)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as snapshotFile:
+            json.dump(state, snapshotFile, separators=(',', ':'))
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+        self.writtenAt = time.monotonic()
+        log.debug('SNAPSHOT_WRITTEN', path=self.path)
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as snapshotFile:
+                state = json.load(snapshotFile)
+        except ValueError:
+            log.warning('SNAPSHOT_UNREADABLE', path=self.path)
+            return None
+
+        age = time.time() - state.get('savedAt', 0)
+        if state.get('version') != SNAPSHOT_VERSION or age > self.maxAgeSeconds:
+            log.info('SNAPSHOT_IGNORED', path=self.path, version=state.get('version'),
+                     ageSeconds=round(age, 1))
+            return None
+
+        return state
@@ -0,0 +1,34 @@
+import unittest
+
+from eventlog import log
+from eventlog import WARNING
+from loadtest import runLeakCheck
+
+# ----------------------------------
+# MEMORY
+# ----------------------------------
+
+
+class LeakCheckTest(unittest.TestCase):
+    # thousands of ticks against the fake exchange, markets turning over throughout
+
+    def setUp(self):
+        self.level = log.level
+        log.level = WARNING
+
+    def tearDown(self):
+        log.level = self.level
+
+    def testTracedMemoryStaysFlat(self):
+        result = runLeakCheck(2000)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['orders_placed_calls'], 1000)
+        self.assertTrue(result['passed'], 'grew %(bytes_per_tick)s bytes per tick: %(growth_sites)s' % result)
+        # every cache is bounded by the markets live at the end, not by the ticks run
+        for name, entries in result['caches'].items():
+            self.assertLess(entries, 500, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import signal
+import threading
+import time
+
+from eventlog import log
+
+# ----------------------------------
+# TRACING
+# ----------------------------------
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'attrs', 'startedAt')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.startedAt = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        endedAt = time.perf_counter()
+        if excType is not None:
+            self.attrs['error'] = excType.__name__
+        self.tracer.write({'name': self.name, 'ph': 'X', 'ts': round(self.startedAt * 1e6),
+                           'dur': round((endedAt - self.startedAt) * 1e6), 'pid': self.tracer.pid,
+                           'tid': threading.get_ident(), 'args': self.attrs})
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    '''
+    Writes complete ('X') spans in the Chrome trace event JSON array format, which
+    chrome://tracing, Perfetto and speedscope load directly (the closing bracket is
+    optional, so the file is valid to load at any point). The file is rotated at
+    maxBytes keeping backupCount old files. span() returns a shared no-op span when
+    tracing is disabled.
+    '''
+
+    def __init__(self, path='trace.json', maxBytes=50 * 1024 * 1024, backupCount=3, enabled=False):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self.file = None
+        self.lock = threading.Lock()
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs)
+
+    def write(self, event):
+        line = json.dumps(event, separators=(',', ':'), default=str) + ',\n'
+
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'w', encoding='utf-8')
+                self.file.write('[\n')
+
+            self.file.write(line)
+
+            if self.file.tell() >= self.maxBytes:
+                self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+
+        for i in range(self.backupCount - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.replace('%s.%d' % (self.path, i),
+                           '%s.%d' % (self.path, i + 1))
+        if self.backupCount > 0:
+            os.replace(self.path, self.path + '.1')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# ----------------------------------
+# PROFILER SWITCH
+# ----------------------------------
+
+
+class ProfilerSwitch:
+    '''
+    Profiles the next N ticks of the live daemon with cProfile when SIGUSR1 is
+    received or the trigger file appears (its contents, if any, give N). Results
+    are dumped as a .prof file (snakeviz, gprof2dot) plus a text summary. When
+    idle the per-tick cost is one stat() of the trigger file.
+
+    cProfile only hooks the thread that enables it and the scheduler runs ticks
+    on pool threads, so the profile is enabled and disabled within each tick, on
+    its thread, and accumulates over the N ticks.
+    '''
+
+    def __init__(self, triggerPath='profile.trigger', outputDir='.', defaultTicks=10):
+        self.triggerPath = triggerPath
+        self.outputDir = outputDir
+        self.defaultTicks = defaultTicks
+        self.requestedTicks = 0
+        self.ticksRemaining = 0
+        self.profile = None
+
+        if hasattr(signal, 'SIGUSR1'):
+            try:
+                signal.signal(signal.SIGUSR1, self.onSignal)
+            except ValueError:
+                # not the main thread; file trigger only
+                pass
+
+    def onSignal(self, signum, frame):
+        self.requestedTicks = self.defaultTicks
+
+    def beforeTick(self):
+        if self.profile is not None:
+            self.profile.enable()
+            return
+
+        if os.path.exists(self.triggerPath):
+            try:
+                with open(self.triggerPath, 'r') as triggerFile:
+                    contents = triggerFile.read().strip()
+                os.remove(self.triggerPath)
+                self.requestedTicks = int(
+                    contents) if contents else self.defaultTicks
+            except (OSError, ValueError):
+                self.requestedTicks = self.defaultTicks
+
+        if self.requestedTicks > 0:
+            log.info('PROFILING', ticks=self.requestedTicks)
+            self.ticksRemaining = self.requestedTicks
+            self.requestedTicks = 0
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def afterTick(self):
+        if self.profile is None:
+            return
+
+        self.profile.disable()
+        self.ticksRemaining = self.ticksRemaining - 1
+        if self.ticksRemaining > 0:
+            return
+
+        basePath = os.path.join(
+            self.outputDir, time.strftime('profile-%Y%m%d-%H%M%S'))
+        self.profile.dump_stats(basePath + '.prof')
+
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats(
+            'cumulative').print_stats(40)
+        with open(basePath + '.txt', 'w') as summaryFile:
+            summaryFile.write(summary.getvalue())
+
+        log.info('PROFILE_WRITTEN', path=basePath + '.prof')
+        self.profile = None
+
+
+# shared tracer - Betfair clients are short lived so the tracer lives here
+tracer = Tracer()